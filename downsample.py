@@ -0,0 +1,176 @@
+import numpy as np
+import param
+
+from holoviews.core import Element, Operation
+from holoviews.streams import PlotSize, RangeX
+
+
+def m4_indices(x, y, width, x_range=None):
+    """
+    Return the indices of the first, min, max and last point in every
+    pixel column (M4 downsampling), sorted. Drawing just these points looks
+    the same as drawing all of them at that width.
+
+    Parameters
+    ----------
+
+    x, y: numpy.array
+        Point coordinates, x sorted
+
+    width: int
+        Number of pixel columns
+
+    x_range: tuple
+        Visible x range, defaults to the range of x
+
+    """
+
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    valid = np.flatnonzero(np.isfinite(x) & np.isfinite(y))
+    if len(valid) == 0:
+        return valid
+
+    if x_range is None:
+        x_range = (x[valid[0]], x[valid[-1]])
+    lo = np.searchsorted(x[valid], x_range[0], side='left')
+    hi = np.searchsorted(x[valid], x_range[1], side='right')
+    valid = valid[lo:hi]
+    if len(valid) <= 4*width:
+        return valid
+
+    xs = x[valid]
+    ys = y[valid]
+    span = (x_range[1] - x_range[0]) or 1.
+    column = np.clip(((xs - x_range[0]) / span * width).astype(np.int64), 0, width - 1)
+
+    # Points are sorted by x, so every column is one contiguous run
+    starts = np.flatnonzero(np.diff(column, prepend=-1))
+    ends = np.append(starts[1:], len(xs))
+    lengths = ends - starts
+    position = np.arange(len(xs))
+    past_end = len(xs)
+
+    mins = np.repeat(np.minimum.reduceat(ys, starts), lengths)
+    maxs = np.repeat(np.maximum.reduceat(ys, starts), lengths)
+    argmin = np.minimum.reduceat(np.where(ys == mins, position, past_end), starts)
+    argmax = np.minimum.reduceat(np.where(ys == maxs, position, past_end), starts)
+
+    picked = np.unique(np.concatenate([starts, argmin, argmax, ends - 1]))
+    return valid[picked]
+
+
+def lttb_indices(x, y, n_out):
+    """
+    Return the indices of n_out points picked with Largest-Triangle-Three-
+    Buckets: the first and last point plus, for every bucket in between,
+    the point making the largest triangle with the point picked in the
+    previous bucket and the average of the next one.
+
+    Parameters
+    ----------
+
+    x, y: numpy.array
+        Point coordinates, x sorted
+
+    n_out: int
+        Number of points to keep
+
+    """
+
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    valid = np.flatnonzero(np.isfinite(x) & np.isfinite(y))
+    count = len(valid)
+    if count <= n_out or n_out < 3:
+        return valid
+    xs = x[valid]
+    ys = y[valid]
+
+    # Bucket edges, the first and last point get a bucket of their own
+    edges = (np.arange(n_out - 1) * (count - 2) / (n_out - 2)).astype(np.int64) + 1
+    edges[-1] = count - 1
+
+    # Average of every bucket, from cumulative sums
+    cx = np.concatenate([[0.], np.cumsum(xs)])
+    cy = np.concatenate([[0.], np.cumsum(ys)])
+    sizes = edges[1:] - edges[:-1]
+    avg_x = np.append((cx[edges[1:]] - cx[edges[:-1]]) / sizes, xs[-1])
+    avg_y = np.append((cy[edges[1:]] - cy[edges[:-1]]) / sizes, ys[-1])
+
+    picked = np.empty(n_out, dtype=np.int64)
+    picked[0] = 0
+    picked[-1] = count - 1
+    previous = 0
+    for bucket in range(n_out - 2):
+        start, end = edges[bucket], edges[bucket + 1]
+        px, py = xs[previous], ys[previous]
+        nx, ny = avg_x[bucket + 1], avg_y[bucket + 1]
+        area = np.abs((px - nx) * (ys[start:end] - py) - (px - xs[start:end]) * (ny - py))
+        previous = start + int(area.argmax())
+        picked[bucket + 1] = previous
+
+    return valid[picked]
+
+
+class downsample(Operation):
+    """
+    Downsample Points, Scatter and Curve elements to what the plot can show
+    without losing extremes, like holoviews.operation.decimate but picking
+    points with M4 (first/min/max/last per pixel column) or LTTB instead of
+    at random. Use with PlotSize and RangeX streams so it follows the plot:
+
+        downsample(dmap, streams=[hv.streams.PlotSize, hv.streams.RangeX])
+
+    """
+
+    algorithm = param.ObjectSelector(default='m4', objects=['m4', 'lttb'], doc="""
+        M4 keeps at most four points per pixel column, LTTB two per column""")
+
+    link_inputs = param.Boolean(default=True, doc="""
+        Link inputs so tools like hover still work on the downsampled plot""")
+
+    width = param.Integer(default=1000, allow_None=True, doc="""
+        Plot width in pixels, set by the PlotSize stream""")
+
+    height = param.Integer(default=400, allow_None=True, doc="""
+        Plot height in pixels, set by the PlotSize stream""")
+
+    scale = param.Number(default=1.0, doc="""
+        Plot scale, set by the PlotSize stream""")
+
+    x_range = param.NumericTuple(default=None, length=2, doc="""
+        Visible x range, set by the RangeX stream""")
+
+    streams = param.List(default=[PlotSize, RangeX], doc="""
+        Streams that trigger the operation""")
+
+    def _process_layer(self, element, key=None):
+        if not len(element):
+            return element
+
+        width = self.p.width or 1000
+        x = element.dimension_values(0)
+        y = element.dimension_values(1)
+        order = None
+        if len(x) > 1 and np.any(np.diff(x) < 0):
+            order = np.argsort(x, kind='mergesort')
+            x = x[order]
+            y = y[order]
+
+        if self.p.algorithm == 'm4':
+            indices = m4_indices(x, y, width, self.p.x_range)
+        else:
+            if self.p.x_range is not None:
+                lo = np.searchsorted(x, self.p.x_range[0], side='left')
+                hi = np.searchsorted(x, self.p.x_range[1], side='right')
+            else:
+                lo, hi = 0, len(x)
+            indices = lo + lttb_indices(x[lo:hi], y[lo:hi], 2*width)
+
+        if order is not None:
+            indices = np.sort(order[indices])
+        return element.iloc[indices]
+
+    def _process(self, element, key=None):
+        return element.map(self._process_layer, Element)
@@ -0,0 +1,138 @@
+import numpy as np
+
+from ring_buffer import RingBuffer
+
+
+class EnvelopePyramid:
+    """
+    Multi-level min/max envelope of one channel, kept up to date as samples
+    arrive in a RingBuffer.
+
+    Level 1 bins every ``fanout`` samples of the source into their min and
+    max (with the time each happened), level 2 bins every ``fanout`` level 1
+    bins, and so on, each level in its own RingBuffer. Bins are only built
+    once, when they are complete, so keeping the pyramid up to date costs
+    O(new samples).
+
+    query() picks the finest level that fits the requested number of points
+    in a time range, finding the range with a binary search, so it costs
+    O(K log N) for K points out of N samples. Spikes survive at every level
+    because each bin keeps both its min and its max.
+
+    Parameters
+    ----------
+
+    source: RingBuffer
+        Ring buffer of the channel to follow
+
+    fanout: int
+        Number of bins of one level that make up a bin of the next
+
+    """
+
+    # Columns of every bin
+    MIN, MAX, MIN_TS, MAX_TS = range(4)
+
+    def __init__(self, source, fanout=4):
+        self.source = source
+        self.fanout = fanout
+        self._cursor = 0
+
+        # Level 0 is the source itself
+        self.levels = []
+        size = source.maxlen // fanout
+        while size >= 1:
+            self.levels.append(RingBuffer(size + 1, shape=(4,)))
+            size //= fanout
+
+        # Complete rows of the level below not yet making up a full bin,
+        # as (rows, start timestamps in ns)
+        self._pending = [(np.empty((0, 4)), np.empty(0, dtype=np.int64)) for _ in self.levels]
+
+    def update(self):
+        """
+        Bin every sample added to the source since the last call
+
+        """
+
+        values, timestamps, self._cursor = self.source.since(self._cursor)
+        times = timestamps.astype(np.float64)
+        rows = np.column_stack([values, values, times, times])
+        starts = timestamps
+
+        for index, level in enumerate(self.levels):
+            pending_rows, pending_starts = self._pending[index]
+            rows = np.concatenate([pending_rows, rows])
+            starts = np.concatenate([pending_starts, starts])
+            full = len(rows) // self.fanout * self.fanout
+            self._pending[index] = (rows[full:], starts[full:])
+            if full == 0:
+                break
+
+            grouped = rows[:full].reshape(-1, self.fanout, 4)
+            low = grouped[:, :, self.MIN].argmin(axis=1)
+            high = grouped[:, :, self.MAX].argmax(axis=1)
+            bins = np.arange(len(grouped))
+            rows = np.column_stack([
+                grouped[bins, low, self.MIN],
+                grouped[bins, high, self.MAX],
+                grouped[bins, low, self.MIN_TS],
+                grouped[bins, high, self.MAX_TS]])
+            starts = starts[:full:self.fanout]
+            level.extend(rows, starts/1e9)
+
+    def query(self, start=None, end=None, max_points=1000):
+        """
+        Return at most about max_points values and their timestamps in ns
+        covering [start, end], as numpy arrays sorted by time
+
+        Parameters
+        ----------
+
+        start, end: int
+            Time range in ns, None for everything retained
+
+        max_points: int
+            Most points wanted, e.g. twice the plot width in pixels
+
+        """
+
+        values, timestamps = self.source.last()
+        lo, hi = self._range(timestamps, start, end)
+        if hi - lo <= max_points or not self.levels:
+            return values[lo:hi], timestamps[lo:hi]
+
+        # Finest level with few enough bins, each bin gives two points
+        for index, level in enumerate(self.levels):
+            rows, starts = level.last()
+            lo, hi = self._range(starts, start, end)
+            if 2*(hi - lo) <= max_points or index == len(self.levels) - 1:
+                break
+
+        # The newest samples aren't in a complete bin of this level yet,
+        # they are still pending at this level and the ones below it
+        pieces = [rows[lo:hi]]
+        for pending_rows, _ in self._pending[index::-1]:
+            pieces.append(pending_rows)
+        rows = np.concatenate(pieces)
+
+        # Two points per bin, in time order within the bin
+        first_min = rows[:, self.MIN_TS] <= rows[:, self.MAX_TS]
+        points = np.empty(2*len(rows))
+        times = np.empty(2*len(rows))
+        points[0::2] = np.where(first_min, rows[:, self.MIN], rows[:, self.MAX])
+        points[1::2] = np.where(first_min, rows[:, self.MAX], rows[:, self.MIN])
+        times[0::2] = np.where(first_min, rows[:, self.MIN_TS], rows[:, self.MAX_TS])
+        times[1::2] = np.where(first_min, rows[:, self.MAX_TS], rows[:, self.MIN_TS])
+
+        keep = np.ones(len(times), dtype=bool)
+        if start is not None:
+            keep &= times >= start
+        if end is not None:
+            keep &= times <= end
+        return points[keep], times[keep].astype(np.int64)
+
+    def _range(self, timestamps, start, end):
+        lo = 0 if start is None else np.searchsorted(timestamps, start, side='left')
+        hi = len(timestamps) if end is None else np.searchsorted(timestamps, end, side='right')
+        return lo, hi
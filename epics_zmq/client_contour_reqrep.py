@@ -1,5 +1,6 @@
 import sys
 import zmq
+import zmq.asyncio
 import tables
 import datetime
 
@@ -14,13 +15,15 @@ from bokeh.io import output_file, save
 from bokeh.server.server import Server
 from bokeh.application import Application
 from bokeh.application.handlers.function import FunctionHandler
+from tornado.ioloop import PeriodicCallback
 
 from holoviews.streams import Buffer
 from holoviews.core import util
 from holoviews.operation.datashader import datashade, dynspread
 from holoviews.operation import decimate
 
-from event_builder import basic_event_builder
+from data_hub import DataHub, request_data
+from lazy_pirate import LazyPirate
 from functools import partial
 from collections import deque
 
@@ -102,8 +105,12 @@ def gen_scatter(df):
     
 class BokehApp:
     
-    def __init__(self):
+    def __init__(self, hub):
         self.switch_key = 'ipm2'
+        
+        # Events built once for every session, and the version last drawn
+        self.hub = hub
+        self.version = None
         self.maxlen = 1000000
         
         self.curBackData = pd.read_csv('data_class.csv', index_col='Unnamed: 0')
@@ -114,41 +121,17 @@ class BokehApp:
         
         # Initialize callbacks
         self.callback_id_scatter = None
-                
-        self.ipm2_index = 0
-        self.ipm3_index = 0
-        self.ebeam_index = 0
-        self.ipm2TS_index = 0
-        self.ipm3TS_index = 0
-        self.ebeamTS_index = 0
         
         self.limit = 50
         
         self.paused_list = pd.DataFrame({'ebeam':[], 'ipm2':[], 'ipm3':[]})
         
-        self.ipm2_plot = []
-        self.ipm3_plot = []
-        self.ebeam_plot = []
-        self.ipm2TS_plot = []
-        self.ipm3TS_plot = []
-        self.ebeamTS_plot = []
-        
-    def produce_scatter_on_background(self, context, doc):
+    def produce_scatter_on_background(self, doc):
 
         # Interesting error, background doesn't seem to update after running multiple instances 
         # to the latest version and starts off with the data the first instance was given. 
         # Need to figure out why!
 
-        # Port to connect to master
-        port = 5000
-        #socket = context.socket(zmq.SUB)
-        socket = context.socket(zmq.REQ)
-        
-        
-        # MUST BE FROM SAME MACHINE, CHANGE IF NECESSARY!!!
-        socket.connect("tcp://localhost:%d" % port)
-        #socket.setsockopt(zmq.SUBSCRIBE, b"")        
-
         # Dynamic Map
         dmapBackground = hv.DynamicMap(gen_background, streams=[self.streamContour])
 
@@ -164,32 +147,14 @@ class BokehApp:
             Push new scatter points into stream to plot.
 
             """
-            # Still has the freezing points error, though, it seems to come more frequently. 
-            # This may be a bigger problem now
-            
-            #if socket.poll(timeout=0):
-                
-            socket.send_string("Hello")
-            print("Oof")
+            # Nothing new since the last tick
+            version, views = self.hub.snapshot(['events'], self.limit)
+            if version == self.version:
+                return
+            self.version = version
             
-            data_dict = socket.recv_pyobj()
-            peakDict = data_dict['peakDict']
-            peakTSDict = data_dict['peakTSDict']
-
-            self.ipm2_plot = list(peakDict['peak_8'])
-            self.ipm3_plot = list(peakDict['peak_9'])
-            self.ebeam_plot = list(peakDict['peak_10'])
-            self.ipm2TS_plot = list(peakTSDict['peak_8_TS'])
-            self.ipm3TS_plot = list(peakTSDict['peak_9_TS'])
-            self.ebeamTS_plot = list(peakTSDict['peak_10_TS'])
-
-            ipm2Data = pd.Series(self.ipm2_plot[-self.limit:], index=self.ipm2TS_plot[-self.limit:])
-            ipm3Data = pd.Series(self.ipm3_plot[-self.limit:], index=self.ipm3TS_plot[-self.limit:])
-            ebeamData = pd.Series(self.ebeam_plot[-self.limit:], index=self.ebeamTS_plot[-self.limit:])
-
-            zipped = basic_event_builder(ipm2=ipm2Data, ipm3=ipm3Data, ebeam=ebeamData)
-
-            scatterList = zipped
+            values, timestamps = views['events']
+            scatterList = pd.DataFrame(values, index=timestamps, columns=self.hub.event_names)
 
             data = scatterList[['ebeam', self.switch_key]]
             self.paused_list = scatterList
@@ -202,6 +167,7 @@ class BokehApp:
 
             """
             self.limit = limitSlider.value
+            self.version = None
 
         def switch(attr, old, new):
             """
@@ -247,13 +213,13 @@ class BokehApp:
 
             if startButton.label == '► Play':
                 startButton.label = '❚❚ Pause'
-                self.callback_id_scatter = doc.add_periodic_callback(scatter_tick, 1000)
+                self.callback_id_scatter = self.hub.register(doc, scatter_tick)
             else:
                 startButton.label = '► Play'
-                doc.remove_periodic_callback(self.callback_id_scatter)
+                self.hub.unregister(self.callback_id_scatter)
 
         # Continuously update scatter plot
-        self.callback_id_scatter = doc.add_periodic_callback(scatter_tick, 1000)
+        self.callback_id_scatter = self.hub.register(doc, scatter_tick)
 
         # Create widgets
         limitSlider = Slider(start=10, end=1000, value=50, step=1, title="Number of Events")
@@ -275,28 +241,42 @@ class BokehApp:
 
         doc.title = "Reference Graph"
         doc.add_root(plot)
+        
+        # Stop updating the graph once the page is closed
+        doc.on_session_destroyed(lambda session_context: self.hub.unregister(self.callback_id_scatter))
      
     
-def make_document(context, doc):
+def make_document(hub, doc):
     """
     Create an instance of BokehApp() for each instance of the server
     
     """
     
-    bokehApp = BokehApp()
+    bokehApp = BokehApp(hub)
     
-    bokehApp.produce_scatter_on_background(context, doc)
+    bokehApp.produce_scatter_on_background(doc)
     
 def launch_server():
    
-    context = zmq.Context()
+    # Sockets are awaited on the IO loop instead of blocking it
+    context = zmq.asyncio.Context()
+    
+    # Data is received and events are built once for the whole process
+    hub = DataHub(['peak_8', 'peak_9', 'peak_10'], events={'ipm2': 'peak_8', 'ipm3': 'peak_9', 'ebeam': 'peak_10'})
+    
+    # Port to connect to master
+    port = 5000
+    
+    # MUST BE FROM SAME MACHINE, CHANGE IF NECESSARY!!!
+    requester = LazyPirate(context, "tcp://localhost:%d" % port)
 
     origins = ["localhost:{}".format(5008)]
     
-    apps = {'/': Application(FunctionHandler(partial(make_document, context)))}
+    apps = {'/': Application(FunctionHandler(partial(make_document, hub)))}
     server = Server(apps, port=5008)
     
     server.start()
+    PeriodicCallback(partial(server.io_loop.spawn_callback, request_data, requester, hub), 1000).start()
     
     print('Opening Bokeh application on:')
     for entry in origins:
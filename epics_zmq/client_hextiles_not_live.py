@@ -21,6 +21,7 @@ from holoviews.operation.datashader import datashade, dynspread
 from holoviews.operation import decimate
 
 from event_builder import basic_event_builder
+from framing import send_message, recv_message
 from functools import partial
 from collections import deque
 
@@ -79,22 +80,12 @@ class BokehApp:
         
         # Initialize callbacks
         self.callback_id_hex = None
-                
-        self.ipm2_index = 0
-        self.ipm3_index = 0
-        self.ebeam_index = 0
-        self.ipm2TS_index = 0
-        self.ipm3TS_index = 0
-        self.ebeamTS_index = 0
         
-        self.paused_list = pd.DataFrame({'ebeam':[], 'ipm2':[], 'ipm3':[]})
+        # Only events strictly after this time (in seconds) are plotted after a clear
+        self.clear_time = None
+        self.last_time = None
         
-        self.ipm2_plot = []
-        self.ipm3_plot = []
-        self.ebeam_plot = []
-        self.ipm2TS_plot = []
-        self.ipm3TS_plot = []
-        self.ebeamTS_plot = []
+        self.paused_list = pd.DataFrame({'ebeam':[], 'ipm2':[], 'ipm3':[]})
     
     def produce_hex(self, context, doc, numEvents): 
         
@@ -114,65 +105,16 @@ class BokehApp:
         # Use bokeh to render plot
         hvplot = renderer.get_plot(plot, doc)
         
-        socket.send_string("Hello")
-        print("Oof")
-
-        #if socket.poll(timeout=0):
-
-        data_dict = socket.recv_pyobj()
-        peakDict = data_dict['peakDict']
-        peakTSDict = data_dict['peakTSDict']
+        # Ask the master for the last numEvents samples of the plotted peaks only
+        peaks = {'ipm2': 'peak_8', 'ipm3': 'peak_9', 'ebeam': 'peak_10'}
         
-        # Set index to number of past events we want to see
-        # Definitely is a cleaner way to do this
-        if len(peakDict['peak_8']) < numEvents:
-            self.ipm2_index = 0
-        else:
-            self.ipm2_index = len(peakDict['peak_8']) - numEvents
-            
-        if len(peakDict['peak_9']) < numEvents:
-            self.ipm3_index = 0
-        else:
-            self.ipm3_index = len(peakDict['peak_9']) - numEvents
-            
-        if len(peakDict['peak_10']) < numEvents:
-            self.ebeam_index = 0
-        else:
-            self.ebeam_index = len(peakDict['peak_10']) - numEvents
-            
-        if len(peakTSDict['peak_8_TS']) < numEvents:
-            self.ipm2TS_index = 0
-        else:
-            self.ipm2TS_index = len(peakTSDict['peak_8_TS']) - numEvents
-            
-        if len(peakTSDict['peak_9_TS']) < numEvents:
-            self.ipm3TS_index = 0
-        else:
-            self.ipm3TS_index = len(peakTSDict['peak_9_TS']) - numEvents
-            
-        if len(peakTSDict['peak_10_TS']) < numEvents:
-            self.ebeamTS_index = 0
-        else:
-            self.ebeamTS_index = len(peakTSDict['peak_10_TS']) - numEvents
-
-      
-
         def clear():
             """
-            "Clear" graphs and particular lists of server instance. Save current index
-            and only plot points after that index.
+            "Clear" graphs of server instance. Save the time of the latest sample
+            and only plot events after it.
 
             """  
-            # Small bug, sometimes, when pressing clear after a while, it'll just
-            # load a lot of data instead of clearing? I think it might be skipping over
-            # the resetting of the index
-            
-            self.ipm2_index = len(self.ipm2_plot)
-            self.ipm3_index = len(self.ipm3_plot)
-            self.ebeam_index = len(self.ebeam_plot)
-            self.ipm2TS_index = len(self.ipm2TS_plot)
-            self.ipm3TS_index = len(self.ipm3TS_plot)
-            self.ebeamTS_index = len(self.ebeamTS_plot)
+            self.clear_time = self.last_time
             push_data()
 
         def push_data():
@@ -181,46 +123,27 @@ class BokehApp:
 
             """
             
-            # Doesn't seem to get the most recent data :(
-
-            socket.send_string("Hello")
-            print("Oof")
+            request = {'channels': list(peaks.values()), 'last': numEvents}
+            if self.clear_time is not None:
+                request['after'] = self.clear_time
+            send_message(socket, request)
             
-            #if socket.poll(timeout=0):
-                
-            data_dict = socket.recv_pyobj()
+            data_dict = recv_message(socket)
             peakDict = data_dict['peakDict']
             peakTSDict = data_dict['peakTSDict']
 
-            self.ipm2_plot = list(peakDict['peak_8'])
-            self.ipm3_plot = list(peakDict['peak_9'])
-            self.ebeam_plot = list(peakDict['peak_10'])
-            self.ipm2TS_plot = list(peakTSDict['peak_8_TS'])
-            self.ipm3TS_plot = list(peakTSDict['peak_9_TS'])
-            self.ebeamTS_plot = list(peakTSDict['peak_10_TS'])
-
-            ipm2Data = pd.Series(
-                self.ipm2_plot[self.ipm2_index:], 
-                index=self.ipm2TS_plot[self.ipm2TS_index:])
-
-            ipm3Data = pd.Series(
-                self.ipm3_plot[self.ipm3_index:], 
-                index=self.ipm3TS_plot[self.ipm3TS_index:])
+            series = {}
+            for key, name in peaks.items():
+                series[key] = pd.Series(peakDict[name], index=peakTSDict[name + '_TS'])
+                if len(series[key].index):
+                    self.last_time = max(self.last_time or 0, series[key].index[-1])
 
-            ebeamData = pd.Series(
-                self.ebeam_plot[self.ebeam_index:], 
-                index=self.ebeamTS_plot[self.ebeamTS_index:])
-
-            zipped = basic_event_builder(ipm2=ipm2Data, ipm3=ipm3Data, ebeam=ebeamData)
+            zipped = basic_event_builder(**series)
             data = zipped[['ebeam', self.switch_key]]
             self.paused_list = zipped
             self.streamHex.event(df=data)
 
-        
-        # Because of how the ZMQ pipe works, if you pause it, then the graph is delayed by however
-        # long it's paused for (so instead of updating all the missed data at once, it'll try to read
-        # each pipe send)
-        
+
 
         def saveFile():
             """
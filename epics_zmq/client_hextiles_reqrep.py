@@ -1,5 +1,6 @@
 import sys
 import zmq
+import zmq.asyncio
 import tables
 import datetime
 
@@ -8,19 +9,25 @@ import holoviews as hv
 import pandas as pd
 
 from bokeh.layouts import layout, widgetbox, row, column
-from bokeh.models import Button, Slider, Select, HoverTool, DatetimeTickFormatter
-from bokeh.plotting import curdoc
+from bokeh.models import Button, Slider, Select, HoverTool, DatetimeTickFormatter, Div
+from bokeh.models import ColumnDataSource, LinearColorMapper, Range1d
+from bokeh.palettes import Viridis256
+from bokeh.plotting import curdoc, figure
 from bokeh.io import output_file, save
 from bokeh.server.server import Server
 from bokeh.application import Application
 from bokeh.application.handlers.function import FunctionHandler
+from tornado.ioloop import PeriodicCallback
 
 from holoviews.streams import Buffer
 from holoviews.core import util
 from holoviews.operation.datashader import datashade, dynspread
 from holoviews.operation import decimate
 
-from event_builder import basic_event_builder
+from data_hub import DataHub, request_data
+from lazy_pirate import LazyPirate
+from hexbin import HexBins
+from streaming_stats import QuantileRange
 from functools import partial
 from collections import deque
 
@@ -44,112 +51,139 @@ def apply_formatter(plot, element):
         months=['%D %H:%M:%S'], 
         years=['%D %H:%M:%S'])
 
-def gen_hex(df):
+def gen_hex(source, mapper):
     """
-    Return holoviews HexTiles plot
+    Return bokeh figure drawing hexagon counts with a hex_tile glyph, and
+    the glyph so its size can be set once the grid is known
     
     Parameters
     ----------
     
-    df: pandas.DataFrame
-        DataFrame containing data to be ploted on hextiles plot
+    source: ColumnDataSource
+        Hexagons to draw, with q, r and counts columns
+        
+    mapper: LinearColorMapper
+        Color mapper for the counts
     
     """
     
-    # Get bounds for graph
-    colNames = list(df)
-    lowX = df[colNames[0]].quantile(0.01)
-    highX = df[colNames[0]].quantile(0.99)
-    lowY = df[colNames[1]].quantile(0.01)
-    highY = df[colNames[1]].quantile(0.99)
+    plot = figure(
+        title="Number of events: 0", x_range=Range1d(0, 1), y_range=Range1d(0, 1),
+        x_axis_label='ebeam', y_axis_label='ipm2', tools="pan,wheel_zoom,box_zoom,reset,save")
+    tiles = plot.hex_tile(
+        q='q', r='r', size=1, source=source, line_color=None,
+        fill_color={'field': 'counts', 'transform': mapper})
+    plot.add_tools(HoverTool(tooltips=[('Events', '@counts')], renderers=[tiles]))
     
-    return hv.HexTiles(df, group="Number of events: " + str(len(df.index))).redim.range(
-        ebeam=(lowX, highX), 
-        ipm2 = (lowY, highY)).opts(
-        norm=dict(framewise=True))
+    return plot, tiles.glyph
     
 class BokehApp:
     
-    def __init__(self):
+    def __init__(self, hub):
         self.switch_key = 'ipm2'
+        
+        # Events built once for every session
+        self.hub = hub
+        self.events_seq = 0
+        self.clear_seq = 0
         self.maxlen = 1000000
         
-        # Initialize buffers
-        self.streamHex = hv.streams.Stream.define('df', df=pd.DataFrame({'ebeam':[], 'ipm2':[]}))()
+        # Hexagon counts of ebeam against each ipm, only changes go to the browser
+        self.hexbins = {'ipm2': HexBins(), 'ipm3': HexBins()}
+        self.source = ColumnDataSource(data={'q': [], 'r': [], 'counts': []})
+        self.mapper = LinearColorMapper(palette=Viridis256, low=0, high=1)
         
         # Initialize callbacks
         self.callback_id_hex = None
+        
+        # Events overwritten before this session read them
+        self.dropped = 0
                 
-        self.ipm2_index = 0
-        self.ipm3_index = 0
-        self.ebeam_index = 0
-        self.ipm2TS_index = 0
-        self.ipm3TS_index = 0
-        self.ebeamTS_index = 0
+        # 1% and 99% quantiles of each channel for the axis ranges, fed with new events only
+        self.ranges = QuantileRange(['ebeam', 'ipm2', 'ipm3'])
+    
+    def axis_ranges(self):
+        """
+        Return the since-clear axis range of each channel
         
-        self.paused_list = pd.DataFrame({'ebeam':[], 'ipm2':[], 'ipm3':[]})
+        """
         
-        self.ipm2_plot = []
-        self.ipm3_plot = []
-        self.ebeam_plot = []
-        self.ipm2TS_plot = []
-        self.ipm3TS_plot = []
-        self.ebeamTS_plot = []
+        return dict((name, self.ranges.range(name)) for name in self.ranges.names)
     
-    def produce_hex(self, context, doc): 
+    def update_hex(self, newEvents):
         """
-        Create hextiles plot
+        Bin new events and send the hexagons that changed to the browser
         
         Parameters
         ----------
         
-        context = zmq.Context()
-            Creates zmq socket to receive data
-            
-        doc: bokeh.document (I think)
-            Bokeh document to be displayed on webpage
+        newEvents: pandas.DataFrame
+            Events built since the last update
         
         """
         
-        # Port to connect to master
-        port = 5000
-        socket = context.socket(zmq.REQ)
+        self.ranges.add(newEvents)
+        for name, hexbins in self.hexbins.items():
+            new, patches = hexbins.add(newEvents['ebeam'].values, newEvents[name].values)
+            if name == self.switch_key:
+                # Patch first, the indices refer to rows already in the source
+                if patches:
+                    self.source.patch(patches)
+                if new['q']:
+                    self.source.stream(new)
+        self.draw_hex()
         
-        # MUST BE FROM SAME MACHINE, CHANGE IF NECESSARY!!!
-        socket.connect("tcp://localhost:%d" % port)        
-
-        # Generate dynamic map
-        plot = hv.DynamicMap(gen_hex, streams=[self.streamHex])
-
-        # Use bokeh to render plot
-        hvplot = renderer.get_plot(plot, doc)
+    def draw_hex(self):
+        """
+        Update hexagon size, colors, title and axis ranges of the plot
         
-        socket.send_string("First")
-        print("Woof")
-        data_dict = socket.recv_pyobj() 
+        """
+        
+        hexbins = self.hexbins[self.switch_key]
+        if hexbins.size is not None:
+            self.glyph.size = hexbins.size
+            self.glyph.aspect_scale = hexbins.aspect_scale
+        self.mapper.high = max(hexbins.counts.max() if len(hexbins.counts) else 0, 1)
+        self.hexPlot.title.text = "Number of events: " + str(hexbins.count)
+        self.hexPlot.yaxis.axis_label = self.switch_key
+        
+        ranges = self.axis_ranges()
+        for name, axis_range in (('ebeam', self.hexPlot.x_range), (self.switch_key, self.hexPlot.y_range)):
+            low, high = ranges[name]
+            if low < high:
+                axis_range.start, axis_range.end = low, high
+    
+    def produce_hex(self, doc): 
+        """
+        Create hextiles plot
+        
+        Parameters
+        ----------
+        
+        doc: bokeh.document (I think)
+            Bokeh document to be displayed on webpage
+        
+        """
         
-        peakDict = data_dict['peakDict']
-        peakTSDict = data_dict['peakTSDict']
+        # Generate hextiles plot
+        self.hexPlot, self.glyph = gen_hex(self.source, self.mapper)
         
-        self.ipm2_index = len(peakDict['peak_8'])
-        self.ipm3_index = len(peakDict['peak_9'])
-        self.ebeam_index = len(peakDict['peak_10'])
-        self.ipm2TS_index = len(peakTSDict['peak_8_TS'])
-        self.ipm3TS_index = len(peakTSDict['peak_9_TS'])
-        self.ebeamTS_index = len(peakTSDict['peak_10_TS'])
+        # Only plot events received after the server instance was opened
+        self.events_seq = self.clear_seq = self.hub.seq('events')
 
         def clear():
             """
-            "Clear" graphs and particular lists of server instance. Save current index
-            and only plot points after that index.
+            "Clear" graphs and particular lists of server instance. Skip everything received
+            so far and only plot events after that.
 
-            """           
-            self.ipm2_index = len(self.ipm2_plot)
-            self.ipm3_index = len(self.ipm3_plot)
-            self.ebeam_index = len(self.ebeam_plot)
-            self.ipm2TS_index = len(self.ipm2TS_plot)
-            self.ipm3TS_index = len(self.ipm3TS_plot)
-            self.ebeamTS_index = len(self.ebeamTS_plot)
+            """
+            
+            self.events_seq = self.clear_seq = self.hub.seq('events')
+            self.ranges.clear()
+            for hexbins in self.hexbins.values():
+                hexbins.clear()
+            self.source.data = {'q': [], 'r': [], 'counts': []}
+            self.draw_hex()
 
         def push_data():
             """
@@ -157,43 +191,15 @@ class BokehApp:
 
             """
             
-            socket.send_string("Hello")
-            print("Oof")
-
-            data_dict = socket.recv_pyobj()
-
-
-            peakDict = data_dict['peakDict']
-            peakTSDict = data_dict['peakTSDict']
-
-            self.ipm2_plot = list(peakDict['peak_8'])
-            self.ipm3_plot = list(peakDict['peak_9'])
-            self.ebeam_plot = list(peakDict['peak_10'])
-            self.ipm2TS_plot = list(peakTSDict['peak_8_TS'])
-            self.ipm3TS_plot = list(peakTSDict['peak_9_TS'])
-            self.ebeamTS_plot = list(peakTSDict['peak_10_TS'])
-
-            ipm2Data = pd.Series(
-                self.ipm2_plot[self.ipm2_index:], 
-                index=self.ipm2TS_plot[self.ipm2TS_index:])
-
-            ipm3Data = pd.Series(
-                self.ipm3_plot[self.ipm3_index:], 
-                index=self.ipm3TS_plot[self.ipm3TS_index:])
-
-            ebeamData = pd.Series(
-                self.ebeam_plot[self.ebeam_index:], 
-                index=self.ebeamTS_plot[self.ebeamTS_index:])
-
-            zipped = basic_event_builder(ipm2=ipm2Data, ipm3=ipm3Data, ebeam=ebeamData)
-            data = zipped[['ebeam', self.switch_key]]
-            self.paused_list = zipped
-            self.streamHex.event(df=data)
+            # After a pause everything missed comes in one update
+            lag, dropped = self.hub.behind('events', self.events_seq)
+            self.dropped += dropped
+            status.text = "Events dropped: %d, behind: %d" % (self.dropped, lag)
+            
+            # Only bin events built since the last tick
+            values, timestamps, self.events_seq = self.hub.since('events', self.events_seq)
+            self.update_hex(pd.DataFrame(values, index=timestamps, columns=self.hub.event_names))
 
-        
-        # Because of how the ZMQ pipe works, if you pause it, then the graph is delayed by however
-        # long it's paused for (so instead of updating all the missed data at once, it'll try to read
-        # each pipe send)
         def play_graph():
             """
             Provide play and pause functionality to the graph
@@ -202,10 +208,10 @@ class BokehApp:
 
             if startButton.label == '► Play':
                 startButton.label = '❚❚ Pause'
-                self.callback_id_hex = doc.add_periodic_callback(push_data, 1000)
+                self.callback_id_hex = self.hub.register(doc, push_data)
             else:
                 startButton.label = '► Play'
-                doc.remove_periodic_callback(self.callback_id_hex)
+                self.hub.unregister(self.callback_id_hex)
 
         def saveFile():
             """
@@ -213,22 +219,8 @@ class BokehApp:
 
             """
 
-            ipm2Data = pd.Series(
-                self.ipm2_plot[self.ipm2_index:], 
-                index=self.ipm2TS_plot[self.ipm2TS_index:])
-
-            ipm3Data = pd.Series(
-                self.ipm3_plot[self.ipm3_index:], 
-                index=self.ipm3TS_plot[self.ipm3TS_index:])
-
-            ebeamData = pd.Series(
-                self.ebeam_plot[self.ebeam_index:], 
-                index=self.ebeamTS_plot[self.ebeamTS_index:])
-            
-            zipped = basic_event_builder(ipm2=ipm2Data, ipm3=ipm3Data, ebeam=ebeamData)
-            zipped.to_csv('data_class.csv')
-
-        # Need to add function to switch while paused as well
+            values, timestamps, _ = self.hub.since('events', self.clear_seq)
+            pd.DataFrame(values, index=timestamps/1e9, columns=self.hub.event_names).to_csv('data_class.csv')
 
         def switch(attr, old, new):
             """
@@ -237,17 +229,10 @@ class BokehApp:
             """
 
             self.switch_key = select.value
+            self.source.data = self.hexbins[self.switch_key].data()
+            self.draw_hex()
 
-        def switch_on_pause(attr, old, new):
-            """
-            Switch hextiles plot even when live plotting is paused
-
-            """
-            
-            if startButton.label == '► Play':
-                self.streamHex.event(df=self.paused_list[['ebeam', self.switch_key]])
-
-        self.callback_id_hex = doc.add_periodic_callback(push_data, 1000)
+        self.callback_id_hex = self.hub.register(doc, push_data)
 
         # Create widgets
         clearButton = Button(label='Clear')
@@ -258,43 +243,58 @@ class BokehApp:
 
         select = Select(title="ipm value:", value="ipm2", options=["ipm2", "ipm3"])
         select.on_change('value', switch)
-        select.on_change('value', switch_on_pause)
 
         startButton = Button(label='❚❚ Pause')
         startButton.on_click(play_graph)
 
+        status = Div(text="Events dropped: 0, behind: 0")
+
         # Layout
         row_buttons = row([widgetbox([startButton, clearButton, saveButton], sizing_mode='stretch_both')])
 
-        plot = layout([[hvplot.state], 
+        plot = layout([[self.hexPlot], 
                        widgetbox([startButton, clearButton, saveButton], sizing_mode='stretch_both'), 
-                       widgetbox([select])])
+                       widgetbox([select, status])])
 
 
         doc.title = "Hextiles Graph"
         doc.add_root(plot)
+        
+        # Stop updating the graph once the page is closed
+        doc.on_session_destroyed(lambda session_context: self.hub.unregister(self.callback_id_hex))
     
     
-def make_document(context, doc):
+def make_document(hub, doc):
     """
     Create an instance of BokehApp() for each instance of the server
     
     """
     
-    bokehApp = BokehApp()
+    bokehApp = BokehApp(hub)
     
-    bokehApp.produce_hex(context, doc)
+    bokehApp.produce_hex(doc)
     
 def launch_server():
    
-    context = zmq.Context()
+    # Sockets are awaited on the IO loop instead of blocking it
+    context = zmq.asyncio.Context()
+    
+    # Data is received and events are built once for the whole process
+    hub = DataHub(['peak_8', 'peak_9', 'peak_10'], events={'ipm2': 'peak_8', 'ipm3': 'peak_9', 'ebeam': 'peak_10'})
+    
+    # Port to connect to master
+    port = 5000
+    
+    # MUST BE FROM SAME MACHINE, CHANGE IF NECESSARY!!!
+    requester = LazyPirate(context, "tcp://localhost:%d" % port)
 
     origins = ["localhost:{}".format(5007)]
     
-    apps = {'/': Application(FunctionHandler(partial(make_document, context)))}
+    apps = {'/': Application(FunctionHandler(partial(make_document, hub)))}
     server = Server(apps, port=5007)
     
     server.start()
+    PeriodicCallback(partial(server.io_loop.spawn_callback, request_data, requester, hub), 1000).start()
     
     print('Opening Bokeh application on:')
     for entry in origins:
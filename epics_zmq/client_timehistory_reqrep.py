@@ -1,5 +1,6 @@
 import sys
 import zmq
+import zmq.asyncio
 
 import numpy as np
 import holoviews as hv
@@ -12,15 +13,18 @@ from bokeh.io import output_file, save
 from bokeh.server.server import Server
 from bokeh.application import Application
 from bokeh.application.handlers.function import FunctionHandler
+from tornado.ioloop import PeriodicCallback
 from holoviews.streams import Buffer
 from holoviews.core import util
-from event_builder import basic_event_builder
+from data_hub import DataHub, request_data
+from lazy_pirate import LazyPirate
 import tables
 from functools import partial
 from collections import deque
 import datetime
 from holoviews.operation.datashader import datashade, dynspread
 from holoviews.operation import decimate
+from downsample import downsample
 
 renderer = hv.renderer('bokeh').instance(mode='server')
 
@@ -44,10 +48,17 @@ def apply_formatter(plot, element):
 
 class BokehApp:
     
-    def __init__(self):
+    def __init__(self, hub):
         self.switch_key = 'peak_8'
         self.maxlen = 1000000
         
+        # Data and rolling median/std per peak, shared with every other session
+        self.hub = hub
+        self.hub.watch(self.switch_key)
+        
+        # Sequence number of the first rolling result not yet sent to the graph
+        self.rolling_seq = 0
+        
         # Initialize buffers
         self.b_th_peak = Buffer(pd.DataFrame({'peak':[], 'lowerbound':[], 'higherbound':[]}), length=1000000)
         
@@ -68,28 +79,18 @@ class BokehApp:
 
         self.b_th_peak.send(pd.DataFrame({'peak':[], 'lowerbound':[], 'higherbound':[]}))
     
-    def produce_timehistory(self, context, doc):
+    def produce_timehistory(self, doc):
         """
         Create timetool data timehistory
         
         Parameters
         ----------
         
-        context = zmq.Context()
-            Creates zmq socket to receive data
-            
         doc: bokeh.document (I think)
             Bokeh document to be displayed on webpage
         
         """
 
-        # Port to connect to master
-        port = 5000
-        socket = context.socket(zmq.REQ)
-        
-        # MUST BE FROM SAME MACHINE, CHANGE IF NECESSARY!!!
-        socket.connect("tcp://localhost:%d" % port)
-        
         # Dynamic Maps
         plot_peak_b = hv.DynamicMap(partial(
             hv.Curve, kdims=['index', 'peak']), streams=[self.b_th_peak]).options(
@@ -106,8 +107,8 @@ class BokehApp:
             line_alpha=0.5, width=1000, line_color='gray').redim.label(
             index='Time in UTC')
         
-        # Decimate and datashade
-        pointTest = decimate(plot_peak_b, streams=[hv.streams.PlotSize])
+        # Downsample (M4 keeps the extremes) and datashade
+        pointTest = downsample(plot_peak_b, streams=[hv.streams.PlotSize, hv.streams.RangeX])
         
         test1 = datashade(plot_peak_std_low, streams=[hv.streams.PlotSize], normalization='linear').options(
             width=1000, finalize_hooks=[apply_formatter])
@@ -126,36 +127,20 @@ class BokehApp:
             
             """
             
-            median = pd.DataFrame({'peak':[]})
-            lowerbound = pd.DataFrame({'peak':[]})
-            higherbound = pd.DataFrame({'peak':[]})
+            # Only rolling results added since the last tick
+            median, timestamp, _ = self.hub.since(self.switch_key + '_median', self.rolling_seq)
+            std, _, self.rolling_seq = self.hub.since(self.switch_key + '_std', self.rolling_seq)
             
-            # Request
-            socket.send_string("Hello")
-            print("Oof")
-            
-            data_dict = socket.recv_pyobj()
-            peakDict = data_dict['peakDict']
-            peakTSDict = data_dict['peakTSDict']
-
-            TS_key = self.switch_key + '_TS'
-            data = list(peakDict[self.switch_key])
-            timestamp = list(peakTSDict[TS_key])
-
-            times = [1000*time for time in timestamp]
-            dataSeries = pd.Series(data, index=times)
-
-            zipped = basic_event_builder(peak=dataSeries)
-            median = zipped.rolling(120, min_periods=1).median()
-            std = zipped.rolling(120, min_periods=1).std()
+            # Convert ns timestamps to ms so bokeh formatter can get correct datetime
+            times = timestamp/1e6
             lowerbound = median - std
             higherbound = median + std
-                            
+            
             df = pd.DataFrame({
-                'peak':median['peak'], 
-                'lowerbound':lowerbound['peak'], 
-                'higherbound':higherbound['peak']
-            })
+                'peak':median, 
+                'lowerbound':lowerbound, 
+                'higherbound':higherbound
+            }, index=times)
 
             stream.send(df)
 
@@ -164,7 +149,10 @@ class BokehApp:
             Update drop down menu value
 
             """
+            self.hub.unwatch(self.switch_key)
             self.switch_key = select.value
+            self.hub.watch(self.switch_key)
+            self.rolling_seq = 0
             self.clear_buffer()
             print("Yes!")
 
@@ -177,13 +165,11 @@ class BokehApp:
             if startButton.label == '► Play':
                 startButton.label = '❚❚ Pause'
                 
-                self.callback_id_th_b = doc.add_periodic_callback(
-                    partial(push_data, stream=self.b_th_peak), 
-                    1000)
+                self.callback_id_th_b = self.hub.register(doc, partial(push_data, stream=self.b_th_peak))
 
             else:
                 startButton.label = '► Play'
-                doc.remove_periodic_callback(self.callback_id_th_b)
+                self.hub.unregister(self.callback_id_th_b)
 
         peak_list = ['peak_8', 'peak_9', 'peak_10', 'peak_11', 'peak_12', 'peak_13', 'peak_14', 'peak_15']
         select = Select(title='Peak:', value='peak_8', options=peak_list)
@@ -192,36 +178,56 @@ class BokehApp:
         startButton = Button(label='❚❚ Pause')
         startButton.on_click(play_graph)
 
-        self.callback_id_th_b = doc.add_periodic_callback(
-            partial(push_data, stream=self.b_th_peak), 
-            1000)
+        self.callback_id_th_b = self.hub.register(doc, partial(push_data, stream=self.b_th_peak))
 
         plot = column(select, startButton, hvplot.state)
 
         doc.title = "Time History Graphs"
         doc.add_root(plot)
+        
+        def session_destroyed(session_context):
+            """
+            Stop receiving the peak once nobody shows it, and updating the graph
+
+            """
+
+            self.hub.unwatch(self.switch_key)
+            self.hub.unregister(self.callback_id_th_b)
+
+        doc.on_session_destroyed(session_destroyed)
     
     
-def make_document(context, doc):
+def make_document(hub, doc):
     """
     Create an instance of BokehApp() for each instance of the server
     
     """
     
-    bokehApp = BokehApp()
+    bokehApp = BokehApp(hub)
     
-    bokehApp.produce_timehistory(context, doc)
+    bokehApp.produce_timehistory(doc)
     
 def launch_server():
    
-    context = zmq.Context()
+    # Sockets are awaited on the IO loop instead of blocking it
+    context = zmq.asyncio.Context()
+    
+    # Data is received and derived once for the whole process
+    hub = DataHub(['peak_8', 'peak_9', 'peak_10', 'peak_11', 'peak_12', 'peak_13', 'peak_14', 'peak_15'])
+    
+    # Port to connect to master
+    port = 5000
+    
+    # MUST BE FROM SAME MACHINE, CHANGE IF NECESSARY!!!
+    requester = LazyPirate(context, "tcp://localhost:%d" % port)
 
     origins = ["localhost:{}".format(5006)]
     
-    apps = {'/': Application(FunctionHandler(partial(make_document, context)))}
+    apps = {'/': Application(FunctionHandler(partial(make_document, hub)))}
     server = Server(apps, port=5006)
     
     server.start()
+    PeriodicCallback(partial(server.io_loop.spawn_callback, request_data, requester, hub), 1000).start()
     
     print('Opening Bokeh application on:')
     for entry in origins:
@@ -0,0 +1,309 @@
+import numpy as np
+
+from ring_buffer import RingBuffer
+from rolling import RollingWindow
+from event_builder import StreamingEventBuilder
+from delta import DeltaCursor
+from framing import unpack_message, subscribe, unsubscribe
+
+
+class DataHub:
+    """
+    Everything a Bokeh server process gets from the master, received and
+    derived once and shared by every session.
+
+    ingest() appends the samples of a message that are newer than the ones
+    already held to one RingBuffer per peak, builds events out of them and
+    brings the rolling median/std of every peak asked for up to date. Each
+    ingest bumps ``version``.
+
+    Sessions don't copy or recompute anything. They read views by name: a
+    peak ('peak_8'), the built events ('events', one column per name in
+    ``event_names``) or a rolling result ('peak_8_median', 'peak_8_std').
+    They keep a sequence number per view and call since() for what is new,
+    or take a snapshot(). Both hand out read-only numpy views, which stay
+    valid until the next ingest; sessions run on the same IO loop as the
+    hub, so nothing changes under them while a callback runs.
+
+    Only the peaks events are built from and the ones sessions watch() are
+    received, so a session switching peaks unwatch()es the old one.
+
+    The receiver of the process calls notify() once it has ingested what
+    arrived, which schedules the callback every session register()ed on
+    the next tick of its document. Sessions don't poll, and a new viewer
+    costs the master nothing.
+
+    Parameters
+    ----------
+
+    names: list
+        Peak names as sent by the master, e.g. 'peak_8'
+
+    events: dict
+        Column name of the built events to peak name, e.g. {'ipm2': 'peak_8'}
+
+    maxlen: int
+        Number of samples and events to keep
+
+    window: int
+        Number of samples in the rolling median/std window
+
+    """
+
+    def __init__(self, names, events=None, maxlen=1000000, window=120):
+        events = events or {}
+        self.version = 0
+        self.maxlen = maxlen
+        self.window = window
+        self.channels = dict((name, RingBuffer(maxlen)) for name in names)
+        self.event_names = list(events)
+        self.events = RingBuffer(maxlen, shape=(len(self.event_names),))
+        self.rolling = dict()
+        self._event_builder = StreamingEventBuilder(
+            **dict((column, self.channels[name]) for column, name in events.items()))
+        self._last_ts = dict((name, None) for name in names)
+
+        # Where the hub is in the master's stream of deltas, and which
+        # peaks it receives
+        self.cursor = DeltaCursor()
+        self.subscribed = set()
+        self._needed = set(events.values())
+        self._watchers = dict((name, 0) for name in names)
+
+        # Session callbacks to run when new data is ingested
+        self._listeners = dict()
+        self._next_key = 0
+        self._notified = 0
+
+    def register(self, doc, callback):
+        """
+        Run callback on the next tick of a document every time new data is
+        ingested, returning a key to unregister() it with
+
+        """
+
+        key = self._next_key
+        self._next_key += 1
+        self._listeners[key] = (doc, callback)
+        return key
+
+    def unregister(self, key):
+        """
+        Stop running a callback added with register()
+
+        """
+
+        self._listeners.pop(key, None)
+
+    def notify(self):
+        """
+        Schedule the callback of every registered session if anything was
+        ingested since the last call
+
+        """
+
+        if self.version == self._notified:
+            return
+        self._notified = self.version
+        for doc, callback in list(self._listeners.values()):
+            doc.add_next_tick_callback(callback)
+
+    def watch(self, name):
+        """
+        Start receiving a peak for a session showing it
+
+        """
+
+        self._watchers[name] += 1
+
+    def unwatch(self, name):
+        """
+        Stop receiving a peak for a session no longer showing it
+
+        """
+
+        self._watchers[name] -= 1
+
+    def watched(self):
+        """
+        Return the set of peaks that have to be received
+
+        """
+
+        return self._needed | set(name for name, count in self._watchers.items() if count > 0)
+
+    def receive(self, data_dict):
+        """
+        Ingest the peaks of a message from the master that carry on from
+        what the hub holds
+
+        """
+
+        names = self.cursor.accept(data_dict)
+        if names:
+            self.ingest(dict((name, data_dict['peakDict'][name]) for name in names),
+                        dict((name + '_TS', data_dict['peakTSDict'][name + '_TS']) for name in names))
+
+    def ingest(self, peakDict, peakTSDict):
+        """
+        Add a message from the master and update everything derived from it
+
+        Parameters
+        ----------
+
+        peakDict: dict
+            Peak values by peak name
+
+        peakTSDict: dict
+            Peak timestamps in seconds by peak name + '_TS'
+
+        """
+
+        for name, buf in self.channels.items():
+            if name not in peakDict:
+                continue
+            values = np.asarray(peakDict[name], dtype=np.float64)
+            timestamps = np.asarray(peakTSDict[name + '_TS'], dtype=np.float64)
+
+            # Masters may resend what was already received
+            last = self._last_ts[name]
+            if last is not None:
+                start = np.searchsorted(timestamps, last, side='right')
+                values = values[start:]
+                timestamps = timestamps[start:]
+            if len(timestamps):
+                buf.extend(values, timestamps)
+                self._last_ts[name] = timestamps[-1]
+
+        for rolling in self.rolling.values():
+            rolling.update()
+
+        if self.event_names:
+            newEvents = self._event_builder.build()
+            if len(newEvents.index):
+                self.events.extend(newEvents[self.event_names].values,
+                                   np.asarray(newEvents.index, dtype=np.float64)/1e9)
+
+        self.version += 1
+
+    def rolling_window(self, name):
+        """
+        Return the RollingWindow of a peak, starting it from the history
+        already held the first time it is asked for
+
+        """
+
+        if name not in self.rolling:
+            rolling = RollingWindow(self.window, source=self.channels[name])
+            rolling.update()
+            self.rolling[name] = rolling
+        return self.rolling[name]
+
+    def view(self, name):
+        """
+        Return the RingBuffer behind a view name
+
+        """
+
+        if name == 'events':
+            return self.events
+        if name in self.channels:
+            return self.channels[name]
+        peak, _, result = name.rpartition('_')
+        return getattr(self.rolling_window(peak), result)
+
+    def seq(self, name):
+        """
+        Return the sequence number the next sample of a view will get, e.g.
+        to only read what arrives after a clear
+
+        """
+
+        return self.view(name).seq
+
+    def since(self, name, seq):
+        """
+        Return read-only values and timestamps in ns of a view added since
+        sequence number seq, and the sequence number to pass next time
+
+        """
+
+        values, timestamps, seq = self.view(name).since(seq)
+        return _read_only(values), _read_only(timestamps), seq
+
+    def behind(self, name, seq):
+        """
+        Return how many entries of a view a session at sequence number seq
+        hasn't read yet, and how many of those were already overwritten, so
+        it will never get them
+
+        """
+
+        view = self.view(name)
+        lag = view.seq - seq
+        return lag, max(lag - view.maxlen, 0)
+
+    def snapshot(self, names, n=None):
+        """
+        Return the version and a dictionary of view name to read-only
+        (values, timestamps in ns) of the last n entries of each view
+
+        """
+
+        views = dict()
+        for name in names:
+            values, timestamps = self.view(name).last(n)
+            views[name] = (_read_only(values), _read_only(timestamps))
+        return self.version, views
+
+
+def _read_only(array):
+    array = array.view()
+    array.flags.writeable = False
+    return array
+
+
+async def receive_published(socket, hub, requester):
+    """
+    Ingest every delta waiting on a zmq.asyncio SUB socket, first following
+    the peaks the hub has to receive. Peaks the hub just started receiving
+    or missed a delta of are asked for through a LazyPirate, so a slow
+    master never blocks the IO loop.
+
+    """
+
+    watched = hub.watched()
+    subscribe(socket, watched - hub.subscribed)
+    unsubscribe(socket, hub.subscribed - watched)
+    hub.subscribed = watched
+
+    while await socket.poll(timeout=0):
+        hub.receive(unpack_message(await socket.recv_multipart(copy=False), channel=True))
+
+    missing = hub.cursor.missing(watched)
+    if missing and not requester.busy:
+        _receive_reply(hub, await requester.request(hub.cursor.request(missing)))
+    hub.notify()
+
+
+async def request_data(requester, hub):
+    """
+    Ask a REP master through a LazyPirate for what arrived since the last
+    reply of the peaks the hub has to receive, and ingest it
+
+    """
+
+    # Still waiting on the previous request
+    if requester.busy:
+        return
+    _receive_reply(hub, await requester.request(hub.cursor.request(hub.watched())))
+    hub.notify()
+
+
+def _receive_reply(hub, reply):
+    if reply is None:
+        return
+    if 'error' in reply:
+        print("Request refused: %s" % reply['error'])
+        return
+    hub.receive(reply)
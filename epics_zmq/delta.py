@@ -0,0 +1,183 @@
+import time
+
+import numpy as np
+
+from query import check_request, select, decimate
+
+
+class DeltaPublisher:
+    """
+    Master side of the delta protocol: instead of the whole history, each
+    message only holds the samples appended to the ring buffers since the
+    previous one.
+
+    Every message is a dictionary with the usual 'peakDict' and
+    'peakTSDict' (timestamps in seconds) plus:
+
+    - 'epoch': set when the master starts, a new one means a new history
+    - 'starts': ring buffer sequence number each channel is sent from
+    - 'cursors': ring buffer sequence number each channel is sent up to
+
+    A client carries on from a message when its start is no later than
+    where the client is. One that joins late or misses a delta asks for
+    what it is missing with a request to reply(), and carries on from
+    there.
+
+    Parameters
+    ----------
+
+    buffers: dict
+        RingBuffer of every channel, by peak name
+
+    """
+
+    def __init__(self, buffers):
+        self.buffers = buffers
+        self.epoch = int(time.time()*1e9)
+        self.cursors = dict((name, buf.seq) for name, buf in buffers.items())
+
+    def delta(self):
+        """
+        Return a dictionary of peak name to a message with every sample of
+        that channel appended since the last delta, to publish each under
+        its own topic
+
+        """
+
+        messages = {}
+        for name, buf in self.buffers.items():
+            message = self._message()
+            values, timestamps, end = buf.since_copy(self.cursors[name])
+            self._add(message, name, values, timestamps, self.cursors[name], end)
+            self.cursors[name] = end
+            messages[name] = message
+        return messages
+
+    def reply(self, request):
+        """
+        Answer a request from a client, which the master doesn't keep
+        track of. A request is a dictionary following the schema of
+        query.check_request(), e.g. {'channels': ['peak_8'], 'last': 1000}.
+        With the 'epoch' and 'cursors' of the messages the client got it
+        only gets what was added since, anything else (a string, another
+        epoch) starts from every retained sample. Raises ValueError for a
+        request that doesn't follow the schema.
+
+        Samples are copied out of the buffers, which CA callbacks keep
+        appending to while the reply is sent.
+
+        """
+
+        if not isinstance(request, dict):
+            request = {}
+        check_request(request, list(self.buffers))
+        cursors = {}
+        if request.get('epoch') == self.epoch:
+            cursors = request.get('cursors') or {}
+
+        message = self._message()
+        dtype = np.dtype(request.get('dtype', np.float64))
+        for name in request.get('channels') or self.buffers:
+            start = cursors.get(name, 0)
+            values, timestamps, end = self.buffers[name].since_copy(start)
+            values, timestamps = select(values, timestamps, request.get('start'),
+                                        request.get('end'), request.get('last'),
+                                        request.get('after'))
+            if request.get('max_points') is not None:
+                values, timestamps = decimate(values, timestamps, int(request['max_points']),
+                                              request.get('aggregate', 'm4'))
+            self._add(message, name, values.astype(dtype, copy=False), timestamps, start, end)
+        return message
+
+    def snapshot(self):
+        """
+        Return a publisher with the same epoch over read-only copies of the
+        buffers, to answer requests from other threads while the buffers
+        keep being appended to
+
+        """
+
+        snapshot = DeltaPublisher(dict((name, buf.copy()) for name, buf in self.buffers.items()))
+        snapshot.epoch = self.epoch
+        return snapshot
+
+    def codecs(self, request):
+        """
+        Return the send_message() codec arguments for the reply to a
+        request, which can ask for a 'codec' for values and another
+        'timestamps_codec' for timestamps, none by default
+
+        """
+
+        if not isinstance(request, dict):
+            request = {}
+        return {'codec': request.get('codec', 'none'),
+                'codecs': {'peakTSDict': request.get('timestamps_codec', 'none')}}
+
+    def _message(self):
+        return {'epoch': self.epoch, 'starts': {}, 'cursors': {},
+                'peakDict': {}, 'peakTSDict': {}}
+
+    def _add(self, message, name, values, timestamps, start, end):
+        message['peakDict'][name] = values
+        message['peakTSDict'][name + '_TS'] = timestamps/1e9
+        message['starts'][name] = start
+        message['cursors'][name] = end
+
+
+class DeltaCursor:
+    """
+    Client side of the delta protocol: where a client is in every channel
+    of a DeltaPublisher, and which channels it has to ask for because it
+    just started following them, missed a delta or the master restarted.
+
+    """
+
+    def __init__(self):
+        self.epoch = None
+        self.cursors = {}
+        self.behind = set()
+
+    def accept(self, message):
+        """
+        Return the names of the channels in a message that carry on from
+        where the client is, and should be ingested
+
+        """
+
+        # A restarted master numbers samples from scratch
+        if message['epoch'] != self.epoch:
+            self.epoch = message['epoch']
+            self.cursors = {}
+            self.behind = set()
+
+        accepted = []
+        for name, end in message['cursors'].items():
+            start = message['starts'][name]
+            if start > self.cursors.get(name, 0):
+                self.behind.add(name)
+                continue
+            self.cursors[name] = max(end, self.cursors.get(name, 0))
+            self.behind.discard(name)
+            accepted.append(name)
+        return accepted
+
+    def missing(self, names):
+        """
+        Return the channels out of names the client has to ask for
+
+        """
+
+        return [name for name in names if name not in self.cursors or name in self.behind]
+
+    def request(self, names=None):
+        """
+        Return the request asking a master for what is missing of some
+        channels, every channel followed so far by default
+
+        """
+
+        request = {'epoch': self.epoch, 'cursors': dict(self.cursors)}
+        if names is not None:
+            request['channels'] = sorted(names)
+        return request
@@ -0,0 +1,176 @@
+import numpy as np
+
+
+def axial_coordinates(x, y, size, aspect_scale=1, orientation='pointytop'):
+    """
+    Return the axial (q, r) coordinates of the hexagon each point falls in,
+    with the same conventions as bokeh.util.hex.cartesian_to_axial so the
+    result can be drawn with a hex_tile glyph
+
+    Parameters
+    ----------
+
+    x, y: numpy.array
+        Point coordinates
+
+    size: float
+        Hexagon size (centre to corner), in y units for pointytop and in x
+        units for flattop
+
+    aspect_scale: float
+        Factor x is multiplied by (pointytop) or y is divided by (flattop)
+        before binning
+
+    orientation: str
+        'pointytop' or 'flattop'
+
+    """
+
+    if orientation == 'pointytop':
+        coords = (np.sqrt(3.0)/3.0, -1.0/3.0, 0.0, 2.0/3.0)
+        x = np.asarray(x, dtype=np.float64) / size * aspect_scale
+        y = -np.asarray(y, dtype=np.float64) / size
+    else:
+        coords = (2.0/3.0, 0.0, -1.0/3.0, np.sqrt(3.0)/3.0)
+        x = np.asarray(x, dtype=np.float64) / size
+        y = -np.asarray(y, dtype=np.float64) / size / aspect_scale
+    q = coords[0]*x + coords[1]*y
+    r = coords[2]*x + coords[3]*y
+
+    # Round in cube coordinates, fixing whichever one rounded the most
+    cube_y = -q - r
+    rq, ry, rr = np.round(q), np.round(cube_y), np.round(r)
+    dq, dy, dr = np.abs(rq - q), np.abs(ry - cube_y), np.abs(rr - r)
+    fix_q = (dq > dy) & (dq > dr)
+    fix_r = ~fix_q & ~(dy > dr)
+    q = np.where(fix_q, -(ry + rr), rq)
+    r = np.where(fix_r, -(rq + ry), rr)
+    return q.astype(np.int64), r.astype(np.int64)
+
+
+class HexBins:
+    """
+    Per-hexagon event counts on a fixed hexagonal grid, updated with only
+    the new events.
+
+    The grid is fixed by the first ``warmup`` events: hexagons are sized so
+    about ``gridsize`` of them span the 1st to 99th percentile of x, and are
+    stretched to the same number along y. After that every event lands in
+    the same grid, so counts only ever go up and add() costs O(new events)
+    however long it runs.
+
+    Hexagons are numbered in the order they first get an event, which is
+    the row they take in a bokeh ColumnDataSource. add() returns the new
+    rows to stream() into the source and the changed counts to patch() into
+    it, so only what changed is sent to the browser.
+
+    Parameters
+    ----------
+
+    gridsize: int
+        Number of hexagons across the x range of the warmup events
+
+    warmup: int
+        Number of events used to pick the grid
+
+    orientation: str
+        'pointytop' or 'flattop', as for the hex_tile glyph
+
+    """
+
+    def __init__(self, gridsize=50, warmup=200, orientation='pointytop'):
+        self.gridsize = gridsize
+        self.warmup = warmup
+        self.orientation = orientation
+        self.clear()
+
+    def clear(self):
+        """
+        Forget every event, the next ones pick a new grid
+
+        """
+
+        self.size = None
+        self.aspect_scale = None
+        self.count = 0
+        self._pending = np.empty((0, 2))
+
+        # Hexagon keys sorted, with the row of each, and the columns by row
+        self._keys = np.empty(0, dtype=np.int64)
+        self._rows = np.empty(0, dtype=np.int64)
+        self.q = np.empty(0, dtype=np.int64)
+        self.r = np.empty(0, dtype=np.int64)
+        self.counts = np.empty(0, dtype=np.int64)
+
+    def data(self):
+        """
+        Return every hexagon as ColumnDataSource data: q, r and counts
+
+        """
+
+        return {'q': self.q.tolist(), 'r': self.r.tolist(), 'counts': self.counts.tolist()}
+
+    def add(self, x, y):
+        """
+        Bin new events, returning the rows of hexagons seen for the first
+        time (ColumnDataSource data to stream) and the new counts of the
+        others (a ColumnDataSource patch)
+
+        """
+
+        events = np.column_stack([np.asarray(x, dtype=np.float64),
+                                  np.asarray(y, dtype=np.float64)])
+        events = events[np.isfinite(events).all(axis=1)]
+        if self.size is None:
+            self._pending = np.concatenate([self._pending, events])
+            if len(self._pending) < self.warmup:
+                return {'q': [], 'r': [], 'counts': []}, {}
+            self._pick_grid(self._pending)
+            events = self._pending
+            self._pending = np.empty((0, 2))
+        if len(events) == 0:
+            return {'q': [], 'r': [], 'counts': []}, {}
+        self.count += len(events)
+
+        q, r = axial_coordinates(events[:, 0], events[:, 1], self.size,
+                                 self.aspect_scale, self.orientation)
+        keys, counts = np.unique(self._key(q, r), return_counts=True)
+
+        # Hexagons already in the source
+        pos = np.searchsorted(self._keys, keys)
+        found = pos < len(self._keys)
+        found[found] = self._keys[pos[found]] == keys[found]
+        rows = self._rows[pos[found]]
+        self.counts[rows] += counts[found]
+        patches = {}
+        if len(rows):
+            patches['counts'] = list(zip(rows.tolist(), self.counts[rows].tolist()))
+
+        # Hexagons seen for the first time go at the end
+        keys, counts = keys[~found], counts[~found]
+        new_rows = np.arange(len(self.counts), len(self.counts) + len(keys))
+        q, r = self._unkey(keys)
+        self.q = np.concatenate([self.q, q])
+        self.r = np.concatenate([self.r, r])
+        self.counts = np.concatenate([self.counts, counts])
+        pos = np.searchsorted(self._keys, keys)
+        self._keys = np.insert(self._keys, pos, keys)
+        self._rows = np.insert(self._rows, pos, new_rows)
+
+        return {'q': q.tolist(), 'r': r.tolist(), 'counts': counts.tolist()}, patches
+
+    def _pick_grid(self, events):
+        low, high = np.percentile(events, [1, 99], axis=0)
+        span = np.where(high > low, high - low, 1.0)
+        self.aspect_scale = span[1] / span[0]
+        if self.orientation == 'pointytop':
+            self.size = span[1] / (np.sqrt(3.0) * self.gridsize)
+        else:
+            self.size = span[0] / (1.5 * self.gridsize)
+
+    # Axial coordinates packed into one int64, 32 bits each
+    def _key(self, q, r):
+        return (q << 32) + (r + (1 << 31))
+
+    def _unkey(self, keys):
+        return keys >> 32, (keys & 0xFFFFFFFF) - (1 << 31)
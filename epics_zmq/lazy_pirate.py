@@ -0,0 +1,70 @@
+import zmq
+
+from framing import send_message, unpack_message
+
+
+class LazyPirate:
+    """
+    REQ client for a REP master that never blocks the IO loop it runs on.
+
+    request() is a coroutine: it sends a message and waits for the reply
+    without blocking, for at most ``timeout`` ms. A REQ socket that never
+    got its reply can't send again, so on a timeout the socket is closed
+    and a fresh one connected before the request is sent again (the "Lazy
+    Pirate" pattern), up to ``retries`` times. A slow or dead master then
+    only delays the data, every session stays responsive.
+
+    Parameters
+    ----------
+
+    context: zmq.asyncio.Context
+        Context to create sockets with, so they can be awaited
+
+    address: str
+        Address of the master, e.g. "tcp://localhost:5000"
+
+    timeout: int
+        Milliseconds to wait for each reply
+
+    retries: int
+        Number of times to send a request before giving up
+
+    """
+
+    def __init__(self, context, address, timeout=2500, retries=3):
+        self.context = context
+        self.address = address
+        self.timeout = timeout
+        self.retries = retries
+        self.busy = False
+        self.timeouts = 0
+        self.socket = None
+        self._connect()
+
+    def _connect(self):
+        if self.socket is not None:
+            self.socket.close(linger=0)
+        self.socket = self.context.socket(zmq.REQ)
+        self.socket.connect(self.address)
+
+    async def request(self, message, **kwargs):
+        """
+        Send a message and return the reply, or None if the master didn't
+        answer any of the retries. Keyword arguments go to send_message().
+
+        """
+
+        self.busy = True
+        try:
+            for _ in range(self.retries):
+                await send_message(self.socket, message, **kwargs)
+                if await self.socket.poll(self.timeout, zmq.POLLIN):
+                    frames = await self.socket.recv_multipart(copy=False)
+                    return unpack_message(frames)
+
+                self.timeouts += 1
+                print("No reply from %s, reconnecting" % self.address)
+                self._connect()
+            return None
+        finally:
+            self.busy = False
@@ -1,16 +1,18 @@
 import time
 
-import numpy as np
 from ophyd.signal import EpicsSignal
 
+from streaming_stats import StreamingStats
+
 
 class StatsEpicsSignal(EpicsSignal):
     SUB_STATS = 'stats'
     _default_sub = SUB_STATS
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, stats_class=StreamingStats, **kwargs):
         super().__init__(*args, **kwargs)
-        self._values_acc = []
+        # Streaming estimators keep memory and per-sample cost constant
+        self._stats = stats_class()
         self._ts_start = None
 
     def subscribe(self, callback, event_type=None, run=True):
@@ -22,11 +24,11 @@ class StatsEpicsSignal(EpicsSignal):
 
     def _read_changed(self, value=None, timestamp=None, **kwargs):
         super()._read_changed(value=value, timestamp=timestamp, **kwargs)
-        self._values_acc.append(value)
+        self._stats.update(value)
         if timestamp - self._ts_start > 1:
             self._run_subs(sub_type=self.SUB_STATS,
-                           median_value=np.median(self._values_acc),
-                           std_value = np.std(self._values_acc),
+                           median_value=self._stats.median(),
+                           std_value = self._stats.std(),
                            timestamp=(timestamp + self._ts_start) / 2)
-            self._values_acc.clear()
-            self._ts_start = time.time()
\ No newline at end of file
+            self._stats.reset()
+            self._ts_start = time.time()
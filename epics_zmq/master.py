@@ -8,79 +8,89 @@ import pandas as pd
 
 from fake_peaks import FakeBeam
 from functools import partial
-from collections import deque
+from ring_buffer import RingBuffer
+from delta import DeltaPublisher
+from framing import send_message, recv_message
 import zmq
 
 
 def new_data(*args, **kwargs):
     """
-    Append data from subscribe into data containers
+    Append data from subscribe into ring buffer
     
     """
     
-    kwargs['in_value'].append(kwargs['value'])
-    kwargs['in_time'].append(kwargs['timestamp'])
+    kwargs['in_buffer'].append(kwargs['value'], kwargs['timestamp'])
     
+
+def launch_server(values_codec='none', timestamps_codec='none'):
+    """
+    Publish new peak data every second
+    
+    Parameters
+    ----------
     
-def launch_server():
+    values_codec: str
+        Codec to compress peak values with, see framing.encode()
+        
+    timestamps_codec: str
+        Codec to compress timestamps with, e.g. 'delta-zstd'
+    
+    """
 
     port = "5000"
     context = zmq.Context()
     socket = context.socket(zmq.PUB)
     socket.bind("tcp://*:%s" % port)
     
+    # Clients ask for what they are missing on the next port
+    snapshot_socket = context.socket(zmq.REP)
+    snapshot_socket.bind("tcp://*:%d" % (int(port) + 1))
+    
     maxlen = 1000000
     
     # Get data
     beam = FakeBeam()
-    peak_8 = deque(maxlen=maxlen)
-    peak_8_TS = deque(maxlen=maxlen)
-    peak_9 = deque(maxlen=maxlen)
-    peak_9_TS = deque(maxlen=maxlen)
-    peak_10 = deque(maxlen=maxlen)
-    peak_10_TS = deque(maxlen=maxlen)
-    peak_11 = deque(maxlen=maxlen)
-    peak_11_TS = deque(maxlen=maxlen)
-    peak_12 = deque(maxlen=maxlen)
-    peak_12_TS = deque(maxlen=maxlen)
-    peak_13 = deque(maxlen=maxlen)
-    peak_13_TS = deque(maxlen=maxlen)
-    peak_14 = deque(maxlen=maxlen)
-    peak_14_TS = deque(maxlen=maxlen)
-    peak_15 = deque(maxlen=maxlen)
-    peak_15_TS = deque(maxlen=maxlen)
+    peak_8 = RingBuffer(maxlen)
+    peak_9 = RingBuffer(maxlen)
+    peak_10 = RingBuffer(maxlen)
+    peak_11 = RingBuffer(maxlen)
+    peak_12 = RingBuffer(maxlen)
+    peak_13 = RingBuffer(maxlen)
+    peak_14 = RingBuffer(maxlen)
+    peak_15 = RingBuffer(maxlen)
     
     # Subscribe to devices
     beam.peak_8.subscribe(
-        partial(new_data, in_value=peak_8, in_time=peak_8_TS)
+        partial(new_data, in_buffer=peak_8)
     )
     
     beam.peak_9.subscribe(
-        partial(new_data, in_value=peak_9, in_time=peak_9_TS)
+        partial(new_data, in_buffer=peak_9)
     )
     
     beam.peak_10.subscribe(
-        partial(new_data, in_value=peak_10, in_time=peak_10_TS)
+        partial(new_data, in_buffer=peak_10)
     )
     
     beam.peak_11.subscribe(
-        partial(new_data, in_value=peak_11, in_time=peak_11_TS)
+        partial(new_data, in_buffer=peak_11)
     )
     
     beam.peak_12.subscribe(
-        partial(new_data, in_value=peak_12, in_time=peak_12_TS)
+        partial(new_data, in_buffer=peak_12)
     )
     
     beam.peak_13.subscribe(
-        partial(new_data, in_value=peak_13, in_time=peak_13_TS)
+        partial(new_data, in_buffer=peak_13)
     )
     
     beam.peak_14.subscribe(
-        partial(new_data, in_value=peak_14, in_time=peak_14_TS)
+        partial(new_data, in_buffer=peak_14)
     )
     
     beam.peak_15.subscribe(
-        partial(new_data, in_value=peak_15, in_time=peak_15_TS)
+        partial(new_data, in_buffer=peak_15)
     )
     
    
@@ -94,27 +104,23 @@ def launch_server():
         'peak_14':peak_14,
         'peak_15':peak_15
     }
-    peakTSDict = {
-        'peak_8_TS':peak_8_TS, 
-        'peak_9_TS':peak_9_TS, 
-        'peak_10_TS':peak_10_TS, 
-        'peak_11_TS':peak_11_TS, 
-        'peak_12_TS':peak_12_TS, 
-        'peak_13_TS':peak_13_TS,
-        'peak_14_TS':peak_14_TS,
-        'peak_15_TS':peak_15_TS
-    }
+    publisher = DeltaPublisher(peakDict)
     
-    data = {
-        'peakDict':peakDict,
-        'peakTSDict':peakTSDict
-    }
-    
-    # Send data a half second intervals
+    # Send new data every second, one topic per peak, answering requests in between
     while True:
-        socket.send_pyobj(data)
-        print(len(data['peakDict']['peak_8']))
-        time.sleep(1)
+        for name, message in publisher.delta().items():
+            send_message(socket, message, channel=name, codec=values_codec,
+                         codecs={'peakTSDict': timestamps_codec})
+        print(len(peakDict['peak_8']))
+        
+        deadline = time.time() + 1
+        while snapshot_socket.poll(timeout=max(int((deadline - time.time())*1000), 0)):
+            try:
+                request = recv_message(snapshot_socket)
+                send_message(snapshot_socket, publisher.reply(request), **publisher.codecs(request))
+            except Exception as error:
+                print("Request failed: %r" % error)
+                send_message(snapshot_socket, {'error': str(error)})
         
 if __name__ == '__main__':
-    launch_server()
+    launch_server(*sys.argv[1:3])
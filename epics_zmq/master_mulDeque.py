@@ -9,7 +9,9 @@ import pandas as pd
 from fake_peaks import FakeBeam
 from functools import partial
 from collections import deque
-import statistics
+from ring_buffer import RingBuffer
+from streaming_stats import StreamingStats
+from request_server import RequestServer
 import zmq
 
 
@@ -20,40 +22,44 @@ def new_data(*args, **kwargs):
     """
     global oldTime
     
-    kwargs['in_value'].append(kwargs['value'])
-    kwargs['in_time'].append(kwargs['timestamp'])
-    kwargs['temp'].append(kwargs['value'])
+    kwargs['in_buffer'].append(kwargs['value'], kwargs['timestamp'])
+    kwargs['stats'].update(kwargs['value'])
     
     if time.time() - oldTime > 1:
-        kwargs['median'].append(statistics.median(kwargs['temp']))
-        kwargs['stdev'].append(statistics.stdev(kwargs['temp']))
+        kwargs['median'].append(kwargs['stats'].median())
+        kwargs['stdev'].append(kwargs['stats'].std(ddof=1))
         kwargs['medianTS'].append(kwargs['timestamp'])
-        kwargs['temp'].clear()
+        kwargs['stats'].reset()
         oldTime = time.time()
         print(kwargs['median'])
         print(kwargs['stdev'])
     
+
+def answer(snapshot, request):
+    """
+    Every request gets the whole snapshot
+    
+    """
+    
+    print("Received request: ", request)
+    return snapshot, {}
     
-def launch_server():
+    
+def launch_server(workers=4):
 
     global oldTime
     oldTime = time.time()
-    port = "5000"
+    port = 5000
     context = zmq.Context()
-    socket = context.socket(zmq.REP)
-    socket.bind("tcp://*:%s" % port)
     
     maxlen = 500000
     full_maxlen = 2000000
     
     # Get data
     beam = FakeBeam()
-    peak_8 = deque(maxlen=maxlen)
-    peak_8_TS = deque(maxlen=maxlen)
-    peak_9 = deque(maxlen=maxlen)
-    peak_9_TS = deque(maxlen=maxlen)
-    peak_10 = deque(maxlen=maxlen)
-    peak_10_TS = deque(maxlen=maxlen)
+    peak_8 = RingBuffer(maxlen)
+    peak_9 = RingBuffer(maxlen)
+    peak_10 = RingBuffer(maxlen)
     
     peak_8_median = deque(maxlen=full_maxlen)
     peak_9_median = deque(maxlen=full_maxlen)
@@ -63,28 +69,28 @@ def launch_server():
     
     peak_8_median_TS = deque(maxlen=full_maxlen) # Maybe use this for stdev too?
     
-    peak_8_temp = []
-    peak_9_temp = []
-    peak_10_temp = []
+    # Running estimators for the current 1 second window
+    peak_8_stats = StreamingStats()
+    peak_9_stats = StreamingStats()
+    peak_10_stats = StreamingStats()
 
     
     # Subscribe to devices
     beam.peak_8.subscribe(
         partial(new_data, 
-                in_value=peak_8, 
-                in_time=peak_8_TS, 
-                temp=peak_8_temp, 
+                in_buffer=peak_8, 
+                stats=peak_8_stats, 
                 median=peak_8_median,
                 stdev=peak_8_std,
                 medianTS=peak_8_median_TS)
     )
     
 #     beam.peak_9.subscribe(
-#         partial(new_data, in_value=peak_9, in_time=peak_9_TS, temp=peak_9_temp)
+#         partial(new_data, in_buffer=peak_9, stats=peak_9_stats)
 #     )
     
 #     beam.peak_10.subscribe(
-#         partial(new_data, in_value=peak_10, in_time=peak_10_TS, temp=peak_10_temp)
+#         partial(new_data, in_buffer=peak_10, stats=peak_10_stats)
 #     )
     
     peakDict = {
@@ -92,12 +98,6 @@ def launch_server():
         #'peak_9':peak_9, 
         #'peak_10':peak_10, 
         
-    }
-    peakTSDict = {
-        'peak_8_TS':peak_8_TS, 
-        #'peak_9_TS':peak_9_TS, 
-        #'peak_10_TS':peak_10_TS, 
-        
     }
     medianDict = {
         'peak_8_median':peak_8_median,
@@ -110,22 +110,35 @@ def launch_server():
     }
     
     data = {
-        'peakDict':peakDict,
-        'peakTSDict':peakTSDict,
         'medianDict':medianDict,
         'stdevDict':stdevDict,
         'median_stdevDict':median_stdevDict
     }
     
-    # Send data a half second intervals
-    while True:
-#         socket.send_pyobj(data)
-#         print(len(data['peakTSDict']['peak_8_TS']))
-#         time.sleep(1)
+    def snapshot():
+        """
+        Return the reply to every request until the next snapshot, built
+        from copies so the CA callbacks can keep appending
+        
+        """
         
-        message = socket.recv()
-        print("Received request: ", message)
-        socket.send_pyobj(data)
+        # Raw peaks come out of the ring buffers, timestamps back in seconds
+        reply = {'peakDict': {}, 'peakTSDict': {}}
+        for name, buf in peakDict.items():
+            values, timestamps = buf.copy().last()
+            reply['peakDict'][name] = values
+            reply['peakTSDict'][name + '_TS'] = timestamps/1e9
+            
+        # Deques go out as arrays, one frame each. deque.copy() holds the
+        # GIL, so appends can't change a deque while it is being read
+        for key, deques in data.items():
+            reply[key] = dict((name, np.array(values.copy())) for name, values in deques.items())
+        return reply
+    
+    # Reply with the latest snapshot from a pool of workers
+    server = RequestServer(context, port, snapshot, answer,
+                           version=lambda: [buf.seq for buf in peakDict.values()], workers=workers)
+    server.run()
         
 if __name__ == '__main__':
-    launch_server()
\ No newline at end of file
+    launch_server(*[int(arg) for arg in sys.argv[1:2]])
\ No newline at end of file
@@ -8,79 +8,83 @@ import pandas as pd
 
 from fake_peaks import FakeBeam
 from functools import partial
-from collections import deque
+from ring_buffer import RingBuffer
+from delta import DeltaPublisher
+from request_server import RequestServer
 import zmq
 
 
 def new_data(*args, **kwargs):
     """
-    Append data from subscribe into data containers
+    Append data from subscribe into ring buffer
     
     """
     
-    kwargs['in_value'].append(kwargs['value'])
-    kwargs['in_time'].append(kwargs['timestamp'])
+    kwargs['in_buffer'].append(kwargs['value'], kwargs['timestamp'])
     
+
+def answer(publisher, request):
+    """
+    Reply to a request from a snapshot of the publisher
+    
+    """
+    
+    print("Received request: ", request)
+    try:
+        return publisher.reply(request), publisher.codecs(request)
+    except ValueError as error:
+        return {'error': str(error)}, {}
     
-def launch_server():
 
-    port = "5000"
+def launch_server(workers=4):
+
+    port = 5000
     context = zmq.Context()
-    socket = context.socket(zmq.REP)
-    socket.bind("tcp://*:%s" % port)
     
     maxlen = 1000000
     
     # Get data
     beam = FakeBeam()
-    peak_8 = deque(maxlen=maxlen)
-    peak_8_TS = deque(maxlen=maxlen)
-    peak_9 = deque(maxlen=maxlen)
-    peak_9_TS = deque(maxlen=maxlen)
-    peak_10 = deque(maxlen=maxlen)
-    peak_10_TS = deque(maxlen=maxlen)
-    peak_11 = deque(maxlen=maxlen)
-    peak_11_TS = deque(maxlen=maxlen)
-    peak_12 = deque(maxlen=maxlen)
-    peak_12_TS = deque(maxlen=maxlen)
-    peak_13 = deque(maxlen=maxlen)
-    peak_13_TS = deque(maxlen=maxlen)
-    peak_14 = deque(maxlen=maxlen)
-    peak_14_TS = deque(maxlen=maxlen)
-    peak_15 = deque(maxlen=maxlen)
-    peak_15_TS = deque(maxlen=maxlen)
+    peak_8 = RingBuffer(maxlen)
+    peak_9 = RingBuffer(maxlen)
+    peak_10 = RingBuffer(maxlen)
+    peak_11 = RingBuffer(maxlen)
+    peak_12 = RingBuffer(maxlen)
+    peak_13 = RingBuffer(maxlen)
+    peak_14 = RingBuffer(maxlen)
+    peak_15 = RingBuffer(maxlen)
     
     # Subscribe to devices
     beam.peak_8.subscribe(
-        partial(new_data, in_value=peak_8, in_time=peak_8_TS)
+        partial(new_data, in_buffer=peak_8)
     )
     
     beam.peak_9.subscribe(
-        partial(new_data, in_value=peak_9, in_time=peak_9_TS)
+        partial(new_data, in_buffer=peak_9)
     )
     
     beam.peak_10.subscribe(
-        partial(new_data, in_value=peak_10, in_time=peak_10_TS)
+        partial(new_data, in_buffer=peak_10)
     )
     
     beam.peak_11.subscribe(
-        partial(new_data, in_value=peak_11, in_time=peak_11_TS)
+        partial(new_data, in_buffer=peak_11)
     )
     
     beam.peak_12.subscribe(
-        partial(new_data, in_value=peak_12, in_time=peak_12_TS)
+        partial(new_data, in_buffer=peak_12)
     )
     
     beam.peak_13.subscribe(
-        partial(new_data, in_value=peak_13, in_time=peak_13_TS)
+        partial(new_data, in_buffer=peak_13)
     )
     
     beam.peak_14.subscribe(
-        partial(new_data, in_value=peak_14, in_time=peak_14_TS)
+        partial(new_data, in_buffer=peak_14)
     )
     
     beam.peak_15.subscribe(
-        partial(new_data, in_value=peak_15, in_time=peak_15_TS)
+        partial(new_data, in_buffer=peak_15)
     )
     
    
@@ -94,28 +98,12 @@ def launch_server():
         'peak_14':peak_14,
         'peak_15':peak_15
     }
-    peakTSDict = {
-        'peak_8_TS':peak_8_TS, 
-        'peak_9_TS':peak_9_TS, 
-        'peak_10_TS':peak_10_TS, 
-        'peak_11_TS':peak_11_TS, 
-        'peak_12_TS':peak_12_TS, 
-        'peak_13_TS':peak_13_TS,
-        'peak_14_TS':peak_14_TS,
-        'peak_15_TS':peak_15_TS
-    }
+    publisher = DeltaPublisher(peakDict)
     
-    data = {
-        'peakDict':peakDict,
-        'peakTSDict':peakTSDict
-    }
-    
-    # Send data a half second intervals
-    while True:
-        
-        message = socket.recv()
-        print("Received request: ", message)
-        socket.send_pyobj(data)
+    # Reply with what each client asks for from a pool of workers
+    server = RequestServer(context, port, publisher.snapshot, answer,
+                           version=lambda: [buf.seq for buf in peakDict.values()], workers=workers)
+    server.run()
         
 if __name__ == '__main__':
-    launch_server()
+    launch_server(*[int(arg) for arg in sys.argv[1:2]])
@@ -8,23 +8,17 @@ import pandas as pd
 
 from fake_peaks_stats import FakeBeam
 from functools import partial
-from collections import deque
-import statistics
+from stats_pyramid import StatsPyramid
+from framing import send_message, recv_message
 import zmq
 
 
-# Move everything into a class
-# Or use a list/dictionary instead of multiple timers
 def new_data(*args, **kwargs):
     """
-    Append data from subscribe into data containers
+    Add data from subscribe into the statistics pyramid
     
-    """    
-    print('hmmm')
-    kwargs['median'].append(kwargs['median_value'])
-    kwargs['stdev'].append(kwargs['std_value'])
-    kwargs['medianTS'].append(kwargs['timestamp'])
-    print(kwargs['stdev'])
+    """
+    kwargs['pyramid'].update(kwargs['value'], kwargs['timestamp'])
     
     
 def launch_server():
@@ -35,72 +29,71 @@ def launch_server():
     socket = context.socket(zmq.REP)
     socket.bind("tcp://*:%s" % port)
     
-    full_maxlen = 2000000
+    # 1 s, 10 s, 1 min and 10 min buckets, coarser ones merged from finer ones
+    levels = (1, 10, 60, 600)
     
     # Get data
-   
-    peak_8_median = deque(maxlen=full_maxlen)
-    peak_9_median = deque(maxlen=full_maxlen)
-    peak_10_median = deque(maxlen=full_maxlen)
-    
-    peak_8_std = deque(maxlen=full_maxlen)
-    peak_9_std = deque(maxlen=full_maxlen)
-    peak_10_std = deque(maxlen=full_maxlen)
-    
-    peak_8_median_TS = deque(maxlen=full_maxlen) # Maybe use this for stdev too?
-    peak_9_median_TS = deque(maxlen=full_maxlen)
-    peak_10_median_TS = deque(maxlen=full_maxlen)
-    
+    peak_8 = StatsPyramid(levels)
+    peak_9 = StatsPyramid(levels)
+    peak_10 = StatsPyramid(levels)
     
-    # Subscribe to devices
+    # Subscribe to the raw values, the pyramid does its own aggregation
     beam.peak_8.subscribe(
-        partial(new_data, 
-                median=peak_8_median,
-                stdev=peak_8_std,
-                medianTS=peak_8_median_TS)
+        partial(new_data, pyramid=peak_8),
+        event_type=beam.peak_8.SUB_VALUE
     )
     
     beam.peak_9.subscribe(
-        partial(new_data, 
-                median=peak_9_median,
-                stdev=peak_9_std,
-                medianTS=peak_9_median_TS)
+        partial(new_data, pyramid=peak_9),
+        event_type=beam.peak_9.SUB_VALUE
     )
     
     beam.peak_10.subscribe(
-        partial(new_data, 
-                median=peak_10_median,
-                stdev=peak_10_std,
-                medianTS=peak_10_median_TS)
+        partial(new_data, pyramid=peak_10),
+        event_type=beam.peak_10.SUB_VALUE
     )
    
-    medianDict = {
-        'peak_8_median':peak_8_median,
-        'peak_9_median':peak_9_median,
-        'peak_10_median':peak_10_median
-    }
-    stdevDict = {
-        'peak_8_std':peak_8_std,
-        'peak_9_std':peak_9_std,
-        'peak_10_std':peak_10_std
-    }
-    median_stdev_TS_Dict={
-        'peak_8_std_median_TS':peak_8_median_TS,
-        'peak_9_std_median_TS':peak_9_median_TS,
-        'peak_10_std_median_TS':peak_10_median_TS
-    }
-    
-    data = {
-        'medianDict':medianDict,
-        'stdevDict':stdevDict,
-        'median_stdev_TS_Dict':median_stdev_TS_Dict
+    pyramidDict = {
+        'peak_8':peak_8,
+        'peak_9':peak_9,
+        'peak_10':peak_10
     }
     
     # Keep sending data
     while True:
 
-        message = socket.recv()
-        socket.send_pyobj(data)
+        # A request is a bucket length in seconds, or {'level': seconds}. An
+        # unknown length gets the finest level, anything else an error.
+        try:
+            message = recv_message(socket)
+            if isinstance(message, dict):
+                message = message.get('level', levels[0])
+            if isinstance(message, bool) or not isinstance(message, int):
+                raise ValueError("Request must be a bucket length in seconds, one of %s"
+                                 % ', '.join(str(level) for level in levels))
+            level = message if message in levels else levels[0]
+            
+            medianDict = {}
+            stdevDict = {}
+            median_stdev_TS_Dict = {}
+            statsDict = {}
+            for name, pyramid in pyramidDict.items():
+                stats = pyramid.level(level)
+                medianDict[name + '_median'] = stats['median']
+                stdevDict[name + '_std'] = stats['std']
+                median_stdev_TS_Dict[name + '_std_median_TS'] = stats['time'] + level/2
+                statsDict[name] = stats
+        
+            data = {
+                'level':level,
+                'medianDict':medianDict,
+                'stdevDict':stdevDict,
+                'median_stdev_TS_Dict':median_stdev_TS_Dict,
+                'statsDict':statsDict
+            }
+            send_message(socket, data)
+        except Exception as error:
+            send_message(socket, {'error': str(error)})
         
 if __name__ == '__main__':
     launch_server()
@@ -0,0 +1,147 @@
+import numpy as np
+
+from downsample import m4_indices, lttb_indices
+
+
+# Ways a request can ask for a channel to be brought down to max_points
+AGGREGATES = ('m4', 'lttb', 'mean')
+
+
+def check_request(request, channels):
+    """
+    Raise ValueError if a request doesn't follow the schema below, which
+    the REQ/REP master answers with DeltaPublisher.reply(). Every key is
+    optional.
+
+    - 'channels': peak names to send, every channel by default
+    - 'epoch', 'cursors': where the client is (see DeltaCursor), to only
+      get samples added since
+    - 'start', 'end': time range in seconds
+    - 'after': only samples strictly after this time in seconds, e.g. the
+      time of the latest sample a client already has
+    - 'last': number of latest samples
+    - 'max_points': most points to send per channel
+    - 'aggregate': how to get down to max_points, one of AGGREGATES
+    - 'dtype': dtype to send values in, e.g. 'float32' to halve the reply
+    - 'codec', 'timestamps_codec': codecs to compress values and timestamps
+      with, see framing.encode()
+
+    Parameters
+    ----------
+
+    request: dict
+        Request received from a client
+
+    channels: list
+        Peak names the master has
+
+    """
+
+    requested = request.get('channels') or []
+    if not isinstance(requested, list) or not all(isinstance(name, str) for name in requested):
+        raise ValueError("channels must be a list of peak names")
+    unknown = set(requested) - set(channels)
+    if unknown:
+        raise ValueError("Unknown channels: %s" % ', '.join(sorted(unknown)))
+    if request.get('aggregate', 'm4') not in AGGREGATES:
+        raise ValueError("aggregate must be one of %s" % ', '.join(AGGREGATES))
+    for key in ('last', 'max_points'):
+        if request.get(key) is not None and not (_is_integer(request[key]) and request[key] >= 1):
+            raise ValueError("%s must be an integer of at least 1" % key)
+    for key in ('start', 'end', 'after'):
+        if request.get(key) is not None and not _is_number(request[key]):
+            raise ValueError("%s must be a time in seconds" % key)
+    cursors = request.get('cursors') or {}
+    if not isinstance(cursors, dict) or not all(
+            _is_integer(cursor) and cursor >= 0 for cursor in cursors.values()):
+        raise ValueError("cursors must map channels to sequence numbers")
+    try:
+        dtype = np.dtype(request.get('dtype', np.float64))
+    except TypeError:
+        dtype = None
+    if dtype is None or dtype.kind not in 'biuf':
+        raise ValueError("dtype must be a numeric dtype")
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _is_integer(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def select(values, timestamps, start=None, end=None, last=None, after=None):
+    """
+    Return the samples in a time range, and only the last few of them
+
+    Parameters
+    ----------
+
+    values, timestamps: numpy.array
+        Samples with their timestamps in ns, sorted by time
+
+    start, end: float
+        Time range in seconds, None for no limit
+
+    last: int
+        Most samples to keep, the latest ones
+
+    after: float
+        Time in seconds, only samples strictly after it are kept
+
+    """
+
+    lo = 0 if start is None else np.searchsorted(timestamps, int(start*1e9), side='left')
+    if after is not None:
+        # after is a timestamp/1e9 a client got, so compare the samples
+        # around it the same way rather than trusting int(after*1e9)
+        near = np.searchsorted(timestamps, int(after*1e9) - 1000, side='left')
+        far = np.searchsorted(timestamps, int(after*1e9) + 1000, side='right')
+        near += np.searchsorted(timestamps[near:far]/1e9, after, side='right')
+        lo = max(lo, near)
+    hi = len(timestamps) if end is None else np.searchsorted(timestamps, int(end*1e9), side='right')
+    if last is not None:
+        lo = max(lo, hi - int(last))
+    return values[lo:hi], timestamps[lo:hi]
+
+
+def decimate(values, timestamps, max_points, aggregate='m4'):
+    """
+    Bring samples down to at most about max_points
+
+    Parameters
+    ----------
+
+    values, timestamps: numpy.array
+        Samples with their timestamps in ns, sorted by time
+
+    max_points: int
+        Most points wanted
+
+    aggregate: str
+        'm4' keeps the first, min, max and last sample of max_points/4 time
+        buckets, 'lttb' picks max_points samples that keep the shape of the
+        curve, 'mean' averages values and times over max_points time buckets
+
+    """
+
+    if len(timestamps) <= max_points:
+        return values, timestamps
+
+    if aggregate == 'm4':
+        indices = m4_indices(timestamps, values, max(max_points // 4, 1))
+    elif aggregate == 'lttb':
+        indices = lttb_indices(timestamps, values, max_points)
+    else:
+        span = (timestamps[-1] - timestamps[0]) or 1
+        # In float, (timestamps - t0) * max_points overflows int64 on long spans
+        bucket = ((timestamps - timestamps[0]) / span * max_points).astype(np.int64)
+        bucket = np.minimum(bucket, max_points - 1)
+        count = np.bincount(bucket, minlength=max_points)
+        filled = count > 0
+        mean = np.bincount(bucket, weights=values, minlength=max_points)[filled] / count[filled]
+        times = np.bincount(bucket, weights=timestamps - timestamps[0], minlength=max_points)
+        times = timestamps[0] + (times[filled] / count[filled]).astype(np.int64)
+        return mean, times
+    return values[indices], timestamps[indices]
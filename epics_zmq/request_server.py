@@ -0,0 +1,123 @@
+import threading
+import time
+
+import zmq
+
+from framing import send_message, unpack_message
+
+
+class RequestServer:
+    """
+    Answers REQ clients from a pool of worker threads, so a slow reply to
+    one client doesn't hold up the others. A ROUTER socket takes the
+    requests of every client and a DEALER hands them to whichever worker is
+    free. Each reply goes back to the client that asked.
+
+    Workers never read the live store, which CA callbacks keep appending to
+    from their own thread. They answer from a snapshot, an immutable copy
+    of the store swapped in by replacing a single reference. A snapshot is
+    only taken when a request comes in, the last one is at least
+    ``interval`` seconds old and the store changed since, so an idle master
+    copies nothing. The other workers keep answering from the previous
+    snapshot while it is taken. Compressing and sending frames release the
+    GIL, so those parts of the replies run in parallel.
+
+    A request that can't be answered gets {'error': message} back, so the
+    worker stays alive and the client isn't left waiting.
+
+    Parameters
+    ----------
+
+    context: zmq.Context
+        Context to create sockets with
+
+    port: int
+        Port to answer requests on
+
+    snapshot: callable
+        Returns an immutable snapshot of the store
+
+    answer: callable
+        Takes a snapshot and a request, returns the reply and the keyword
+        arguments to send it with, see framing.send_message()
+
+    version: callable
+        Returns a value that changes whenever the store does, e.g. the
+        sequence numbers of its ring buffers. Without it a snapshot is
+        taken every interval there are requests.
+
+    workers: int
+        Number of worker threads
+
+    interval: float
+        Seconds between snapshots
+
+    """
+
+    def __init__(self, context, port, snapshot, answer, version=None, workers=4, interval=1.):
+        self.context = context
+        self.port = port
+        self.snapshot = snapshot
+        self.answer = answer
+        self.version = version
+        self.workers = workers
+        self.interval = interval
+        self.current = None
+        self.address = "inproc://workers-%d" % port
+        self._lock = threading.Lock()
+        self._taken = 0.
+        self._version = None
+
+    def latest(self):
+        """
+        Return the snapshot to answer a request from, taking a new one if
+        the last one is stale and no other worker is already taking it
+
+        """
+
+        if time.time() - self._taken < self.interval:
+            return self.current
+
+        # Only the first request has to wait for a snapshot
+        if not self._lock.acquire(blocking=self.current is None):
+            return self.current
+        try:
+            if time.time() - self._taken >= self.interval:
+                version = self.version() if self.version is not None else None
+                if self.current is None or version is None or version != self._version:
+                    self.current = self.snapshot()
+                    self._version = version
+                self._taken = time.time()
+        finally:
+            self._lock.release()
+        return self.current
+
+    def _work(self):
+        socket = self.context.socket(zmq.REP)
+        socket.connect(self.address)
+        while True:
+            frames = socket.recv_multipart(copy=False)
+            try:
+                reply, kwargs = self.answer(self.latest(), unpack_message(frames))
+                send_message(socket, reply, **kwargs)
+            except Exception as error:
+                print("Request failed: %r" % error)
+                send_message(socket, {'error': str(error)})
+
+    def run(self):
+        """
+        Answer requests until interrupted
+
+        """
+
+        frontend = self.context.socket(zmq.ROUTER)
+        frontend.bind("tcp://*:%d" % self.port)
+
+        # Workers can only connect once the backend is bound
+        backend = self.context.socket(zmq.DEALER)
+        backend.bind(self.address)
+
+        for _ in range(self.workers):
+            threading.Thread(target=self._work, daemon=True).start()
+
+        zmq.proxy(frontend, backend)
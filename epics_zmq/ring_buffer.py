@@ -0,0 +1,178 @@
+import numpy as np
+
+
+class RingBuffer:
+    """
+    Preallocated columnar ring buffer holding one PV's values and timestamps.
+
+    Both columns are stored twice back to back (a "mirrored" buffer), so
+    the most recent N samples are always one contiguous slice and can be
+    handed out as zero-copy numpy views. Appending costs two array writes.
+
+    Timestamps are passed in as EPICS seconds and stored as int64
+    nanoseconds so exact matches survive event building.
+
+    Every appended sample gets a sequence number (0, 1, 2, ...). ``seq``
+    is the sequence number the next sample will get, which lets readers
+    ask for only what arrived since they last looked.
+
+    Note: views are only valid until the buffer wraps past them, so
+    copy anything that has to be kept for longer than ``maxlen`` samples.
+
+    Parameters
+    ----------
+
+    maxlen: int
+        Number of samples to keep
+
+    dtype: numpy.dtype
+        dtype of the value column
+
+    shape: tuple
+        Shape of a single value, e.g. (n,) for array PVs like the timetool
+
+    """
+
+    def __init__(self, maxlen, dtype=np.float64, shape=()):
+        self.maxlen = int(maxlen)
+        self.dtype = np.dtype(dtype)
+        self.shape = tuple(shape)
+        self._values = np.zeros((2*self.maxlen,) + self.shape, dtype=self.dtype)
+        self._timestamps = np.zeros(2*self.maxlen, dtype=np.int64)
+        self.seq = 0
+        self._start_seq = 0
+
+    def __len__(self):
+        return min(self.seq - self._start_seq, self.maxlen)
+
+    def append(self, value, timestamp):
+        """
+        Append a single sample
+
+        """
+
+        pos = self.seq % self.maxlen
+        ts = int(timestamp*1e9)
+        self._values[pos] = value
+        self._values[pos + self.maxlen] = value
+        self._timestamps[pos] = ts
+        self._timestamps[pos + self.maxlen] = ts
+        # Bump seq last so readers never see a half written sample
+        self.seq += 1
+
+    def extend(self, values, timestamps):
+        """
+        Append many samples at once
+
+        """
+
+        values = np.asarray(values, dtype=self.dtype)
+        timestamps = (np.asarray(timestamps, dtype=np.float64)*1e9).astype(np.int64)
+        count = len(timestamps)
+
+        # Only the newest maxlen samples can survive
+        skip = max(count - self.maxlen, 0)
+        pos = (self.seq + skip + np.arange(count - skip)) % self.maxlen
+        for column, new in ((self._values, values[skip:]), (self._timestamps, timestamps[skip:])):
+            column[pos] = new
+            column[pos + self.maxlen] = new
+        self.seq += count
+
+    def _window(self, start_seq, end_seq):
+        """
+        Return views of the samples with sequence numbers in [start_seq, end_seq)
+
+        """
+
+        start_seq = max(start_seq, end_seq - self.maxlen, self._start_seq)
+        count = max(end_seq - start_seq, 0)
+        if count == 0:
+            return self._values[:0], self._timestamps[:0]
+        end = (end_seq - 1) % self.maxlen + 1 + self.maxlen
+        return self._values[end - count:end], self._timestamps[end - count:end]
+
+    @property
+    def values(self):
+        return self.last()[0]
+
+    @property
+    def timestamps(self):
+        return self.last()[1]
+
+    def last(self, n=None):
+        """
+        Return zero-copy views of the (up to) n most recent values and
+        timestamps, or of everything retained if n is None
+
+        """
+
+        end_seq = self.seq
+        if n is None:
+            n = self.maxlen
+        return self._window(end_seq - int(n), end_seq)
+
+    def since(self, seq):
+        """
+        Return zero-copy views of every retained sample with sequence number
+        >= seq, along with the sequence number to pass in next time.
+
+        Parameters
+        ----------
+
+        seq: int
+            Sequence number returned from the previous call (0 for everything)
+
+        """
+
+        end_seq = self.seq
+        values, timestamps = self._window(seq, end_seq)
+        return values, timestamps, end_seq
+
+    def since_copy(self, seq):
+        """
+        Same as since() but with copies, for samples read while another
+        thread appends. Samples an append overwrote during the copy are left
+        out, so values and timestamps always match.
+
+        """
+
+        values, timestamps, end_seq = self.since(seq)
+        values, timestamps = values.copy(), timestamps.copy()
+
+        # An append overwrites the oldest sample before bumping seq
+        skip = max(self.seq + 1 - self.maxlen - (end_seq - len(timestamps)), 0)
+        return values[skip:], timestamps[skip:], end_seq
+
+    def copy(self):
+        """
+        Return a read-only copy of the retained samples keeping their
+        sequence numbers, for other threads to read while this buffer keeps
+        being appended to. Samples overwritten while copying are left out.
+
+        """
+
+        values, timestamps, end_seq = self.since_copy(0)
+        count = len(timestamps)
+
+        # One spare slot, so since_copy() on the copy doesn't leave out its
+        # oldest sample for an append that can't happen
+        copy = RingBuffer(count + 1, self.dtype, self.shape)
+        copy.seq = end_seq
+        copy._start_seq = end_seq - count
+
+        # Only fill the half of the mirror reads come from, the pages of the
+        # other half are never touched so never allocated
+        end = (end_seq - 1) % copy.maxlen + 1 + copy.maxlen
+        for column, new in ((copy._values, values), (copy._timestamps, timestamps)):
+            column[end - count:end] = new
+            column.flags.writeable = False
+        return copy
+
+    def clear(self):
+        """
+        Forget every sample, keeping the allocated memory. Sequence numbers
+        keep counting up so cursors held by readers stay valid.
+
+        """
+
+        self._start_seq = self.seq
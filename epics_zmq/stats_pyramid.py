@@ -0,0 +1,161 @@
+import math
+import threading
+
+import numpy as np
+
+from ring_buffer import RingBuffer
+from streaming_stats import RunningStats, QuantileSketch
+
+
+# Columns stored for every closed bucket
+COUNT, SUM, SUMSQ, MIN, MAX, MEDIAN = range(6)
+
+
+class StatsBucket:
+    """
+    Aggregate of every value seen in one time bucket. Buckets of the same
+    length can be merged into a bucket covering a longer time.
+
+    Parameters
+    ----------
+
+    start: float
+        Start of the bucket in seconds
+
+    """
+
+    def __init__(self, start):
+        self.start = start
+        self.running = RunningStats()
+        self.sketch = QuantileSketch()
+
+    def update(self, value):
+        self.running.update(value)
+        self.sketch.update(value)
+
+    def merge(self, other):
+        self.running.merge(other.running)
+        self.sketch.merge(other.sketch)
+
+    def row(self):
+        """
+        Return the bucket as one row of COUNT, SUM, SUMSQ, MIN, MAX, MEDIAN
+
+        """
+
+        running = self.running
+        return (running.count,
+                running.mean*running.count,
+                running._m2 + running.count*running.mean**2,
+                running.min,
+                running.max,
+                self.sketch.quantile(0.5))
+
+
+class StatsPyramid:
+    """
+    Hierarchical statistics of one PV at several cadences (1 s, 10 s, 1 min
+    and 10 min by default).
+
+    Raw values only go into the finest level. Whenever a bucket closes it is
+    merged into the open bucket of the next level up, so coarser levels never
+    rescan raw data. Closed buckets are kept per level as rows of
+    count/sum/sumsq/min/max/median in a RingBuffer; only the open bucket of
+    each level holds a quantile sketch.
+
+    update() and level() hold a lock, so CA callbacks can keep adding
+    values while another thread reads a level. Reading a sketch compresses
+    it, which would otherwise race with values going in.
+
+    Parameters
+    ----------
+
+    levels: tuple
+        Bucket lengths in seconds, finest first. Each should divide the next.
+
+    maxlen: int
+        Number of closed buckets to keep per level
+
+    """
+
+    def __init__(self, levels=(1, 10, 60, 600), maxlen=50000):
+        self.levels = tuple(levels)
+        self._closed = [RingBuffer(maxlen, shape=(6,)) for _ in self.levels]
+        self._open = [None for _ in self.levels]
+        self._lock = threading.Lock()
+
+    def update(self, value, timestamp):
+        """
+        Add a raw value with its timestamp in seconds
+
+        """
+
+        start = math.floor(timestamp / self.levels[0]) * self.levels[0]
+        with self._lock:
+            bucket = self._open[0]
+            if bucket is None or start > bucket.start:
+                if bucket is not None:
+                    self._close(0)
+                bucket = self._open[0] = StatsBucket(start)
+            bucket.update(value)
+
+    def _close(self, level):
+        """
+        Store the open bucket of a level and merge it into the level above
+
+        """
+
+        bucket = self._open[level]
+        self._closed[level].append(bucket.row(), bucket.start)
+        self._open[level] = None
+
+        if level + 1 == len(self.levels):
+            return
+        length = self.levels[level + 1]
+        start = math.floor(bucket.start / length) * length
+        parent = self._open[level + 1]
+        if parent is not None and start > parent.start:
+            self._close(level + 1)
+            parent = None
+        if parent is None:
+            parent = self._open[level + 1] = StatsBucket(start)
+        parent.merge(bucket)
+
+    def level(self, seconds):
+        """
+        Return the buckets of one level, including the one still filling up
+        (which only covers finer buckets that have already closed), as a
+        dictionary of numpy arrays: time (bucket start in seconds), count,
+        mean, median, std, min and max
+
+        Parameters
+        ----------
+
+        seconds: int
+            Bucket length of the level, must be one of self.levels
+
+        """
+
+        index = self.levels.index(seconds)
+        with self._lock:
+            rows, starts = self._closed[index].last()
+            rows = np.array(rows)
+            starts = starts/1e9
+            bucket = self._open[index]
+            if bucket is not None:
+                rows = np.vstack([rows, bucket.row()])
+                starts = np.append(starts, bucket.start)
+
+        count = rows[:, COUNT]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = rows[:, SUM] / count
+            std = np.sqrt(np.clip(rows[:, SUMSQ]/count - mean**2, 0, None))
+
+        return {
+            'time': starts,
+            'count': count,
+            'mean': mean,
+            'median': rows[:, MEDIAN],
+            'std': std,
+            'min': rows[:, MIN],
+            'max': rows[:, MAX]}
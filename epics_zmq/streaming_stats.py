@@ -0,0 +1,435 @@
+import math
+
+
+class RunningStats:
+    """
+    Count, mean, variance, min and max of a stream of values, updated in
+    constant time and memory per sample (Welford's algorithm).
+
+    Two RunningStats can be merged, e.g. to combine per-second windows into
+    longer ones without looking at the raw values again.
+
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """
+        Forget every value seen so far
+
+        """
+
+        self.count = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def update(self, value):
+        """
+        Add a single value
+
+        """
+
+        value = float(value)
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (value - self.mean)
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        """
+        Fold the values seen by another RunningStats into this one
+
+        """
+
+        if other.count == 0:
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self._m2 += other._m2 + delta*delta * self.count * other.count / count
+        self.mean += delta * other.count / count
+        self.count = count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def variance(self, ddof=0):
+        """
+        Variance of the values, ddof=0 like numpy.var and ddof=1 like
+        statistics.variance
+
+        """
+
+        if self.count - ddof <= 0:
+            return math.nan
+        return self._m2 / (self.count - ddof)
+
+    def std(self, ddof=0):
+        """
+        Standard deviation of the values, see variance
+
+        """
+
+        return math.sqrt(self.variance(ddof))
+
+
+class P2Quantile:
+    """
+    Streaming estimate of a single quantile using the P-square algorithm
+    (Jain and Chlamtac, 1985). Keeps five markers no matter how many values
+    are added, so each update costs constant time and memory.
+
+    Parameters
+    ----------
+
+    q: float
+        Quantile to estimate, between 0 and 1 (0.5 for the median)
+
+    """
+
+    def __init__(self, q=0.5):
+        self.q = q
+        self.reset()
+
+    def reset(self):
+        """
+        Forget every value seen so far
+
+        """
+
+        q = self.q
+        self.count = 0
+        self._heights = []
+        self._positions = [0, 1, 2, 3, 4]
+        self._desired = [0, 2*q, 4*q, 2 + 2*q, 4]
+        self._increments = [0, q/2, q, (1 + q)/2, 1]
+
+    def update(self, value):
+        """
+        Add a single value
+
+        """
+
+        value = float(value)
+        self.count += 1
+        heights = self._heights
+
+        # Markers are the first five values until there are enough of them
+        if self.count <= 5:
+            heights.append(value)
+            heights.sort()
+            return
+
+        positions = self._positions
+        if value < heights[0]:
+            heights[0] = value
+            k = 0
+        elif value >= heights[4]:
+            heights[4] = value
+            k = 3
+        else:
+            k = 0
+            while value >= heights[k + 1]:
+                k += 1
+
+        for i in range(k + 1, 5):
+            positions[i] += 1
+        for i in range(5):
+            self._desired[i] += self._increments[i]
+
+        # Move the middle markers towards their desired positions
+        for i in range(1, 4):
+            d = self._desired[i] - positions[i]
+            if ((d >= 1 and positions[i + 1] - positions[i] > 1) or
+                    (d <= -1 and positions[i - 1] - positions[i] < -1)):
+                d = 1 if d > 0 else -1
+                height = self._parabolic(i, d)
+                if not heights[i - 1] < height < heights[i + 1]:
+                    height = self._linear(i, d)
+                heights[i] = height
+                positions[i] += d
+
+    def _parabolic(self, i, d):
+        heights = self._heights
+        positions = self._positions
+        return heights[i] + d / (positions[i + 1] - positions[i - 1]) * (
+            (positions[i] - positions[i - 1] + d) * (heights[i + 1] - heights[i])
+            / (positions[i + 1] - positions[i])
+            + (positions[i + 1] - positions[i] - d) * (heights[i] - heights[i - 1])
+            / (positions[i] - positions[i - 1]))
+
+    def _linear(self, i, d):
+        heights = self._heights
+        positions = self._positions
+        return heights[i] + d * (heights[i + d] - heights[i]) / (positions[i + d] - positions[i])
+
+    @property
+    def value(self):
+        """
+        Current estimate of the quantile, exact while fewer than six values
+        have been seen
+
+        """
+
+        heights = self._heights
+        if self.count == 0:
+            return math.nan
+        if self.count <= 5:
+            # Same linear interpolation as numpy.percentile
+            pos = self.q * (len(heights) - 1)
+            low = int(math.floor(pos))
+            high = min(low + 1, len(heights) - 1)
+            return heights[low] + (heights[high] - heights[low]) * (pos - low)
+        return heights[2]
+
+
+class StreamingStats:
+    """
+    Bundle of streaming estimators for one window of a PV: count, min, max,
+    mean and std from RunningStats plus a P2Quantile median.
+
+    StatsEpicsSignal uses this by default; anything with the same update,
+    reset, median and std methods can be plugged in instead.
+
+    """
+
+    def __init__(self):
+        self.running = RunningStats()
+        self.quantile = P2Quantile(0.5)
+
+    @property
+    def count(self):
+        return self.running.count
+
+    def reset(self):
+        """
+        Start a new window
+
+        """
+
+        self.running.reset()
+        self.quantile.reset()
+
+    def update(self, value):
+        """
+        Add a single value
+
+        """
+
+        self.running.update(value)
+        self.quantile.update(value)
+
+    def median(self):
+        return self.quantile.value
+
+    def std(self, ddof=0):
+        return self.running.std(ddof)
+
+    def summary(self):
+        """
+        Return the current window as a dictionary
+
+        """
+
+        return {
+            'count': self.running.count,
+            'mean': self.running.mean,
+            'median': self.median(),
+            'std': self.std(),
+            'min': self.running.min,
+            'max': self.running.max}
+
+
+class QuantileSketch:
+    """
+    Mergeable quantile sketch in the style of a t-digest: values are kept as
+    weighted centroids, with small centroids near the tails and larger ones
+    near the middle. Memory stays at a few times ``size`` centroids (growing
+    only logarithmically with the number of values), and two sketches can be
+    merged.
+
+    Parameters
+    ----------
+
+    size: int
+        Compression, more centroids give more accurate quantiles
+
+    """
+
+    def __init__(self, size=100):
+        self.size = size
+        self.reset()
+
+    def reset(self):
+        """
+        Forget every value seen so far
+
+        """
+
+        self.count = 0
+        self._centroids = []
+        self._buffer = []
+
+    def update(self, value):
+        """
+        Add a single value
+
+        """
+
+        self._buffer.append((float(value), 1))
+        self.count += 1
+        if len(self._buffer) > 4*self.size:
+            self._compress()
+
+    def extend(self, values):
+        """
+        Add many values at once, skipping NaN
+
+        """
+
+        values = [(value, 1) for value in map(float, values) if value == value]
+        self._buffer.extend(values)
+        self.count += len(values)
+        if len(self._buffer) > 4*self.size:
+            self._compress()
+
+    def merge(self, other):
+        """
+        Fold the values seen by another QuantileSketch into this one
+
+        """
+
+        self._buffer.extend(other._centroids)
+        self._buffer.extend(other._buffer)
+        self.count += other.count
+        self._compress()
+
+    def _compress(self):
+        points = sorted(self._centroids + self._buffer)
+        self._buffer = []
+        if not points:
+            return
+
+        total = self.count
+        centroids = []
+        mean, weight = points[0]
+        cumulative = 0
+        for next_mean, next_weight in points[1:]:
+            proposed = weight + next_weight
+            q = (cumulative + proposed/2) / total
+            if proposed <= max(4*total*q*(1 - q)/self.size, 1):
+                mean += (next_mean - mean) * next_weight / proposed
+                weight = proposed
+            else:
+                centroids.append((mean, weight))
+                cumulative += weight
+                mean, weight = next_mean, next_weight
+        centroids.append((mean, weight))
+        self._centroids = centroids
+
+    def quantile(self, q):
+        """
+        Estimate the q quantile, q between 0 and 1
+
+        """
+
+        if self._buffer:
+            self._compress()
+        centroids = self._centroids
+        if not centroids:
+            return math.nan
+        if len(centroids) == 1:
+            return centroids[0][0]
+
+        # Interpolate between centroid centres by cumulative weight
+        target = q * self.count
+        cumulative = 0
+        previous_mean, previous_centre = centroids[0][0], centroids[0][1]/2
+        if target <= previous_centre:
+            return previous_mean
+        for mean, weight in centroids:
+            centre = cumulative + weight/2
+            if target <= centre and centre > previous_centre:
+                frac = (target - previous_centre) / (centre - previous_centre)
+                return previous_mean + (mean - previous_mean) * frac
+            previous_mean, previous_centre = mean, centre
+            cumulative += weight
+        return centroids[-1][0]
+
+
+class QuantileRange:
+    """
+    Low and high quantiles (1% and 99% by default) of several channels, both
+    over everything added and since the last clear(), e.g. to set the axis
+    ranges of a plot without sorting its whole history on every update.
+
+    Each channel keeps one QuantileSketch of the values added since the last
+    clear() and one of everything before it. clear() merges the first into
+    the second, and the full history range merges the two. Ranges are cached
+    until the next add().
+
+    Parameters
+    ----------
+
+    names: list
+        Channel names
+
+    low, high: float
+        Quantiles to return, between 0 and 1
+
+    size: int
+        Compression of the sketches, see QuantileSketch
+
+    """
+
+    def __init__(self, names, low=0.01, high=0.99, size=100):
+        self.names = list(names)
+        self.low = low
+        self.high = high
+        self._before = dict((name, QuantileSketch(size)) for name in self.names)
+        self._since = dict((name, QuantileSketch(size)) for name in self.names)
+        self._ranges = dict()
+
+    def add(self, events):
+        """
+        Add new values, given as a pandas.DataFrame or dictionary with one
+        column of values per channel
+
+        """
+
+        for name in self.names:
+            self._since[name].extend(events[name])
+        self._ranges.clear()
+
+    def clear(self):
+        """
+        Start a new since-clear range, the full history is kept
+
+        """
+
+        for name in self.names:
+            self._before[name].merge(self._since[name])
+            self._since[name].reset()
+        self._ranges.clear()
+
+    def range(self, name, since_clear=True):
+        """
+        Return the (low, high) quantiles of a channel since the last clear()
+        or over everything added
+
+        """
+
+        key = (name, since_clear)
+        if key not in self._ranges:
+            sketch = self._since[name]
+            if not since_clear:
+                sketch = QuantileSketch(sketch.size)
+                sketch.merge(self._before[name])
+                sketch.merge(self._since[name])
+            self._ranges[key] = (sketch.quantile(self.low), sketch.quantile(self.high))
+        return self._ranges[key]
@@ -14,3 +14,242 @@ def basic_event_builder(*args,**kwargs):
     [data_table.setdefault(col,kwargs[col]) for col in kwargs]
     full_frame = pd.DataFrame(data_table)
     return full_frame.dropna()
+
+
+def match_timestamps(reference, timestamps, tolerance=None, direction='nearest'):
+    """
+    Match every reference timestamp to a sample of another channel.
+
+    Both arrays must be sorted. Returns the index of the matched sample for
+    each reference timestamp (-1 where nothing is close enough) and the
+    offset timestamps - reference of each match.
+
+    Parameters
+    ----------
+
+    reference: numpy.array
+        Sorted timestamps to build events on
+
+    timestamps: numpy.array
+        Sorted timestamps of the channel to match against
+
+    tolerance: number
+        Largest allowed absolute offset, in the same units as the timestamps.
+        None allows any offset.
+
+    direction: str
+        'backward' takes the last sample at or before the reference,
+        'forward' the first sample at or after it and 'nearest' the closer
+        of the two
+
+    """
+
+    reference = np.asarray(reference)
+    timestamps = np.asarray(timestamps)
+    count = len(timestamps)
+    if count == 0:
+        return np.full(len(reference), -1), np.zeros(len(reference), dtype=reference.dtype)
+
+    if direction == 'backward':
+        index = np.searchsorted(timestamps, reference, side='right') - 1
+    elif direction == 'forward':
+        index = np.searchsorted(timestamps, reference, side='left')
+    elif direction == 'nearest':
+        after = np.searchsorted(timestamps, reference, side='left')
+        before = np.clip(after - 1, 0, count - 1)
+        after = np.clip(after, 0, count - 1)
+        take_after = np.abs(timestamps[after] - reference) < np.abs(reference - timestamps[before])
+        index = np.where(take_after, after, before)
+    else:
+        raise ValueError("direction must be 'backward', 'forward' or 'nearest'")
+
+    valid = (index >= 0) & (index < count)
+    index = np.where(valid, index, 0)
+    offsets = timestamps[index] - reference
+    if direction == 'backward':
+        valid &= offsets <= 0
+    elif direction == 'forward':
+        valid &= offsets >= 0
+    if tolerance is not None:
+        valid &= np.abs(offsets) <= tolerance
+
+    return np.where(valid, index, -1), offsets
+
+
+def asof_event_builder(*args, tolerance=None, direction='nearest', **kwargs):
+    """
+    Pass any number of pandas Series and return an event built pandas
+    DataFrame, matching samples whose timestamps are within tolerance of
+    each other instead of requiring exact matches.
+
+    The first Series is the reference: every one of its samples becomes an
+    event if every other channel has a sample close enough to it. Kwargs can
+    be used to name the columns of the returned DataFrame.
+
+    Returns the DataFrame and a dictionary of match statistics per channel
+    (number and fraction of reference samples matched, mean and largest
+    absolute offset).
+
+    Parameters
+    ----------
+
+    tolerance: number
+        Largest allowed timestamp difference, in the units of the index.
+        None allows any difference.
+
+    direction: str
+        'backward', 'forward' or 'nearest', see match_timestamps
+
+    """
+
+    channels = dict()
+    [channels.setdefault(col,args[col]) for col in range(len(args))]
+    [channels.setdefault(col,kwargs[col]) for col in kwargs]
+    for col, series in channels.items():
+        if not series.index.is_monotonic_increasing:
+            channels[col] = series.sort_index()
+
+    names = list(channels)
+    reference = channels[names[0]].index.values
+    keep = np.ones(len(reference), dtype=bool)
+    matches = dict()
+    stats = dict()
+    for col in names[1:]:
+        index, offsets = match_timestamps(
+            reference, channels[col].index.values, tolerance, direction)
+        matched = index >= 0
+        keep &= matched
+        matches[col] = index
+        offsets = np.abs(offsets[matched])
+        stats[col] = {
+            'matched': int(matched.sum()),
+            'fraction': float(matched.mean()) if len(matched) else 0.0,
+            'mean_offset': float(offsets.mean()) if len(offsets) else 0.0,
+            'max_offset': float(offsets.max()) if len(offsets) else 0.0}
+
+    data_table = dict()
+    data_table[names[0]] = channels[names[0]].values[keep]
+    for col in names[1:]:
+        data_table[col] = channels[col].values[matches[col][keep]]
+
+    return pd.DataFrame(data_table, index=reference[keep]), stats
+
+
+class StreamingEventBuilder:
+    """
+    Stateful event builder that only looks at newly arrived samples.
+
+    Works like basic_event_builder (an event is a timestamp present in every
+    channel) but keeps a cursor per channel, so each call to build() joins
+    only the samples that arrived since the last call and returns only the
+    events completed since then. Samples that can no longer be matched are
+    dropped, so the pending state stays small. A channel that stalls or
+    hasn't started yet would make the others hold on to everything, so each
+    channel keeps at most maxlen pending samples, and none older than
+    horizon before its latest one.
+
+    Parameters
+    ----------
+
+    maxlen: int
+        Most pending samples per channel, defaults to the shortest ring
+        buffer, older samples are gone from it anyway
+
+    horizon: number
+        Oldest pending sample to keep, as a time before the latest sample
+        of the channel in the units of the timestamps. None for no limit.
+
+    **channels: RingBuffer
+        Optional ring buffers to pull new samples from, keyed by column name.
+        Channels can also be fed by hand with add().
+
+    """
+
+    def __init__(self, *names, maxlen=None, horizon=None, **channels):
+        self.names = list(names) + list(channels)
+        self.channels = channels
+        if maxlen is None and channels:
+            maxlen = min(buf.maxlen for buf in channels.values())
+        self.maxlen = maxlen
+        self.horizon = horizon
+        self._cursors = {name: 0 for name in channels}
+        self._pending = {name: None for name in self.names}
+        self._last_ts = {name: None for name in self.names}
+
+    def add(self, name, values, timestamps):
+        """
+        Add samples for one channel. Timestamps must be increasing; anything
+        at or before the last timestamp seen for the channel is ignored, so a
+        full history can be passed in again without creating duplicates.
+
+        """
+
+        values = np.asarray(values)
+        timestamps = np.asarray(timestamps)
+        last = self._last_ts[name]
+        if last is not None:
+            start = np.searchsorted(timestamps, last, side='right')
+            values = values[start:]
+            timestamps = timestamps[start:]
+        if len(timestamps) == 0:
+            return
+
+        if self._pending[name] is not None:
+            old_values, old_timestamps = self._pending[name]
+            values = np.concatenate([old_values, values])
+            timestamps = np.concatenate([old_timestamps, timestamps])
+
+        keep = 0
+        if self.maxlen is not None:
+            keep = max(len(timestamps) - self.maxlen, 0)
+        if self.horizon is not None:
+            keep = max(keep, np.searchsorted(timestamps, timestamps[-1] - self.horizon, side='left'))
+        self._pending[name] = (values[keep:], timestamps[keep:])
+        self._last_ts[name] = timestamps[-1]
+
+    def build(self):
+        """
+        Return a pandas DataFrame of the events completed since the last call,
+        indexed by timestamp with one column per channel
+
+        """
+
+        for name, buf in self.channels.items():
+            values, timestamps, self._cursors[name] = buf.since(self._cursors[name])
+            self.add(name, values, timestamps)
+
+        if any(pending is None for pending in self._pending.values()):
+            return pd.DataFrame({name: [] for name in self.names})
+
+        common = None
+        for name in self.names:
+            timestamps = self._pending[name][1]
+            common = timestamps if common is None else np.intersect1d(
+                common, timestamps, assume_unique=True)
+
+        data_table = dict()
+        for name in self.names:
+            values, timestamps = self._pending[name]
+            data_table[name] = values[np.searchsorted(timestamps, common)]
+
+        # Every channel has seen everything up to the oldest last timestamp,
+        # so unmatched samples before it can never be part of an event
+        horizon = min(self._last_ts.values())
+        for name in self.names:
+            values, timestamps = self._pending[name]
+            keep = np.searchsorted(timestamps, horizon, side='right')
+            self._pending[name] = (values[keep:], timestamps[keep:])
+
+        return pd.DataFrame(data_table, index=common)
+
+    def reset(self):
+        """
+        Drop pending samples and skip everything received so far, e.g. when
+        the user clears a graph
+
+        """
+
+        for name, buf in self.channels.items():
+            self._cursors[name] = buf.seq
+        for name in self.names:
+            self._pending[name] = None
@@ -0,0 +1,213 @@
+import numpy as np
+
+from ring_buffer import RingBuffer
+
+
+class Histogram2D:
+    """
+    2D histogram of event built (x, y) pairs, kept up to date as events
+    arrive instead of being rebuilt from the whole dataset.
+
+    Bin edges span the 1st to 99th percentile of the first ``warmup`` events
+    on each axis, like gen_background used to do from a saved csv. New
+    events are added to the counts in place, so the cost of add() only
+    depends on the number of new events. The edges are only worked out
+    again when the data drift: more than ``drift`` of the latest ``warmup``
+    events fall outside them, or those events cover less than ``1 - drift``
+    of them on an axis. Counts are then rebuilt from the last ``history``
+    events kept for that purpose.
+
+    By default every event counts forever. With ``window`` only the last
+    window events count (older ones are taken out again as they drop out),
+    and with ``halflife`` older events fade out, each one weighing half as
+    much after halflife newer events.
+
+    Parameters
+    ----------
+
+    bins: int
+        Number of bins along each axis
+
+    window: int
+        Number of latest events to count, None to count every event
+
+    halflife: float
+        Number of events after which an event counts half, None for no decay
+
+    drift: float
+        Fraction of recent events outside (or range left unused) that
+        triggers new bin edges
+
+    warmup: int
+        Number of events to wait for before picking edges, also the number of
+        recent events the drift is checked against
+
+    history: int
+        Number of events kept to rebuild the counts with new edges
+
+    source: StreamingEventBuilder
+        Optional event builder to pull new events from with update()
+
+    columns: tuple
+        Names of the x and y columns of the events built by source
+
+    """
+
+    def __init__(self, bins=30, window=None, halflife=None, drift=0.25, warmup=200,
+                 history=20000, source=None, columns=('ebeam', 'ipm2')):
+        if window is not None and halflife is not None:
+            raise ValueError("Use either a window or a halflife, not both")
+        if window is not None:
+            history = max(history, window)
+        self.bins = bins
+        self.window = window
+        self.halflife = halflife
+        self.drift = drift
+        self.warmup = warmup
+        self.source = source
+        self.columns = columns
+        self.edges = None
+        self.counts = np.zeros((bins, bins))
+        self._events = RingBuffer(history, shape=(2,))
+        self._added = 0
+
+    def update(self):
+        """
+        Add every event the source has built since the last call
+
+        """
+
+        events = self.source.build()
+        x, y = self.columns
+        self.add(events[x].values, events[y].values)
+
+    def add(self, x, y):
+        """
+        Add new events, one x and y value each
+
+        """
+
+        events = np.column_stack([np.asarray(x, dtype=np.float64),
+                                  np.asarray(y, dtype=np.float64)])
+        events = events[np.isfinite(events).all(axis=1)]
+        count = len(events)
+        if count == 0:
+            return
+
+        # Events about to fall out of the window are taken out again
+        dropped = None
+        if self.window is not None:
+            events = events[-self.window:]
+            count = len(events)
+            old, _ = self._events.last(self.window)
+            dropped = old[:max(len(old) + count - self.window, 0)]
+
+        self._events.extend(events, np.arange(self._added, self._added + count))
+        self._added += count
+
+        if self.edges is None:
+            if len(self._events) >= self.warmup:
+                self._rebin()
+            return
+        if self._drifted():
+            self._rebin()
+            return
+
+        if self.halflife is not None:
+            self.counts *= 0.5**(count / self.halflife)
+            weights = 0.5**(np.arange(count - 1, -1, -1) / self.halflife)
+        else:
+            weights = None
+        self.counts += self._histogram(events, weights)
+        if dropped is not None and len(dropped):
+            self.counts -= self._histogram(dropped)
+            np.clip(self.counts, 0, None, out=self.counts)
+
+    def clear(self):
+        """
+        Forget every event, the next events pick new edges
+
+        """
+
+        self.edges = None
+        self.counts[:] = 0
+        self._events.clear()
+
+    def image(self):
+        """
+        Return the counts as a 2D numpy array laid out like an image (first
+        row at the top, so at the highest y) and the bounds (left, bottom,
+        right, top) to give hv.Image
+
+        """
+
+        if self.edges is None and len(self._events) > 1:
+            self._rebin()
+        if self.edges is None:
+            return np.zeros((self.bins, self.bins)), (0, 0, 1, 1)
+        (x0, x1), (y0, y1) = self.edges
+        return self.counts[::-1].copy(), (x0, y0, x1, y1)
+
+    def _recent(self):
+        events, _ = self._events.last(self.warmup)
+        return events
+
+    def _drifted(self):
+        events = self._recent()
+        if len(events) < self.warmup:
+            return False
+
+        inside = self._inside(events)
+        if 1 - inside.mean() > self.drift:
+            return True
+
+        # Data bunched up in a small part of the range
+        for axis, (lo, hi) in enumerate(self.edges):
+            low, high = np.percentile(events[:, axis], [1, 99])
+            if high - low < (1 - self.drift) * (hi - lo):
+                return True
+        return False
+
+    def _rebin(self):
+        """
+        Pick edges from the recent events and rebuild the counts from the
+        events kept in history
+
+        """
+
+        recent = self._recent()
+        edges = []
+        for axis in range(2):
+            lo, hi = np.percentile(recent[:, axis], [1, 99])
+            if hi <= lo:
+                hi = lo + 1
+            edges.append((lo, hi))
+        self.edges = tuple(edges)
+
+        events, _ = self._events.last(self.window)
+        weights = None
+        if self.halflife is not None:
+            weights = 0.5**(np.arange(len(events) - 1, -1, -1) / self.halflife)
+        self.counts = self._histogram(events, weights)
+
+    def _inside(self, events):
+        (x0, x1), (y0, y1) = self.edges
+        return ((events[:, 0] >= x0) & (events[:, 0] < x1) &
+                (events[:, 1] >= y0) & (events[:, 1] < y1))
+
+    def _histogram(self, events, weights=None):
+        """
+        Bin events into a (bins, bins) array of counts, rows along y
+
+        """
+
+        (x0, x1), (y0, y1) = self.edges
+        inside = self._inside(events)
+        events = events[inside]
+        if weights is not None:
+            weights = weights[inside]
+        ix = ((events[:, 0] - x0) / (x1 - x0) * self.bins).astype(np.int64)
+        iy = ((events[:, 1] - y0) / (y1 - y0) * self.bins).astype(np.int64)
+        flat = np.minimum(iy, self.bins - 1)*self.bins + np.minimum(ix, self.bins - 1)
+        counts = np.bincount(flat, weights=weights, minlength=self.bins*self.bins)
+        return counts.reshape(self.bins, self.bins).astype(np.float64)
@@ -13,7 +13,10 @@ from bokeh.application import Application
 import tables
 from fake_beam import FakeBeam
 from functools import partial
-from collections import deque
+from ring_buffer import RingBuffer
+from streaming_stats import QuantileRange
+from rolling import RollingWindow
+from envelope import EnvelopePyramid
 from event_builder import basic_event_builder
 from holoviews.streams import Buffer
 import time
@@ -79,7 +82,7 @@ def gen_background(df):
         cmap='fire').opts(
         norm=dict(framewise=True))
 
-def gen_hex(df):
+def gen_hex(df, ranges=None):
     """
     Return holoviews HexTiles plot
     
@@ -89,18 +92,20 @@ def gen_hex(df):
     df: pandas.DataFrame
         DataFrame containing data to be ploted on hextiles plot
     
+    ranges: dict
+        (low, high) axis range of each column, e.g. from a QuantileRange.
+        Defaults to the 1% and 99% quantiles of df.
+    
     """
     
     # Get bounds for graph
     colNames = list(df)
-    lowX = df[colNames[0]].quantile(0.01)
-    highX = df[colNames[0]].quantile(0.99)
-    lowY = df[colNames[1]].quantile(0.01)
-    highY = df[colNames[1]].quantile(0.99)
+    if ranges is None:
+        ranges = dict((name, (df[name].quantile(0.01), df[name].quantile(0.99))) for name in colNames)
     
     return hv.HexTiles(df, group="Number of events: " + str(len(df.index))).redim.range(
-        ebeam=(lowX, highX), 
-        ipm2 = (lowY, highY)).opts(
+        ebeam=ranges[colNames[0]], 
+        ipm2 = ranges[colNames[1]]).opts(
         norm=dict(framewise=True))
 
 def gen_scatter(df):
@@ -119,51 +124,56 @@ def gen_scatter(df):
 def gen_timehistory(df):
     
     return hv.Curve(df).opts(norm=dict(framewise=True)) 
+
+def gen_envelope(pyramid, x_range=None, width=1000, **kwargs):
+    """
+    Return holoviews Scatter with at most two points per pixel of the
+    channel's envelope over the visible time range
     
-def produce_timehistory(doc, ipm2List, ipm3List, ebeamList, ipm2TS, ipm3TS, ebeamTS):
-    # Streams
+    Parameters
+    ----------
     
-    # See if you can limit the buffer
-    b_th_ipm2 = Buffer(pd.DataFrame({'ipm':[]}), length=1200)
-    b_th_ipm3 = Buffer(pd.DataFrame({'ipm':[]}), length=1200)
+    pyramid: EnvelopePyramid
+        Envelope pyramid of the channel to plot
     
-    streamTH2 = hv.streams.Stream.define(
-        'df', df=pd.DataFrame({
-            'timestamp':[], 'ipm':[]
-        }))()
+    x_range: tuple
+        Visible time range in ms, None for everything
+        
+    width: int
+        Plot width in pixels
     
-    streamTH3 = hv.streams.Stream.define(
-        'df', df=pd.DataFrame({
-            'timestamp':[], 'ipm':[]
-        }))()
+    """
+    
+    start = end = None
+    if x_range is not None:
+        # Plot times are in ms, pyramid times in ns
+        start, end = int(x_range[0]*1e6), int(x_range[1]*1e6)
+    
+    values, timestamps = pyramid.query(start, end, max_points=2*width)
+    
+    # Convert ns timestamps to ms so bokeh formatter can get correct datetime
+    return hv.Scatter((timestamps/1e6, values), kdims=['index'], vdims=['ipm'])
+    
+def produce_timehistory(doc, ipm2, ipm3, ebeam, rolling, envelope):
+    # Streams
+    
+    # Tick whenever new data has been binned, plot size and range come from the plot
+    streamTH2 = hv.streams.Stream.define('Tick', tick=0)()
+    streamTH3 = hv.streams.Stream.define('Tick', tick=0)()
     
     # Generate dynamic map
     
-    # bottom plot
     # blue data
     plot_ipm2_b = hv.DynamicMap(
-        hv.Scatter,
-        streams=[b_th_ipm2]).options(width=1001, finalize_hooks=[apply_formatter])
+        partial(gen_envelope, pyramid=envelope['ipm2']),
+        streams=[streamTH2, hv.streams.PlotSize(), hv.streams.RangeX()]).options(
+        width=1001, finalize_hooks=[apply_formatter])
     # red data
     plot_ipm3_b = hv.DynamicMap(
-        hv.Scatter,
-        streams=[b_th_ipm3]).options(color='red', finalize_hooks=[apply_formatter])
+        partial(gen_envelope, pyramid=envelope['ipm3']),
+        streams=[streamTH3, hv.streams.PlotSize(), hv.streams.RangeX()]).options(
+        color='red', finalize_hooks=[apply_formatter])
 
-    # top plot
-    # blue plot
-#     plot_ipm2 = hv.DynamicMap(
-#         gen_timehistory,
-#         streams=[streamTH2]).options(
-#         width=1000, finalize_hooks=[apply_formatter]).redim.label(
-#         index='test')
-#     # red plot
-#     plot_ipm3 = hv.DynamicMap(
-#         gen_timehistory,
-#         streams=[streamTH3]).options(
-#         color='red', finalize_hooks=[apply_formatter]).redim.label(
-#         index='test')
-    
-    #plot = (plot_ipm2*plot_ipm3)# + plot_ipm2_b*plot_ipm3_b).cols(1)
     plot = plot_ipm2_b*plot_ipm3_b
     
     # Use bokeh to render plot
@@ -172,74 +182,23 @@ def produce_timehistory(doc, ipm2List, ipm3List, ebeamList, ipm2TS, ipm3TS, ebea
     callback_id_th2 = None
     callback_id_th3 = None
     
-    def push_data(ipm, timestamp, stream):
+    def push_data(ipm, stream):
         """
-        Push data into stream to be ploted on hextiles plot
+        Bring the shared rolling median and its envelope up to date and
+        redraw the time history
         
         """
-                
-        ipm_plot = list(ipm)
-        timestamp_plot = list(timestamp)
-        
-        times = [1000*time for time in timestamp_plot]
-        ipmData = pd.Series(ipm_plot, index=times)
-        
-        zipped = basic_event_builder(ipm=ipmData)
-        median = zipped.rolling(120, min_periods=1).median()
-        
-        if type(stream) == hv.streams.Buffer:
-            if len(median) > 1000:
-                counter = 0
-                pos = 0
-                send = pd.DataFrame({'ipm':[]})
-                
-                while counter < 1000:
-                    
-                    divide = len(median)/1000. 
-                    test = int(pos)
-                    send = send.append(median.iloc[[test]])
-                    #print(send)
-                    #print(type(median.iloc[[test]]))
-                    pos += divide
-                    counter += 1
-                    
-                #print(len(send))
-                #print(len(stream.data))
-                stream.send(send)
-                #print(stream.data[-10:])
-                print("Done")
-                
-            else:
-                stream.send(median)
-            #stream.send(median)
-        elif len(median) > 100:
-            stream.event(df=median)
-            #print(len(stream.data))
-        
-        #stream.send(median)
-        #stream.event(df=median)
-        #print(type(stream))
-        #print(len(median))
-        
-#         ipmData = pd.DataFrame({'timestamp': times, 'ipm': ipm_plot})        
-        
-#         stream.event(df=ipmData)
-        
-        
-#     callback_id_th2 = doc.add_periodic_callback(
-#         partial(push_data, ipm=ipm2List, timestamp=ipm2TS, stream=streamTH2), 
-#         1000)
-    
-#     callback_id_th3 = doc.add_periodic_callback(
-#         partial(push_data, ipm=ipm3List, timestamp=ipm3TS, stream=streamTH3), 
-#         1000)
+        
+        rolling[ipm].update()
+        envelope[ipm].update()
+        stream.event(tick=stream.tick + 1)
     
     callback_id_th2_b = doc.add_periodic_callback(
-        partial(push_data, ipm=ipm2List, timestamp=ipm2TS, stream=b_th_ipm2), 
+        partial(push_data, ipm='ipm2', stream=streamTH2), 
         1000)
     
     callback_id_th3_b = doc.add_periodic_callback(
-        partial(push_data, ipm=ipm3List, timestamp=ipm3TS, stream=b_th_ipm3), 
+        partial(push_data, ipm='ipm3', stream=streamTH3), 
         1000)
     
     plot = hvplot.state
@@ -247,7 +206,7 @@ def produce_timehistory(doc, ipm2List, ipm3List, ebeamList, ipm2TS, ipm3TS, ebea
     doc.title = "Time History Graphs"
     doc.add_root(plot)
     
-def produce_hex(doc, ipm2List, ipm3List, ebeamList, ipm2TS, ipm3TS, ebeamTS): 
+def produce_hex(doc, ipm2, ipm3, ebeam): 
     """
     Produce updating hextiles plot and push them onto the web page document.
     User may save current data, clear existing data, or pause the graph. User
@@ -259,41 +218,34 @@ def produce_hex(doc, ipm2List, ipm3List, ebeamList, ipm2TS, ipm3TS, ebeamTS):
     doc: bokeh.document (I think)
         Bokeh document to be displayed on webpage
     
-    ipm2List: deque
-        Deque containing updating ipm2 values
+    ipm2: RingBuffer
+        Ring buffer containing updating ipm2 values and timestamps
         
-    ipm3List: deque
-        Deque containing updating ipm3 values
-    
-    ebeamList: deque
-        Deque containing updating ebeam values
-    
-    ipm2TS: deque
-        Deque containing updating ipm2 timestamps
-    
-    ipm3TS: deque
-        Deque containing updating ipm3 timestamps
+    ipm3: RingBuffer
+        Ring buffer containing updating ipm3 values and timestamps
     
-    ebeamTS: deque
-        Deque containing updating ebeam timestamps
+    ebeam: RingBuffer
+        Ring buffer containing updating ebeam values and timestamps
     
     """
     
-    # Create copy of deques for each instance of server
-    ipm2_plot = list(ipm2List)
-    ipm3_plot = list(ipm3List)
-    ebeam_plot = list(ebeamList)
-    ipm2TS_plot = list(ipm2TS)
-    ipm3TS_plot = list(ipm3TS)
-    ebeamTS_plot = list(ebeamTS)
+    # Views of the ring buffers for each instance of server
+    ipm2_plot, ipm2TS_plot = ipm2.last()
+    ipm3_plot, ipm3TS_plot = ipm3.last()
+    ebeam_plot, ebeamTS_plot = ebeam.last()
     
-    ipm2_index, ipm3_index, ebeam_index, ipm2TS_index, ipm3TS_index, ebeamTS_index = (0, 0, 0, 0, 0, 0)
+    # Sequence numbers to plot from, moved forward by clear()
+    ipm2_seq, ipm3_seq, ebeam_seq = (0, 0, 0)
+    
+    # 1% and 99% quantiles of each channel for the axis ranges, fed with new events only
+    ranges = QuantileRange(['ebeam', 'ipm2', 'ipm3'])
+    last_event = -1
     
     # Streams
     streamHex = hv.streams.Stream.define(
         'df', df=pd.DataFrame({
             'ebeam':[], 'ipm2':[]
-        }))()
+        }), ranges=None)()
     
     # Generate dynamic map
     plot = hv.DynamicMap(
@@ -311,19 +263,17 @@ def produce_hex(doc, ipm2List, ipm3List, ebeamList, ipm2TS, ipm3TS, ebeamTS):
     
     def clear():
         """
-        "Clear" graphs and particular lists of server instance. Save current index
-        and only plot points after that index.
+        "Clear" graphs and particular lists of server instance. Save current sequence
+        number and only plot points after that sequence number.
         
         """
         
-        nonlocal ipm2_index, ipm3_index, ebeam_index, ipm2TS_index, ipm3TS_index, ebeamTS_index
+        nonlocal ipm2_seq, ipm3_seq, ebeam_seq
         
-        ipm2_index = len(ipm2List)
-        ipm3_index = len(ipm3List)
-        ebeam_index = len(ebeamList)
-        ipm2TS_index = len(ipm2TS)
-        ipm3TS_index = len(ipm3TS)
-        ebeamTS_index = len(ebeamTS)
+        ipm2_seq = ipm2.seq
+        ipm3_seq = ipm3.seq
+        ebeam_seq = ebeam.seq
+        ranges.clear()
         
     def push_data():
         """
@@ -331,22 +281,33 @@ def produce_hex(doc, ipm2List, ipm3List, ebeamList, ipm2TS, ipm3TS, ebeamTS):
         
         """
         
-        nonlocal ipm2_plot, ipm3_plot, ebeam_plot, ipm2TS_plot, ipm3TS_plot, ebeamTS_plot
+        nonlocal ipm2_plot, ipm3_plot, ebeam_plot, ipm2TS_plot, ipm3TS_plot, ebeamTS_plot, last_event
         
-        ipm2_plot = list(ipm2List)[ipm2_index:]
-        ipm3_plot = list(ipm3List)[ipm3_index:]
-        ebeam_plot = list(ebeamList)[ebeam_index:]
-        ipm2TS_plot = list(ipm2TS)[ipm2TS_index:]
-        ipm3TS_plot = list(ipm3TS)[ipm3TS_index:]
-        ebeamTS_plot = list(ebeamTS)[ebeamTS_index:]
+        ipm2_plot, ipm2TS_plot, _ = ipm2.since(ipm2_seq)
+        ipm3_plot, ipm3TS_plot, _ = ipm3.since(ipm3_seq)
+        ebeam_plot, ebeamTS_plot, _ = ebeam.since(ebeam_seq)
         
         ipm2Data = pd.Series(ipm2_plot, index=ipm2TS_plot)
         ipm3Data = pd.Series(ipm3_plot, index=ipm3TS_plot)
         ebeamData = pd.Series(ebeam_plot, index=ebeamTS_plot)
         zipped = basic_event_builder(ipm2=ipm2Data, ipm3=ipm3Data, ebeam=ebeamData)
+        
+        # Events are sorted by timestamp, only the ones after the last tick are new
+        ranges.add(zipped.iloc[zipped.index.searchsorted(last_event, side='right'):])
+        if len(zipped.index):
+            last_event = zipped.index[-1]
+        
         data = zipped[['ebeam', switch_key_hex]]
         #print(zipped)
-        streamHex.event(df=data)
+        streamHex.event(df=data, ranges=axis_ranges())
+    
+    def axis_ranges():
+        """
+        Return the since-clear axis range of each channel
+        
+        """
+        
+        return dict((name, ranges.range(name)) for name in ranges.names)
     
     def play_graph():
         """
@@ -410,7 +371,7 @@ def produce_hex(doc, ipm2List, ipm3List, ebeamList, ipm2TS, ipm3TS, ebeamTS):
     doc.title = "Hextiles Graph"
     doc.add_root(plot)
     
-def produce_scatter_on_background(doc, ipm2List, ipm3List, ebeamList, ipm2TS, ipm3TS, ebeamTS):
+def produce_scatter_on_background(doc, ipm2, ipm3, ebeam):
     """
     Produce background plot with updating scatter plot on top of it 
     and push them onto the web page document. User can control how many
@@ -423,23 +384,14 @@ def produce_scatter_on_background(doc, ipm2List, ipm3List, ebeamList, ipm2TS, ip
     doc: bokeh.document (I think)
         Bokeh document to be displayed on webpage
     
-    ipm2List: deque
-        Deque containing updating ipm2 values
+    ipm2: RingBuffer
+        Ring buffer containing updating ipm2 values and timestamps
         
-    ipm3List: deque
-        Deque containing updating ipm3 values
-    
-    ebeamList: deque
-        Deque containing updating ebeam values
-    
-    ipm2TS: deque
-        Deque containing updating ipm2 timestamps
-    
-    ipm3TS: deque
-        Deque containing updating ipm3 timestamps
+    ipm3: RingBuffer
+        Ring buffer containing updating ipm3 values and timestamps
     
-    ebeamTS: deque
-        Deque containing updating ebeam timestamps
+    ebeam: RingBuffer
+        Ring buffer containing updating ebeam values and timestamps
     
     """
     
@@ -488,16 +440,13 @@ def produce_scatter_on_background(doc, ipm2List, ipm3List, ebeamList, ipm2TS, ip
         # Still has the freezing points error, though, it seems to come more frequently. 
         # This may be a bigger problem now
         
-        ebeamConverted = list(ebeamList)
-        ipm2Converted = list(ipm2List)
-        ipm3Converted = list(ipm3List)
-        ebeamTimeConverted = list(ebeamTS)
-        ipm2TimeConverted = list(ipm2TS)
-        ipm3TimeConverted = list(ipm3TS)
+        ebeamConverted, ebeamTimeConverted = ebeam.last(limit)
+        ipm2Converted, ipm2TimeConverted = ipm2.last(limit)
+        ipm3Converted, ipm3TimeConverted = ipm3.last(limit)
 
-        ipm2Data = pd.Series(ipm2Converted[-limit:], index=ipm2TimeConverted[-limit:])
-        ipm3Data = pd.Series(ipm3Converted[-limit:], index=ipm3TimeConverted[-limit:])
-        ebeamData = pd.Series(ebeamConverted[-limit:], index=ebeamTimeConverted[-limit:])
+        ipm2Data = pd.Series(ipm2Converted, index=ipm2TimeConverted)
+        ipm3Data = pd.Series(ipm3Converted, index=ipm3TimeConverted)
+        ebeamData = pd.Series(ebeamConverted, index=ebeamTimeConverted)
         
         zipped = basic_event_builder(ipm2=ipm2Data, ipm3=ipm3Data, ebeam=ebeamData)
 
@@ -586,12 +535,11 @@ def produce_scatter_on_background(doc, ipm2List, ipm3List, ebeamList, ipm2TS, ip
 
 def new_data(*args, **kwargs):
     """
-    Append data from subscribe into data containers
+    Append data from subscribe into ring buffer
     
     """
     
-    kwargs['in_value'].append(kwargs['value'])
-    kwargs['in_time'].append(kwargs['timestamp'])
+    kwargs['in_buffer'].append(kwargs['value'], kwargs['timestamp'])
 
 def launch_server():
     '''
@@ -606,24 +554,31 @@ def launch_server():
     
     # Get data
     beam = FakeBeam()
-    ipm2List = deque(maxlen=maxlen)
-    ipm3List = deque(maxlen=maxlen)
-    ebeamList = deque(maxlen=maxlen)
-    ipm2TimeStamp = deque(maxlen=maxlen)
-    ipm3TimeStamp = deque(maxlen=maxlen)
-    ebeamTimeStamp = deque(maxlen=maxlen)
+    ipm2 = RingBuffer(maxlen)
+    ipm3 = RingBuffer(maxlen)
+    ebeam = RingBuffer(maxlen)
+    
+    # Rolling median and its min/max envelope, shared by every session
+    rolling = {
+        'ipm2':RollingWindow(120, source=ipm2),
+        'ipm3':RollingWindow(120, source=ipm3)
+    }
+    envelope = {
+        'ipm2':EnvelopePyramid(rolling['ipm2'].median),
+        'ipm3':EnvelopePyramid(rolling['ipm3'].median)
+    }
     
     # Subscribe to devices
     beam.fake_ipm2.subscribe(
-        partial(new_data, in_value=ipm2List, in_time=ipm2TimeStamp)
+        partial(new_data, in_buffer=ipm2)
     )
 
     beam.fake_ipm3.subscribe(
-        partial(new_data, in_value=ipm3List, in_time=ipm3TimeStamp)
+        partial(new_data, in_buffer=ipm3)
     )
 
     beam.fake_L3.subscribe(
-        partial(new_data, in_value=ebeamList, in_time=ebeamTimeStamp)
+        partial(new_data, in_buffer=ebeam)
     )
     
     origins = ["localhost:{}".format(5006)]
@@ -632,32 +587,25 @@ def launch_server():
         {
             '/Hextiles': partial(
                 produce_hex,
-                ipm2List=ipm2List,
-                ipm3List=ipm3List,
-                ebeamList=ebeamList,
-                ipm2TS=ipm2TimeStamp,
-                ipm3TS=ipm3TimeStamp,
-                ebeamTS=ebeamTimeStamp#,
+                ipm2=ipm2,
+                ipm3=ipm3,
+                ebeam=ebeam#,
                 #streamHex=streamHex
             ),
             '/Contour': partial(
                 produce_scatter_on_background,
-                ipm2List=ipm2List,
-                ipm3List=ipm3List,
-                ebeamList=ebeamList,
-                ipm2TS=ipm2TimeStamp,
-                ipm3TS=ipm3TimeStamp,
-                ebeamTS=ebeamTimeStamp#,
+                ipm2=ipm2,
+                ipm3=ipm3,
+                ebeam=ebeam#,
                 #streamHex=streamHex
             ),
             '/Time_History': partial(
                 produce_timehistory,
-                ipm2List=ipm2List,
-                ipm3List=ipm3List,
-                ebeamList=ebeamList,
-                ipm2TS=ipm2TimeStamp,
-                ipm3TS=ipm3TimeStamp,
-                ebeamTS=ebeamTimeStamp#,
+                ipm2=ipm2,
+                ipm3=ipm3,
+                ebeam=ebeam,
+                rolling=rolling,
+                envelope=envelope#,
                 #streamHex=streamHex
             )
         },
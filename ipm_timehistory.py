@@ -13,8 +13,11 @@ from bokeh.application import Application
 import tables
 from fake_beam import FakeBeam
 from functools import partial
-from collections import deque
-from event_builder import basic_event_builder
+from ring_buffer import RingBuffer
+from streaming_stats import QuantileRange
+from rolling import RollingWindow
+from histogram import Histogram2D
+from event_builder import asof_event_builder, StreamingEventBuilder
 from holoviews.streams import Buffer
 from holoviews.core import util
 import time
@@ -39,39 +42,33 @@ def apply_formatter(plot, element):
         months=['%D %H:%M:%S'], 
         years=['%D %H:%M:%S'])
 
-def gen_background(df):
+def gen_background(counts, bounds, names):
     """
-    Return holoviews contour plot based on image generated from data
+    Return holoviews contour plot of a 2D histogram of events
     
     Parameters
     ----------
     
-    df: pandas.DataFrame
-        DataFrame containing data to be ploted on contour plot
+    counts: numpy.array
+        Histogram counts laid out like an image, from Histogram2D.image()
+        
+    bounds: tuple
+        Left, bottom, right and top edges of the histogram
+        
+    names: tuple
+        Names of the x and y channels
         
     """
     
-    colNames = list(df)
-    ebeamL3 = df[colNames[0]].astype(float)
-    ipmValue = df[colNames[1]].astype(float)
-   
-    #Reverse xbins array to provide the correct y-axis (otherwise it's flipped)
-    xbinsReversed = np.linspace(np.percentile(ipmValue, 1), np.percentile(ipmValue, 99),30)
-    xbins = xbinsReversed[::-1]
-    ybins = np.linspace(np.percentile(ebeamL3, 1), np.percentile(ebeamL3, 99), 30)
-    ind0 = np.digitize(ipmValue, xbins)
-    ind1 = np.digitize(ebeamL3, ybins)
-    ind2d = np.ravel_multi_index((ind0,ind1), (ybins.shape[0]+1, xbins.shape[0]+1))
-    iSig = np.bincount(ind2d, minlength=(xbins.shape[0]+1)*(ybins.shape[0]+1)).reshape(xbins.shape[0]+1, ybins.shape[0]+1)
-    low = np.percentile(iSig, 1)
-    high = np.percentile(iSig, 99)
+    low = np.percentile(counts, 1)
+    high = np.percentile(counts, 99)
     
     # Changing axis names so they don't match HexTiles names
-    x = colNames[0] + " Contour"
-    y = colNames[1] + " Contour"
+    x = names[0] + " Contour"
+    y = names[1] + " Contour"
     
     img_less_bins = hv.Image(
-        iSig, bounds=(ybins[0], xbins[0], ybins[-1], xbins[-1]), kdims=[x, y]).options(
+        counts, bounds=bounds, kdims=[x, y]).options(
         show_legend=False).redim.range(
         z=(low, high))
     
@@ -80,28 +77,33 @@ def gen_background(df):
         cmap='fire').opts(
         norm=dict(framewise=True))
 
-def gen_hex(df):
+def gen_hex(df, ranges=None):
     """
     Return holoviews HexTiles plot
     
     Parameters
     ----------
     
-    df: pandas.DataFrame
-        DataFrame containing data to be ploted on hextiles plot
+    df: pandas.DataFrame or dict
+        DataFrame or dictionary of column arrays containing data to be
+        ploted on hextiles plot
+    
+    ranges: dict
+        (low, high) axis range of each column, e.g. from a QuantileRange.
+        Defaults to the 1% and 99% quantiles of df.
     
     """
     
     # Get bounds for graph
     colNames = list(df)
-    lowX = df[colNames[0]].quantile(0.01)
-    highX = df[colNames[0]].quantile(0.99)
-    lowY = df[colNames[1]].quantile(0.01)
-    highY = df[colNames[1]].quantile(0.99)
-    
-    return hv.HexTiles(df, group="Number of events: " + str(len(df.index))).redim.range(
-        ebeam=(lowX, highX), 
-        ipm2 = (lowY, highY)).opts(
+    if ranges is None:
+        ranges = dict((name, (pd.Series(df[name]).quantile(0.01), pd.Series(df[name]).quantile(0.99)))
+                      for name in colNames)
+    
+    count = len(df[colNames[0]])
+    return hv.HexTiles(df, kdims=colNames, group="Number of events: " + str(count)).redim.range(
+        ebeam=ranges[colNames[0]], 
+        ipm2 = ranges[colNames[1]]).opts(
         norm=dict(framewise=True))
 
 def gen_scatter(df):
@@ -118,7 +120,7 @@ def gen_scatter(df):
     print(df.head())
     return hv.Scatter(df).options(size=10, tools=['hover'], apply_ranges=False)
     
-def produce_timehistory(doc, ipm2List, ipm3List, ebeamList, ipm2TS, ipm3TS, ebeamTS):
+def produce_timehistory(doc, ipm2, ipm3, ebeam, rolling):
     # Streams
     
     # See if you can limit the buffer
@@ -127,6 +129,10 @@ def produce_timehistory(doc, ipm2List, ipm3List, ebeamList, ipm2TS, ipm3TS, ebea
     
     switch_key = 'ipm2'
     
+    # Sequence numbers of the next median and std the plots haven't shown
+    median_seq = 0
+    std_seq = 0
+    
     # Generate dynamic map
     
     plot_ipm_b = hv.DynamicMap(
@@ -152,19 +158,20 @@ def produce_timehistory(doc, ipm2List, ipm3List, ebeamList, ipm2TS, ipm3TS, ebea
     
     # For pushing in data, maybe cut off first 119 points to get rid of those weird extremes
     def push_data(stream):
-                
-        if switch_key == 'ipm2':
-            ipm_plot = list(ipm2List)
-            timestamp_plot = list(ipm2TS)
-        elif switch_key == 'ipm3':
-            ipm_plot = list(ipm3List)
-            timestamp_plot = list(ipm3TS)
-    
-        times = [1000*time for time in timestamp_plot]
-        ipmData = pd.Series(ipm_plot, index=times)
         
-        zipped = basic_event_builder(ipm=ipmData)
-        median = zipped.rolling(120, min_periods=1).median()
+        nonlocal median_seq
+        
+        # Shared engine only computes the median of samples it hasn't seen yet,
+        # and only medians the plot hasn't shown are read
+        rollingWindow = rolling[switch_key]
+        rollingWindow.update()
+        median_plot, timestamp_plot, median_seq = rollingWindow.median.since(median_seq)
+        if len(median_plot) == 0:
+            return
+    
+        # Convert ns timestamps to ms so bokeh formatter can get correct datetime
+        times = timestamp_plot/1e6
+        median = pd.DataFrame({'ipm':median_plot}, index=times)
         
         # This might be making it take a long time to switch 
         if type(stream) == hv.streams.Buffer:
@@ -196,21 +203,18 @@ def produce_timehistory(doc, ipm2List, ipm3List, ebeamList, ipm2TS, ipm3TS, ebea
             stream.event(df=median) 
             
     def push_std(stream):
-        if switch_key == 'ipm2':
-            ipm_plot = list(ipm2List)
-            timestamp_plot = list(ipm2TS)
-        elif switch_key == 'ipm3':
-            ipm_plot = list(ipm3List)
-            timestamp_plot = list(ipm3TS)
-        
-        times = [1000*time for time in timestamp_plot]
-        ipmData = pd.Series(ipm_plot, index=times)
-        
-        zipped = basic_event_builder(ipm=ipmData)
-        median = zipped.rolling(120, min_periods=1).median()
-        std = zipped.rolling(120, min_periods=1).std()
-        lowerbound = median - std
-        higherbound = median + std
+        nonlocal std_seq
+        
+        rollingWindow = rolling[switch_key]
+        rollingWindow.update()
+        median_plot, timestamp_plot, _ = rollingWindow.median.since(std_seq)
+        std_plot, _, std_seq = rollingWindow.std.since(std_seq)
+        if len(std_plot) == 0:
+            return
+        
+        times = timestamp_plot/1e6
+        lowerbound = pd.DataFrame({'ipm':median_plot - std_plot}, index=times)
+        higherbound = pd.DataFrame({'ipm':median_plot + std_plot}, index=times)
         df = pd.DataFrame({'lowerbound':lowerbound['ipm'], 'higherbound':higherbound['ipm']})
         
         if len(df) > 1000:
@@ -256,9 +260,12 @@ def produce_timehistory(doc, ipm2List, ipm3List, ebeamList, ipm2TS, ipm3TS, ebea
         
         """
         
-        nonlocal switch_key
+        nonlocal switch_key, median_seq, std_seq
         switch_key = select.value
         clear_buffer()
+        
+        # Start the new channel from its whole history again
+        median_seq = std_seq = 0
         print("Yes!")
         
         
@@ -282,7 +289,7 @@ def produce_timehistory(doc, ipm2List, ipm3List, ebeamList, ipm2TS, ipm3TS, ebea
     doc.title = "Time History Graphs"
     doc.add_root(plot)
     
-def produce_hex(doc, ipm2List, ipm3List, ebeamList, ipm2TS, ipm3TS, ebeamTS): 
+def produce_hex(doc, ipm2, ipm3, ebeam): 
     """
     Produce updating hextiles plot and push them onto the web page document.
     User may save current data, clear existing data, or pause the graph. User
@@ -294,41 +301,28 @@ def produce_hex(doc, ipm2List, ipm3List, ebeamList, ipm2TS, ipm3TS, ebeamTS):
     doc: bokeh.document (I think)
         Bokeh document to be displayed on webpage
     
-    ipm2List: deque
-        Deque containing updating ipm2 values
+    ipm2: RingBuffer
+        Ring buffer containing updating ipm2 values and timestamps
         
-    ipm3List: deque
-        Deque containing updating ipm3 values
-    
-    ebeamList: deque
-        Deque containing updating ebeam values
-    
-    ipm2TS: deque
-        Deque containing updating ipm2 timestamps
-    
-    ipm3TS: deque
-        Deque containing updating ipm3 timestamps
+    ipm3: RingBuffer
+        Ring buffer containing updating ipm3 values and timestamps
     
-    ebeamTS: deque
-        Deque containing updating ebeam timestamps
+    ebeam: RingBuffer
+        Ring buffer containing updating ebeam values and timestamps
     
     """
     
-    # Create copy of deques for each instance of server
-    ipm2_plot = list(ipm2List)
-    ipm3_plot = list(ipm3List)
-    ebeam_plot = list(ebeamList)
-    ipm2TS_plot = list(ipm2TS)
-    ipm3TS_plot = list(ipm3TS)
-    ebeamTS_plot = list(ebeamTS)
+    # Each instance of server builds events from its own cursors into the ring buffers
+    eventBuilder = StreamingEventBuilder(ipm2=ipm2, ipm3=ipm3, ebeam=ebeam)
     
-    ipm2_index, ipm3_index, ebeam_index, ipm2TS_index, ipm3TS_index, ebeamTS_index = (0, 0, 0, 0, 0, 0)
+    # 1% and 99% quantiles of each channel for the axis ranges, fed with new events only
+    ranges = QuantileRange(['ebeam', 'ipm2', 'ipm3'])
     
     # Streams
     streamHex = hv.streams.Stream.define(
         'df', df=pd.DataFrame({
             'ebeam':[], 'ipm2':[]
-        }))()
+        }), ranges=None)()
     
     # Generate dynamic map
     plot = hv.DynamicMap(
@@ -343,23 +337,31 @@ def produce_hex(doc, ipm2List, ipm3List, ebeamList, ipm2TS, ipm3TS, ebeamTS):
     
     # Initialize values that can be updated by widgets
     switch_key_hex = 'ipm2'
-    paused_list = pd.DataFrame({'ebeam':[], 'ipm2':[], 'ipm3':[]})
     
-    def clear():
+    # Events since the last clear, at most as many as the ring buffers hold.
+    # The plot gets views of them instead of a new copy of the history every tick.
+    columns = ['ebeam', 'ipm2', 'ipm3']
+    events = RingBuffer(ebeam.maxlen, shape=(len(columns),))
+    
+    def hex_data():
+        """
+        Return views of the ebeam and selected ipm columns of the events
+        
         """
-        "Clear" graphs and particular lists of server instance. Save current index
-        and only plot points after that index.
         
+        values, _ = events.last()
+        return {'ebeam': values[:, 0], switch_key_hex: values[:, columns.index(switch_key_hex)]}
+    
+    def clear():
         """
+        "Clear" graphs and particular lists of server instance. Skip everything
+        received so far and only plot events after that.
         
-        nonlocal ipm2_index, ipm3_index, ebeam_index, ipm2TS_index, ipm3TS_index, ebeamTS_index
+        """
         
-        ipm2_index = len(ipm2List)
-        ipm3_index = len(ipm3List)
-        ebeam_index = len(ebeamList)
-        ipm2TS_index = len(ipm2TS)
-        ipm3TS_index = len(ipm3TS)
-        ebeamTS_index = len(ebeamTS)
+        eventBuilder.reset()
+        ranges.clear()
+        events.clear()
         
     def push_data():
         """
@@ -367,23 +369,20 @@ def produce_hex(doc, ipm2List, ipm3List, ebeamList, ipm2TS, ipm3TS, ebeamTS):
         
         """
         
-        nonlocal ipm2_plot, ipm3_plot, ebeam_plot, ipm2TS_plot, ipm3TS_plot, ebeamTS_plot, paused_list
+        # Only join what arrived since the last tick
+        newEvents = eventBuilder.build()
+        ranges.add(newEvents)
+        if len(newEvents.index):
+            events.extend(newEvents[columns].values, np.asarray(newEvents.index, dtype=np.float64)/1e9)
+        streamHex.event(df=hex_data(), ranges=axis_ranges())
+    
+    def axis_ranges():
+        """
+        Return the since-clear axis range of each channel
         
-        ipm2_plot = list(ipm2List)[ipm2_index:]
-        ipm3_plot = list(ipm3List)[ipm3_index:]
-        ebeam_plot = list(ebeamList)[ebeam_index:]
-        ipm2TS_plot = list(ipm2TS)[ipm2TS_index:]
-        ipm3TS_plot = list(ipm3TS)[ipm3TS_index:]
-        ebeamTS_plot = list(ebeamTS)[ebeamTS_index:]
+        """
         
-        ipm2Data = pd.Series(ipm2_plot, index=ipm2TS_plot)
-        ipm3Data = pd.Series(ipm3_plot, index=ipm3TS_plot)
-        ebeamData = pd.Series(ebeam_plot, index=ebeamTS_plot)
-        zipped = basic_event_builder(ipm2=ipm2Data, ipm3=ipm3Data, ebeam=ebeamData)
-        data = zipped[['ebeam', switch_key_hex]]
-        paused_list = zipped
-        #print(zipped)
-        streamHex.event(df=data)
+        return dict((name, ranges.range(name)) for name in ranges.names)
     
     def play_graph():
         """
@@ -405,11 +404,8 @@ def produce_hex(doc, ipm2List, ipm3List, ebeamList, ipm2TS, ipm3TS, ebeamTS):
         
         """
         
-        ipm2Data = pd.Series(ipm2_plot, index=ipm2TS_plot)
-        ipm3Data = pd.Series(ipm3_plot, index=ipm3TS_plot)
-        ebeamData = pd.Series(ebeam_plot, index=ebeamTS_plot)
-        zipped = basic_event_builder(ipm2=ipm2Data, ipm3=ipm3Data, ebeam=ebeamData)
-        zipped.to_csv('data2.csv')
+        values, timestamps = events.last()
+        pd.DataFrame(values, index=timestamps, columns=columns).to_csv('data2.csv')
     
     # Need to add function to switch while paused as well
     
@@ -424,7 +420,7 @@ def produce_hex(doc, ipm2List, ipm3List, ebeamList, ipm2TS, ipm3TS, ebeamTS):
         
     def switch_on_pause(attr, old, new):
         if startButton.label == '► Play':
-            streamHex.event(df=paused_list[['ebeam', switch_key_hex]])
+            streamHex.event(df=hex_data(), ranges=axis_ranges())
     
     callback_id_hex = doc.add_periodic_callback(push_data, 1000)
     
@@ -454,7 +450,7 @@ def produce_hex(doc, ipm2List, ipm3List, ebeamList, ipm2TS, ipm3TS, ebeamTS):
     doc.title = "Hextiles Graph"
     doc.add_root(plot)
     
-def produce_scatter_on_background(doc, ipm2List, ipm3List, ebeamList, ipm2TS, ipm3TS, ebeamTS):
+def produce_scatter_on_background(doc, ipm2, ipm3, ebeam, backgrounds):
     """
     Produce background plot with updating scatter plot on top of it 
     and push them onto the web page document. User can control how many
@@ -467,35 +463,26 @@ def produce_scatter_on_background(doc, ipm2List, ipm3List, ebeamList, ipm2TS, ip
     doc: bokeh.document (I think)
         Bokeh document to be displayed on webpage
     
-    ipm2List: deque
-        Deque containing updating ipm2 values
+    ipm2: RingBuffer
+        Ring buffer containing updating ipm2 values and timestamps
         
-    ipm3List: deque
-        Deque containing updating ipm3 values
-    
-    ebeamList: deque
-        Deque containing updating ebeam values
+    ipm3: RingBuffer
+        Ring buffer containing updating ipm3 values and timestamps
     
-    ipm2TS: deque
-        Deque containing updating ipm2 timestamps
+    ebeam: RingBuffer
+        Ring buffer containing updating ebeam values and timestamps
     
-    ipm3TS: deque
-        Deque containing updating ipm3 timestamps
-    
-    ebeamTS: deque
-        Deque containing updating ebeam timestamps
+    backgrounds: dict
+        Histogram2D of ebeam against each ipm, shared by every session
     
     """
     
-    # Interesting error, background doesn't seem to update after running multiple instances 
-    # to the latest version and starts off with the data the first instance was given. 
-    # Need to figure out why!
-    
-    curBackData = pd.read_csv('data2.csv', index_col='Unnamed: 0')
+    # Background drawn from the histogram shared by every session
+    counts, bounds = backgrounds['ipm2'].image()
     
     # Streams
     streamContour = hv.streams.Stream.define(
-        'df', df=curBackData)()
+        'Histogram', counts=counts, bounds=bounds, names=('ebeam', 'ipm2'))()
 
     streamScatter = hv.streams.Stream.define(
         'df', df=pd.DataFrame({
@@ -524,6 +511,10 @@ def produce_scatter_on_background(doc, ipm2List, ipm3List, ebeamList, ipm2TS, ip
     limit = 50
     paused_list = pd.DataFrame({'ebeam':[], 'ipm2':[], 'ipm3':[]})
     
+    # Largest timestamp difference (ns) between PVs still counted as one event,
+    # about half the spacing of 120 Hz shots
+    tolerance = 4000000
+    
     def scatter_tick():
         """
         Push new scatter points into stream to plot.
@@ -534,18 +525,19 @@ def produce_scatter_on_background(doc, ipm2List, ipm3List, ebeamList, ipm2TS, ip
         # Still has the freezing points error, though, it seems to come more frequently. 
         # This may be a bigger problem now
         
-        ebeamConverted = list(ebeamList)
-        ipm2Converted = list(ipm2List)
-        ipm3Converted = list(ipm3List)
-        ebeamTimeConverted = list(ebeamTS)
-        ipm2TimeConverted = list(ipm2TS)
-        ipm3TimeConverted = list(ipm3TS)
+        for hist in backgrounds.values():
+            hist.update()
+        
+        ebeamConverted, ebeamTimeConverted = ebeam.last(limit)
+        ipm2Converted, ipm2TimeConverted = ipm2.last(limit)
+        ipm3Converted, ipm3TimeConverted = ipm3.last(limit)
 
-        ipm2Data = pd.Series(ipm2Converted[-limit:], index=ipm2TimeConverted[-limit:])
-        ipm3Data = pd.Series(ipm3Converted[-limit:], index=ipm3TimeConverted[-limit:])
-        ebeamData = pd.Series(ebeamConverted[-limit:], index=ebeamTimeConverted[-limit:])
+        ipm2Data = pd.Series(ipm2Converted, index=ipm2TimeConverted)
+        ipm3Data = pd.Series(ipm3Converted, index=ipm3TimeConverted)
+        ebeamData = pd.Series(ebeamConverted, index=ebeamTimeConverted)
         
-        zipped = basic_event_builder(ipm2=ipm2Data, ipm3=ipm3Data, ebeam=ebeamData)
+        zipped, _ = asof_event_builder(
+            ebeam=ebeamData, ipm2=ipm2Data, ipm3=ipm3Data, tolerance=tolerance)
 
         scatterList = zipped[-limit:]
         
@@ -572,15 +564,25 @@ def produce_scatter_on_background(doc, ipm2List, ipm3List, ebeamList, ipm2TS, ip
         nonlocal switch_key_scatter
         switch_key_scatter = select.value
     
+    def draw_background():
+        """
+        Bring the histogram of the selected ipm up to date and redraw the
+        contour plot from it
+        
+        """
+        
+        hist = backgrounds[switch_key_scatter]
+        hist.update()
+        counts, bounds = hist.image()
+        streamContour.event(counts=counts, bounds=bounds, names=('ebeam', switch_key_scatter))
+    
     def switch_background(attr, old, new):
         """
         Switch background when drop down menu value is updated
         
         """
         
-        nonlocal curBackData
-        data = curBackData[['ebeam', switch_key_scatter]]
-        streamContour.event(df=data)
+        draw_background()
         
     def switch_on_pause(attr, old, new):
         if startButton.label == '► Play':
@@ -595,12 +597,7 @@ def produce_scatter_on_background(doc, ipm2List, ipm3List, ebeamList, ipm2TS, ip
         
         """
         
-        nonlocal curBackData
-        newData = pd.read_csv('data2.csv', index_col='Unnamed: 0')
-        curBackData = newData
-        data = newData[['ebeam', switch_key_scatter]]
-        
-        streamContour.event(df=data)
+        draw_background()
         
     def play_graph():
         """
@@ -642,12 +639,11 @@ def produce_scatter_on_background(doc, ipm2List, ipm3List, ebeamList, ipm2TS, ip
 
 def new_data(*args, **kwargs):
     """
-    Append data from subscribe into data containers
+    Append data from subscribe into ring buffer
     
     """
     
-    kwargs['in_value'].append(kwargs['value'])
-    kwargs['in_time'].append(kwargs['timestamp'])
+    kwargs['in_buffer'].append(kwargs['value'], kwargs['timestamp'])
 
 def launch_server():
     '''
@@ -662,58 +658,60 @@ def launch_server():
     
     # Get data
     beam = FakeBeam()
-    ipm2List = deque(maxlen=maxlen)
-    ipm3List = deque(maxlen=maxlen)
-    ebeamList = deque(maxlen=maxlen)
-    ipm2TimeStamp = deque(maxlen=maxlen)
-    ipm3TimeStamp = deque(maxlen=maxlen)
-    ebeamTimeStamp = deque(maxlen=maxlen)
+    ipm2 = RingBuffer(maxlen)
+    ipm3 = RingBuffer(maxlen)
+    ebeam = RingBuffer(maxlen)
+    
+    # Rolling median/std shared by every time history session
+    rolling = {
+        'ipm2':RollingWindow(120, source=ipm2),
+        'ipm3':RollingWindow(120, source=ipm3)
+    }
     
     # Subscribe to devices
     beam.fake_ipm2.subscribe(
-        partial(new_data, in_value=ipm2List, in_time=ipm2TimeStamp)
+        partial(new_data, in_buffer=ipm2)
     )
 
     beam.fake_ipm3.subscribe(
-        partial(new_data, in_value=ipm3List, in_time=ipm3TimeStamp)
+        partial(new_data, in_buffer=ipm3)
     )
 
     beam.fake_L3.subscribe(
-        partial(new_data, in_value=ebeamList, in_time=ebeamTimeStamp)
+        partial(new_data, in_buffer=ebeam)
     )
     
+    # Background histograms shared by every contour session
+    backgrounds = {
+        'ipm2':Histogram2D(source=StreamingEventBuilder(ebeam=ebeam, ipm2=ipm2), columns=('ebeam', 'ipm2')),
+        'ipm3':Histogram2D(source=StreamingEventBuilder(ebeam=ebeam, ipm3=ipm3), columns=('ebeam', 'ipm3'))
+    }
+    
     origins = ["localhost:{}".format(5006)]
     
     server = Server(
         {
             '/Hextiles': partial(
                 produce_hex,
-                ipm2List=ipm2List,
-                ipm3List=ipm3List,
-                ebeamList=ebeamList,
-                ipm2TS=ipm2TimeStamp,
-                ipm3TS=ipm3TimeStamp,
-                ebeamTS=ebeamTimeStamp#,
+                ipm2=ipm2,
+                ipm3=ipm3,
+                ebeam=ebeam#,
                 #streamHex=streamHex
             ),
             '/Contour': partial(
                 produce_scatter_on_background,
-                ipm2List=ipm2List,
-                ipm3List=ipm3List,
-                ebeamList=ebeamList,
-                ipm2TS=ipm2TimeStamp,
-                ipm3TS=ipm3TimeStamp,
-                ebeamTS=ebeamTimeStamp#,
+                ipm2=ipm2,
+                ipm3=ipm3,
+                ebeam=ebeam,
+                backgrounds=backgrounds#,
                 #streamHex=streamHex
             ),
             '/Time_History': partial(
                 produce_timehistory,
-                ipm2List=ipm2List,
-                ipm3List=ipm3List,
-                ebeamList=ebeamList,
-                ipm2TS=ipm2TimeStamp,
-                ipm3TS=ipm3TimeStamp,
-                ebeamTS=ebeamTimeStamp#,
+                ipm2=ipm2,
+                ipm3=ipm3,
+                ebeam=ebeam,
+                rolling=rolling#,
                 #streamHex=streamHex
             )
         },
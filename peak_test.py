@@ -13,12 +13,14 @@ from bokeh.application import Application
 import tables
 from fake_peaks import FakeBeam
 from functools import partial
-from collections import deque
+from ring_buffer import RingBuffer
+from rolling import RollingWindow
 from event_builder import basic_event_builder
 from holoviews.streams import Buffer
 from holoviews.core import util
 from holoviews.operation.datashader import datashade, dynspread
 from holoviews.operation import decimate
+from downsample import downsample
 
 import time
 
@@ -54,7 +56,7 @@ def gen_labels(df):
     
     return labels
     
-def produce_timehistory(doc, peak, peakTS):
+def produce_timehistory(doc, peak, rolling):
     # Streams
     
     # See if you can limit the buffer
@@ -102,7 +104,8 @@ def produce_timehistory(doc, peak, peakTS):
     #.opts(norm=dict(framewise=True))
     test2 = datashade(plot_peak_std_high, streams=[hv.streams.PlotSize], normalization='linear')
     #.opts(norm=dict(framewise=True))
-    pointTest = decimate(plot_peak_b, streams=[hv.streams.PlotSize], normalization='linear')
+    # M4 keeps the spikes that decimate would randomly drop
+    pointTest = downsample(plot_peak_b, streams=[hv.streams.PlotSize, hv.streams.RangeX])
     
     
     # Scrolling after pausing the graph seems to cause Parameter name clashes for keys: {'height', 'width', 'scale'} error!
@@ -120,22 +123,26 @@ def produce_timehistory(doc, peak, peakTS):
     labels = ['Test 1', 'Test 2']
     medianCheck = 0
     
+    # Sequence number of the next median and std the plot hasn't shown
+    median_seq = 0
+    
     # For pushing in data, maybe cut off first 119 points to get rid of those weird extremes
     def push_data(stream):
+        
+        nonlocal median_seq
                 
-        TS_key = switch_key + '_TS'
-        data = list(peak[switch_key])
-        timestamp = list(peakTS[TS_key])
+        # Shared engine only computes results for samples it hasn't seen yet,
+        # and only results the plot hasn't shown are read
+        rollingWindow = rolling[switch_key]
+        rollingWindow.update()
+        median, timestamp, _ = rollingWindow.median.since(median_seq)
+        std, _, median_seq = rollingWindow.std.since(median_seq)
+        if len(std) == 0:
+            return
        
-        times = [1000*time for time in timestamp]
-        dataSeries = pd.Series(data, index=times)
-        
-        zipped = basic_event_builder(peak=dataSeries)
-        median = zipped.rolling(120, min_periods=1).median()
-        std = zipped.rolling(120, min_periods=1).std()
-        lowerbound = median - std
-        higherbound = median + std
-        df = pd.DataFrame({'peak':median['peak'], 'lowerbound':lowerbound['peak'], 'higherbound':higherbound['peak']})
+        # Convert ns timestamps to ms so bokeh formatter can get correct datetime
+        times = timestamp/1e6
+        df = pd.DataFrame({'peak':median, 'lowerbound':median - std, 'higherbound':median + std}, index=times)
         
         stream.send(df)
     
@@ -157,8 +164,7 @@ def produce_timehistory(doc, peak, peakTS):
 
         # Need to clear the buffers somehow to stop weird overlapping
         height = [1]
-        data = list(peak[switch_key])
-        dataSeries = pd.Series(data)
+        dataSeries = pd.Series(peak[switch_key].values)
         median = [dataSeries.median()]
 
         if median == medianCheck:
@@ -203,9 +209,12 @@ def produce_timehistory(doc, peak, peakTS):
         
         """
         
-        nonlocal switch_key
+        nonlocal switch_key, median_seq
         switch_key = select.value
         clear_buffer()
+        
+        # Start the new channel from its whole history again
+        median_seq = 0
         print("Yes!")
     
     def play_graph():
@@ -274,12 +283,11 @@ def produce_timehistory(doc, peak, peakTS):
 
 def new_data(*args, **kwargs):
     """
-    Append data from subscribe into data containers
+    Append data from subscribe into ring buffer
     
     """
     
-    kwargs['in_value'].append(kwargs['value'])
-    kwargs['in_time'].append(kwargs['timestamp'])
+    kwargs['in_buffer'].append(kwargs['value'], kwargs['timestamp'])
 
 def launch_server():
     '''
@@ -295,54 +303,46 @@ def launch_server():
     
     # Get data
     beam = FakeBeam()
-    peak_8 = deque(maxlen=maxlen)
-    peak_8_TS = deque(maxlen=maxlen)
-    peak_9 = deque(maxlen=maxlen)
-    peak_9_TS = deque(maxlen=maxlen)
-    peak_10 = deque(maxlen=maxlen)
-    peak_10_TS = deque(maxlen=maxlen)
-    peak_11 = deque(maxlen=maxlen)
-    peak_11_TS = deque(maxlen=maxlen)
-    peak_12 = deque(maxlen=maxlen)
-    peak_12_TS = deque(maxlen=maxlen)
-    peak_13 = deque(maxlen=maxlen)
-    peak_13_TS = deque(maxlen=maxlen)
-    peak_14 = deque(maxlen=maxlen)
-    peak_14_TS = deque(maxlen=maxlen)
-    peak_15 = deque(maxlen=maxlen)
-    peak_15_TS = deque(maxlen=maxlen)
+    peak_8 = RingBuffer(maxlen)
+    peak_9 = RingBuffer(maxlen)
+    peak_10 = RingBuffer(maxlen)
+    peak_11 = RingBuffer(maxlen)
+    peak_12 = RingBuffer(maxlen)
+    peak_13 = RingBuffer(maxlen)
+    peak_14 = RingBuffer(maxlen)
+    peak_15 = RingBuffer(maxlen)
     
     # Subscribe to devices
     beam.peak_8.subscribe(
-        partial(new_data, in_value=peak_8, in_time=peak_8_TS)
+        partial(new_data, in_buffer=peak_8)
     )
     
     beam.peak_9.subscribe(
-        partial(new_data, in_value=peak_9, in_time=peak_9_TS)
+        partial(new_data, in_buffer=peak_9)
     )
     
     beam.peak_10.subscribe(
-        partial(new_data, in_value=peak_10, in_time=peak_10_TS)
+        partial(new_data, in_buffer=peak_10)
     )
     
     beam.peak_11.subscribe(
-        partial(new_data, in_value=peak_11, in_time=peak_11_TS)
+        partial(new_data, in_buffer=peak_11)
     )
     
     beam.peak_12.subscribe(
-        partial(new_data, in_value=peak_12, in_time=peak_12_TS)
+        partial(new_data, in_buffer=peak_12)
     )
     
     beam.peak_13.subscribe(
-        partial(new_data, in_value=peak_13, in_time=peak_13_TS)
+        partial(new_data, in_buffer=peak_13)
     )
     
     beam.peak_14.subscribe(
-        partial(new_data, in_value=peak_14, in_time=peak_14_TS)
+        partial(new_data, in_buffer=peak_14)
     )
     
     beam.peak_15.subscribe(
-        partial(new_data, in_value=peak_15, in_time=peak_15_TS)
+        partial(new_data, in_buffer=peak_15)
     )
     
     peakDict = {
@@ -355,17 +355,10 @@ def launch_server():
         'peak_14':peak_14,
         'peak_15':peak_15
     }
-    peakTSDict = {
-        'peak_8_TS':peak_8_TS, 
-        'peak_9_TS':peak_9_TS, 
-        'peak_10_TS':peak_10_TS, 
-        'peak_11_TS':peak_11_TS, 
-        'peak_12_TS':peak_12_TS, 
-        'peak_13_TS':peak_13_TS,
-        'peak_14_TS':peak_14_TS,
-        'peak_15_TS':peak_15_TS
-    }
-
+    
+    # Rolling median/std shared by every session
+    rolling = {name: RollingWindow(120, source=buf) for name, buf in peakDict.items()}
+    
     origins = ["localhost:{}".format(5006)]
     
     server = Server(
@@ -373,7 +366,7 @@ def launch_server():
             '/Time_History': partial(
                 produce_timehistory,
                 peak=peakDict,
-                peakTS=peakTSDict
+                rolling=rolling
             )
         },
         allow_websocket_origin=origins,
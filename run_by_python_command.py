@@ -13,44 +13,40 @@ from bokeh.application import Application
 import tables
 from fake_beam import FakeBeam
 from functools import partial
-from collections import deque
-from event_builder import basic_event_builder
+from ring_buffer import RingBuffer
+from streaming_stats import QuantileRange
+from event_builder import basic_event_builder, StreamingEventBuilder
+from histogram import Histogram2D
 
 renderer = hv.renderer('bokeh').instance(mode='server')
 
-def gen_background(df):
+def gen_background(counts, bounds, names):
     """
-    Return holoviews contour plot based on image generated from data
+    Return holoviews contour plot of a 2D histogram of events
     
     Parameters
     ----------
     
-    df: pandas.DataFrame
-        DataFrame containing data to be ploted on contour plot
+    counts: numpy.array
+        Histogram counts laid out like an image, from Histogram2D.image()
+        
+    bounds: tuple
+        Left, bottom, right and top edges of the histogram
+        
+    names: tuple
+        Names of the x and y channels
         
     """
     
-    colNames = list(df)
-    ebeamL3 = df[colNames[0]].astype(float)
-    ipmValue = df[colNames[1]].astype(float)
-   
-    #Reverse xbins array to provide the correct y-axis (otherwise it's flipped)
-    xbinsReversed = np.linspace(np.percentile(ipmValue, 1), np.percentile(ipmValue, 99),30)
-    xbins = xbinsReversed[::-1]
-    ybins = np.linspace(np.percentile(ebeamL3, 1), np.percentile(ebeamL3, 99), 30)
-    ind0 = np.digitize(ipmValue, xbins)
-    ind1 = np.digitize(ebeamL3, ybins)
-    ind2d = np.ravel_multi_index((ind0,ind1), (ybins.shape[0]+1, xbins.shape[0]+1))
-    iSig = np.bincount(ind2d, minlength=(xbins.shape[0]+1)*(ybins.shape[0]+1)).reshape(xbins.shape[0]+1, ybins.shape[0]+1)
-    low = np.percentile(iSig, 1)
-    high = np.percentile(iSig, 99)
+    low = np.percentile(counts, 1)
+    high = np.percentile(counts, 99)
     
     # Changing axis names so they don't match HexTiles names
-    x = colNames[0] + " Contour"
-    y = colNames[1] + " Contour"
+    x = names[0] + " Contour"
+    y = names[1] + " Contour"
     
     img_less_bins = hv.Image(
-        iSig, bounds=(ybins[0], xbins[0], ybins[-1], xbins[-1]), kdims=[x, y]).options(
+        counts, bounds=bounds, kdims=[x, y]).options(
         show_legend=False).redim.range(
         z=(low, high))
     
@@ -59,7 +55,7 @@ def gen_background(df):
         cmap='fire').opts(
         norm=dict(framewise=True))
 
-def gen_hex(df):
+def gen_hex(df, ranges=None):
     """
     Return holoviews HexTiles plot
     
@@ -69,18 +65,20 @@ def gen_hex(df):
     df: pandas.DataFrame
         DataFrame containing data to be ploted on hextiles plot
     
+    ranges: dict
+        (low, high) axis range of each column, e.g. from a QuantileRange.
+        Defaults to the 1% and 99% quantiles of df.
+    
     """
     
     # Get bounds for graph
     colNames = list(df)
-    lowX = df[colNames[0]].quantile(0.01)
-    highX = df[colNames[0]].quantile(0.99)
-    lowY = df[colNames[1]].quantile(0.01)
-    highY = df[colNames[1]].quantile(0.99)
+    if ranges is None:
+        ranges = dict((name, (df[name].quantile(0.01), df[name].quantile(0.99))) for name in colNames)
     
     return hv.HexTiles(df, group="Number of events: " + str(len(df.index))).redim.range(
-        ebeam=(lowX, highX), 
-        ipm2 = (lowY, highY)).opts(
+        ebeam=ranges[colNames[0]], 
+        ipm2 = ranges[colNames[1]]).opts(
         norm=dict(framewise=True))
 
 def gen_scatter(df):
@@ -96,7 +94,7 @@ def gen_scatter(df):
     """
     return hv.Scatter(df).options(size=10, tools=['hover'], apply_ranges=False)
 
-def produce_hex(doc, ipm2List, ipm3List, ebeamList, ipm2TS, ipm3TS, ebeamTS): 
+def produce_hex(doc, ipm2, ipm3, ebeam): 
     """
     Produce updating hextiles plot and push them onto the web page document.
     
@@ -109,41 +107,34 @@ def produce_hex(doc, ipm2List, ipm3List, ebeamList, ipm2TS, ipm3TS, ebeamTS):
     doc: bokeh.document (I think)
         Bokeh document to be displayed on webpage
     
-    ipm2List: deque
-        Deque containing updating ipm2 values
+    ipm2: RingBuffer
+        Ring buffer containing updating ipm2 values and timestamps
         
-    ipm3List: deque
-        Deque containing updating ipm3 values
-    
-    ebeamList: deque
-        Deque containing updating ebeam values
-    
-    ipm2TS: deque
-        Deque containing updating ipm2 timestamps
+    ipm3: RingBuffer
+        Ring buffer containing updating ipm3 values and timestamps
     
-    ipm3TS: deque
-        Deque containing updating ipm3 timestamps
-    
-    ebeamTS: deque
-        Deque containing updating ebeam timestamps
+    ebeam: RingBuffer
+        Ring buffer containing updating ebeam values and timestamps
     
     """
     
-    # Create copy of deques for each instance of server
-    ipm2_plot = list(ipm2List)
-    ipm3_plot = list(ipm3List)
-    ebeam_plot = list(ebeamList)
-    ipm2TS_plot = list(ipm2TS)
-    ipm3TS_plot = list(ipm3TS)
-    ebeamTS_plot = list(ebeamTS)
+    # Views of the ring buffers for each instance of server
+    ipm2_plot, ipm2TS_plot = ipm2.last()
+    ipm3_plot, ipm3TS_plot = ipm3.last()
+    ebeam_plot, ebeamTS_plot = ebeam.last()
+    
+    # Sequence numbers to plot from, moved forward by clear()
+    ipm2_seq, ipm3_seq, ebeam_seq = (0, 0, 0)
     
-    ipm2_index, ipm3_index, ebeam_index, ipm2TS_index, ipm3TS_index, ebeamTS_index = (0, 0, 0, 0, 0, 0)
+    # 1% and 99% quantiles of each channel for the axis ranges, fed with new events only
+    ranges = QuantileRange(['ebeam', 'ipm2', 'ipm3'])
+    last_event = -1
     
     # Streams
     streamHex = hv.streams.Stream.define(
         'df', df=pd.DataFrame({
             'ebeam':[], 'ipm2':[]
-        }))()
+        }), ranges=None)()
     
     # Generate dynamic map
     plot = hv.DynamicMap(
@@ -163,18 +154,16 @@ def produce_hex(doc, ipm2List, ipm3List, ebeamList, ipm2TS, ipm3TS, ebeamTS):
         """
         "Clear" graphs and particular lists of server instance. 
         
-        Save current index and only plot points after that index.
+        Save current sequence number and only plot points after that sequence number.
         
         """
         
-        nonlocal ipm2_index, ipm3_index, ebeam_index, ipm2TS_index, ipm3TS_index, ebeamTS_index
+        nonlocal ipm2_seq, ipm3_seq, ebeam_seq
         
-        ipm2_index = len(ipm2List)
-        ipm3_index = len(ipm3List)
-        ebeam_index = len(ebeamList)
-        ipm2TS_index = len(ipm2TS)
-        ipm3TS_index = len(ipm3TS)
-        ebeamTS_index = len(ebeamTS)
+        ipm2_seq = ipm2.seq
+        ipm3_seq = ipm3.seq
+        ebeam_seq = ebeam.seq
+        ranges.clear()
         
     def push_data():
         """
@@ -182,22 +171,33 @@ def produce_hex(doc, ipm2List, ipm3List, ebeamList, ipm2TS, ipm3TS, ebeamTS):
         
         """
         
-        nonlocal ipm2_plot, ipm3_plot, ebeam_plot, ipm2TS_plot, ipm3TS_plot, ebeamTS_plot
+        nonlocal ipm2_plot, ipm3_plot, ebeam_plot, ipm2TS_plot, ipm3TS_plot, ebeamTS_plot, last_event
         
-        ipm2_plot = list(ipm2List)[ipm2_index:]
-        ipm3_plot = list(ipm3List)[ipm3_index:]
-        ebeam_plot = list(ebeamList)[ebeam_index:]
-        ipm2TS_plot = list(ipm2TS)[ipm2TS_index:]
-        ipm3TS_plot = list(ipm3TS)[ipm3TS_index:]
-        ebeamTS_plot = list(ebeamTS)[ebeamTS_index:]
+        ipm2_plot, ipm2TS_plot, _ = ipm2.since(ipm2_seq)
+        ipm3_plot, ipm3TS_plot, _ = ipm3.since(ipm3_seq)
+        ebeam_plot, ebeamTS_plot, _ = ebeam.since(ebeam_seq)
         
         ipm2Data = pd.Series(ipm2_plot, index=ipm2TS_plot)
         ipm3Data = pd.Series(ipm3_plot, index=ipm3TS_plot)
         ebeamData = pd.Series(ebeam_plot, index=ebeamTS_plot)
         zipped = basic_event_builder(ipm2=ipm2Data, ipm3=ipm3Data, ebeam=ebeamData)
+        
+        # Events are sorted by timestamp, only the ones after the last tick are new
+        ranges.add(zipped.iloc[zipped.index.searchsorted(last_event, side='right'):])
+        if len(zipped.index):
+            last_event = zipped.index[-1]
+        
         data = zipped[['ebeam', switch_key_hex]]
         #print(zipped)
-        streamHex.event(df=data)
+        streamHex.event(df=data, ranges=axis_ranges())
+    
+    def axis_ranges():
+        """
+        Return the since-clear axis range of each channel
+        
+        """
+        
+        return dict((name, ranges.range(name)) for name in ranges.names)
     
     def play_graph():
         """
@@ -261,7 +261,7 @@ def produce_hex(doc, ipm2List, ipm3List, ebeamList, ipm2TS, ipm3TS, ebeamTS):
     doc.title = "Hextiles Graph"
     doc.add_root(plot)
     
-def produce_scatter_on_background(doc, ipm2List, ipm3List, ebeamList, ipm2TS, ipm3TS, ebeamTS):
+def produce_scatter_on_background(doc, ipm2, ipm3, ebeam, backgrounds):
     """
     Produce background plot with updating scatter plot on top of it 
     and push them onto the web page document. 
@@ -275,35 +275,26 @@ def produce_scatter_on_background(doc, ipm2List, ipm3List, ebeamList, ipm2TS, ip
     doc: bokeh.document (I think)
         Bokeh document to be displayed on webpage
     
-    ipm2List: deque
-        Deque containing updating ipm2 values
+    ipm2: RingBuffer
+        Ring buffer containing updating ipm2 values and timestamps
         
-    ipm3List: deque
-        Deque containing updating ipm3 values
-    
-    ebeamList: deque
-        Deque containing updating ebeam values
+    ipm3: RingBuffer
+        Ring buffer containing updating ipm3 values and timestamps
     
-    ipm2TS: deque
-        Deque containing updating ipm2 timestamps
+    ebeam: RingBuffer
+        Ring buffer containing updating ebeam values and timestamps
     
-    ipm3TS: deque
-        Deque containing updating ipm3 timestamps
-    
-    ebeamTS: deque
-        Deque containing updating ebeam timestamps
+    backgrounds: dict
+        Histogram2D of ebeam against each ipm, shared by every session
     
     """
     
-    # Interesting error, background doesn't seem to update after running multiple instances 
-    # to the latest version and starts off with the data the first instance was given. 
-    # Need to figure out why!
-    
-    curBackData = pd.read_csv('data2.csv', index_col='Unnamed: 0')
+    # Background drawn from the histogram shared by every session
+    counts, bounds = backgrounds['ipm2'].image()
     
     # Streams
     streamContour = hv.streams.Stream.define(
-        'df', df=curBackData)()
+        'Histogram', counts=counts, bounds=bounds, names=('ebeam', 'ipm2'))()
 
     streamScatter = hv.streams.Stream.define(
         'df', df=pd.DataFrame({
@@ -340,16 +331,16 @@ def produce_scatter_on_background(doc, ipm2List, ipm3List, ebeamList, ipm2TS, ip
         # Still has the freezing points error, though, it seems to come more frequently. 
         # This may be a bigger problem now
         
-        ebeamConverted = list(ebeamList)
-        ipm2Converted = list(ipm2List)
-        ipm3Converted = list(ipm3List)
-        ebeamTimeConverted = list(ebeamTS)
-        ipm2TimeConverted = list(ipm2TS)
-        ipm3TimeConverted = list(ipm3TS)
+        for hist in backgrounds.values():
+            hist.update()
+        
+        ebeamConverted, ebeamTimeConverted = ebeam.last(limit)
+        ipm2Converted, ipm2TimeConverted = ipm2.last(limit)
+        ipm3Converted, ipm3TimeConverted = ipm3.last(limit)
 
-        ipm2Data = pd.Series(ipm2Converted[-limit:], index=ipm2TimeConverted[-limit:])
-        ipm3Data = pd.Series(ipm3Converted[-limit:], index=ipm3TimeConverted[-limit:])
-        ebeamData = pd.Series(ebeamConverted[-limit:], index=ebeamTimeConverted[-limit:])
+        ipm2Data = pd.Series(ipm2Converted, index=ipm2TimeConverted)
+        ipm3Data = pd.Series(ipm3Converted, index=ipm3TimeConverted)
+        ebeamData = pd.Series(ebeamConverted, index=ebeamTimeConverted)
         
         zipped = basic_event_builder(ipm2=ipm2Data, ipm3=ipm3Data, ebeam=ebeamData)
 
@@ -376,15 +367,25 @@ def produce_scatter_on_background(doc, ipm2List, ipm3List, ebeamList, ipm2TS, ip
         nonlocal switch_key_scatter
         switch_key_scatter = select.value
     
+    def draw_background():
+        """
+        Bring the histogram of the selected ipm up to date and redraw the
+        contour plot from it
+        
+        """
+        
+        hist = backgrounds[switch_key_scatter]
+        hist.update()
+        counts, bounds = hist.image()
+        streamContour.event(counts=counts, bounds=bounds, names=('ebeam', switch_key_scatter))
+    
     def switch_background(attr, old, new):
         """
         Switch background when drop down menu value is updated
         
         """
         
-        nonlocal curBackData
-        data = curBackData[['ebeam', switch_key_scatter]]
-        streamContour.event(df=data)
+        draw_background()
         
     def update_background():
         """
@@ -392,12 +393,7 @@ def produce_scatter_on_background(doc, ipm2List, ipm3List, ebeamList, ipm2TS, ip
         
         """
         
-        nonlocal curBackData
-        newData = pd.read_csv('data2.csv', index_col='Unnamed: 0')
-        curBackData = newData
-        data = newData[['ebeam', switch_key_scatter]]
-        
-        streamContour.event(df=data)
+        draw_background()
         
     def play_graph():
         """
@@ -438,12 +434,11 @@ def produce_scatter_on_background(doc, ipm2List, ipm3List, ebeamList, ipm2TS, ip
 
 def new_data(*args, **kwargs):
     """
-    Append data from subscribe into data containers
+    Append data from subscribe into ring buffer
     
     """
     
-    kwargs['in_value'].append(kwargs['value'])
-    kwargs['in_time'].append(kwargs['timestamp'])
+    kwargs['in_buffer'].append(kwargs['value'], kwargs['timestamp'])
 
 def launch_server():
     '''
@@ -458,48 +453,46 @@ def launch_server():
     
     # Get data
     beam = FakeBeam()
-    ipm2List = deque(maxlen=maxlen)
-    ipm3List = deque(maxlen=maxlen)
-    ebeamList = deque(maxlen=maxlen)
-    ipm2TimeStamp = deque(maxlen=maxlen)
-    ipm3TimeStamp = deque(maxlen=maxlen)
-    ebeamTimeStamp = deque(maxlen=maxlen)
+    ipm2 = RingBuffer(maxlen)
+    ipm3 = RingBuffer(maxlen)
+    ebeam = RingBuffer(maxlen)
     
     # Subscribe to devices
     beam.fake_ipm2.subscribe(
-        partial(new_data, in_value=ipm2List, in_time=ipm2TimeStamp)
+        partial(new_data, in_buffer=ipm2)
     )
 
     beam.fake_ipm3.subscribe(
-        partial(new_data, in_value=ipm3List, in_time=ipm3TimeStamp)
+        partial(new_data, in_buffer=ipm3)
     )
 
     beam.fake_L3.subscribe(
-        partial(new_data, in_value=ebeamList, in_time=ebeamTimeStamp)
+        partial(new_data, in_buffer=ebeam)
     )
     
+    # Background histograms shared by every contour session
+    backgrounds = {
+        'ipm2':Histogram2D(source=StreamingEventBuilder(ebeam=ebeam, ipm2=ipm2), columns=('ebeam', 'ipm2')),
+        'ipm3':Histogram2D(source=StreamingEventBuilder(ebeam=ebeam, ipm3=ipm3), columns=('ebeam', 'ipm3'))
+    }
+    
     origins = ["localhost:{}".format(5006)]
     
     server = Server(
         {
             '/Hextiles': partial(
                 produce_hex,
-                ipm2List=ipm2List,
-                ipm3List=ipm3List,
-                ebeamList=ebeamList,
-                ipm2TS=ipm2TimeStamp,
-                ipm3TS=ipm3TimeStamp,
-                ebeamTS=ebeamTimeStamp#,
+                ipm2=ipm2,
+                ipm3=ipm3,
+                ebeam=ebeam#,
                 #streamHex=streamHex
             ),
             '/Contour': partial(
                 produce_scatter_on_background,
-                ipm2List=ipm2List,
-                ipm3List=ipm3List,
-                ebeamList=ebeamList,
-                ipm2TS=ipm2TimeStamp,
-                ipm3TS=ipm3TimeStamp,
-                ebeamTS=ebeamTimeStamp#,
+                ipm2=ipm2,
+                ipm3=ipm3,
+                ebeam=ebeam,
+                backgrounds=backgrounds#,
                 #streamHex=streamHex
             )
         },
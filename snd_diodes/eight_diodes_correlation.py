@@ -10,11 +10,14 @@ from bokeh.io import output_file, save
 from bokeh.server.server import Server
 from bokeh.application import Application
 from holoviews.streams import Buffer
+from holoviews.core import util
 import tables
 from eight_diodes_beam import FakeEightBeams
 from functools import partial
-from collections import deque
-from event_builder import basic_event_builder
+from ring_buffer import RingBuffer
+from event_builder import match_timestamps
+from rolling import CorrelationMatrix
+from itertools import combinations
 import time
 
 renderer = hv.renderer('bokeh').instance(mode='server')
@@ -37,9 +40,25 @@ def apply_formatter(plot, element):
         months=['%D %H:%M:%S'], 
         years=['%D %H:%M:%S'])
     
-def produce_correlation_graphs(doc, diode_t_dict, diode_dict):
+def gen_heatmap(df):
     """
-    Produce correlation graphs and push them onto the web page document.
+    Return holoviews HeatMap of the diode correlation matrix
+    
+    Parameters
+    ----------
+    
+    df: pandas.DataFrame
+        DataFrame with x_diode, y_diode and correlation columns
+    
+    """
+    
+    return hv.HeatMap(df, kdims=['x_diode', 'y_diode'], vdims=['correlation']).redim.range(
+        correlation=(-1, 1))
+    
+def produce_correlation_graphs(doc, diode_dict):
+    """
+    Produce correlation graphs of every pair of diodes plus a correlation
+    matrix and push them onto the web page document.
     
     Parameters
     ----------
@@ -47,63 +66,121 @@ def produce_correlation_graphs(doc, diode_t_dict, diode_dict):
     doc: bokeh.document (I think)
         Bokeh document to be displayed on webpage
     
-    diode_t_dict: dictionary
-        diciontary with deques containing timestamps of the diode readings
-    
     diode_dict: dictionary
-        dictionary with deques containing diode readins
+        dictionary with ring buffers containing diode readings and timestamps
     
     """
     
     # Initialize formatting variables
     buffer_length = 40000
-    width = 500
+    width = 250
     
-    # Initialize Streams
-    b_dcc_dco = Buffer(pd.DataFrame({'x_diode':[], 'y_diode':[]}), length=buffer_length)
-    b_t4d_dd = Buffer(pd.DataFrame({'x_diode':[], 'y_diode':[]}), length=buffer_length)
-    b_do_di = Buffer(pd.DataFrame({'x_diode':[], 'y_diode':[]}), length=buffer_length)
-    b_t4d_dco = Buffer(pd.DataFrame({'x_diode':[], 'y_diode':[]}), length=buffer_length)
-    
-    # Initialize dynamic maps
-    hvPoint_dcc_dco = hv.DynamicMap(
-        partial(hv.Scatter, kdims=['x_diode','y_diode'], group='DCC vs DCO'), streams=[b_dcc_dco]).options(
-        width=width).redim.label(x_diode='DCC', y_diode='DCO')
+    names = list(diode_dict)
+    pairs = list(combinations(names, 2))
     
-    hvPoint_t4d_dd = hv.DynamicMap(
-        partial(hv.Scatter, kdims=['x_diode','y_diode'], group='T4D vs DD'), streams=[b_t4d_dd]).options(
-        width=width).redim.label(x_diode='T4D', y_diode='DD')
+    # Initialize Streams, one buffer of event built diodes feeds every scatter plot
+    b_events = Buffer(pd.DataFrame({name:[] for name in names}), length=buffer_length)
+    streamMatrix = hv.streams.Stream.define(
+        'df', df=pd.DataFrame({'x_diode':[], 'y_diode':[], 'correlation':[]}))()
     
-    hvPoint_do_di = hv.DynamicMap(
-        partial(hv.Scatter, kdims=['x_diode','y_diode'], group='DO vs DI'), streams=[b_do_di]).options(
-        width=width).redim.label(x_diode='DO', y_diode='DI')
+    # Initialize dynamic maps
+    hvPoints = [
+        hv.DynamicMap(
+            partial(hv.Scatter, kdims=[x_name], vdims=[y_name], 
+                    group=x_name.upper() + ' vs ' + y_name.upper()), 
+            streams=[b_events]).options(width=width, height=width)
+        for x_name, y_name in pairs]
     
-    hvPoint_t4d_dco = hv.DynamicMap(
-        partial(hv.Scatter, kdims=['x_diode','y_diode'], group='T4D vs DCO'), streams=[b_t4d_dco]).options(
-        width=width).redim.label(x_diode='T4D', y_diode='DCO')
+    hvMatrix = hv.DynamicMap(gen_heatmap, streams=[streamMatrix]).options(
+        width=2*width, colorbar=True, xrotation=45)
     
-    plots_col = (hvPoint_dcc_dco + hvPoint_t4d_dco + hvPoint_do_di + hvPoint_t4d_dd).cols(2)
+    plots_col = hv.Layout(hvPoints + [hvMatrix]).cols(4)
     
     # Render plot with bokeh
     hvplot = renderer.get_plot(plots_col, doc)
     
     # Initialize callbacks
-    cb_id_dcc_dco = None
-    cb_id_t4d_dd = None
-    cb_id_do_di = None
-    cb_id_t4d_dco = None
+    cb_id = None
+    
+    # Largest timestamp difference (ns) between diodes still counted as one event
+    tolerance = 4000000
+    
+    # Correlation of every pair, over the last 1200 events and since clear
+    correlation = CorrelationMatrix(names, window=1200)
+    since_clear = False
+    
+    # Events are built on the first diode, from this sequence number on
+    reference = names[0]
+    reference_seq = 0
+    
+    def build_events():
+        """
+        Event build every diode at once for the samples of the reference diode
+        that arrived since the last tick. Samples too new for every other diode
+        to have a match yet are left for the next tick.
+        
+        """
+        
+        nonlocal reference_seq
+        
+        ref_d, ref_t, end_seq = diode_dict[reference].since(reference_seq)
+        others = [diode_dict[name].last() for name in names[1:]]
+        if any(len(timestamps) == 0 for _, timestamps in others):
+            return np.empty((0, len(names))), ref_t[:0]
+        
+        newest = min(timestamps[-1] for _, timestamps in others)
+        ready = np.searchsorted(ref_t, newest - tolerance, side='right')
+        reference_seq = end_seq - (len(ref_t) - ready)
+        ref_d = ref_d[:ready]
+        ref_t = ref_t[:ready]
+        
+        columns = [ref_d]
+        keep = np.ones(ready, dtype=bool)
+        for values, timestamps in others:
+            index, _ = match_timestamps(ref_t, timestamps, tolerance)
+            keep &= index >= 0
+            columns.append(values[index])
+        
+        return np.column_stack(columns)[keep], ref_t[keep]
+    
+    def draw_matrix():
+        """
+        Update the correlation matrix with the current correlations
+        
+        """
+        
+        matrix = correlation.correlation(since_clear)
+        streamMatrix.event(df=pd.DataFrame({
+            'x_diode':np.repeat(names, len(names)), 
+            'y_diode':np.tile(names, len(names)), 
+            'correlation':matrix.ravel()}))
+    
+    def clear_buffer():
+        """
+        Modified version of hv.buffer.clear() since original appears to be
+        buggy
+        
+        """
+        
+        with util.disable_constant(b_events):
+            
+            b_events.data = b_events.data.iloc[:0]
+        
+        b_events.send(pd.DataFrame({name:[] for name in names}))
     
     # Push data into buffers
-    def push_data(x_diode, y_diode, x_diode_t, y_diode_t, buffer):
+    def push_data():
         """
-        Push data from x and y diode into buffer to be graphed.
-
+        Push new events into the scatter plots and update the correlation matrix
+        
         """
         
-        x_diode_data = pd.Series(x_diode, index=x_diode_t)
-        y_diode_data = pd.Series(y_diode, index=y_diode_t)
-        zipped = basic_event_builder(x_diode=x_diode_data, y_diode=y_diode_data)
-        buffer.send(zipped)
+        events, timestamps = build_events()
+        correlation.add(events, timestamps/1e9)
+        
+        # Convert ns timestamps to ms so bokeh formatter can get correct datetime
+        b_events.send(pd.DataFrame(events, columns=names, index=timestamps/1e6))
+        draw_matrix()
     
     #
     def play_graph():
@@ -112,45 +189,49 @@ def produce_correlation_graphs(doc, diode_t_dict, diode_dict):
 
         """
         
-        nonlocal cb_id_dcc_dco, cb_id_t4d_dd, cb_id_do_di, cb_id_t4d_dco
+        nonlocal cb_id
         
         cb_time = 1000
         
         if startButton.label == '► Play':
             startButton.label = '❚❚ Pause'
-            
-            cb_id_dcc_dco = doc.add_periodic_callback(
-                partial(push_data, x_diode=diode_dict['dcc_d'], y_diode=diode_dict['dco_d'], 
-                        x_diode_t=diode_t_dict['dcc_t'], y_diode_t=diode_t_dict['dco_t'], buffer=b_dcc_dco),
-                cb_time)
-
-            cb_id_t4d_dd = doc.add_periodic_callback(
-                partial(push_data, x_diode=diode_dict['t4d_d'], y_diode=diode_dict['dd_d'], 
-                        x_diode_t=diode_t_dict['t4d_t'], y_diode_t=diode_t_dict['dd_t'], buffer=b_t4d_dd),
-                cb_time)
-
-            cb_id_do_di = doc.add_periodic_callback(
-                partial(push_data, x_diode=diode_dict['do_d'], y_diode=diode_dict['di_d'], 
-                        x_diode_t=diode_t_dict['do_t'], y_diode_t=diode_t_dict['di_t'], buffer=b_do_di),
-                cb_time)
-
-            cb_id_t4d_dco = doc.add_periodic_callback(
-                partial(push_data, x_diode=diode_dict['t4d_d'], y_diode=diode_dict['dco_d'], 
-                        x_diode_t=diode_t_dict['t4d_t'], y_diode_t=diode_t_dict['dco_t'], buffer=b_t4d_dco),
-                cb_time)
-            
+            cb_id = doc.add_periodic_callback(push_data, cb_time)
         else:
             startButton.label = '► Play'
-            doc.remove_periodic_callback(cb_id_dcc_dco)
-            doc.remove_periodic_callback(cb_id_t4d_dd)
-            doc.remove_periodic_callback(cb_id_do_di)
-            doc.remove_periodic_callback(cb_id_t4d_dco)
+            doc.remove_periodic_callback(cb_id)
+    
+    def clear():
+        """
+        Clear scatter plots and restart the since clear correlation
+        
+        """
+        
+        correlation.clear()
+        clear_buffer()
+        draw_matrix()
+    
+    def switch(attr, old, new):
+        """
+        Switch correlation matrix between rolling window and since clear
+        
+        """
+        
+        nonlocal since_clear
+        since_clear = select.value == 'Since clear'
+        draw_matrix()
     
     # Create widgets
     startButton = Button(label='► Play')
     startButton.on_click(play_graph)
     
-    plot = layout([startButton, row([hvplot.state])])
+    clearButton = Button(label='Clear')
+    clearButton.on_click(clear)
+    
+    select = Select(title='Correlation matrix:', value='Rolling window', 
+                    options=['Rolling window', 'Since clear'])
+    select.on_change('value', switch)
+    
+    plot = layout([[startButton, clearButton, select], row([hvplot.state])])
     
     doc.title = "Correlation Graphs"
     doc.add_root(plot)
@@ -158,19 +239,18 @@ def produce_correlation_graphs(doc, diode_t_dict, diode_dict):
 
 def new_data(*args, **kwargs):
     """
-    Append data from subscribe into data containers
+    Append data from subscribe into ring buffer
     
     """
     
-    kwargs['in_value'].append(kwargs['value'])
-    kwargs['in_time'].append(kwargs['timestamp'])
+    kwargs['in_buffer'].append(kwargs['value'], kwargs['timestamp'])
     #print("I'm working!")
 
 def launch_server():
     '''
     Launch a bokeh_server to plot the time history of dcc, dci, dco, 
     dd, di, do, t1d, and t4d diodes and the correlation graphs between 
-    dcc and dco, t4d and dd, do and di, and t4d and dco.
+    every pair of them plus their correlation matrix.
     
     '''
     
@@ -179,65 +259,51 @@ def launch_server():
     # Initialize data carriers
     beam = FakeEightBeams()
 
-    dcc_d = deque(maxlen=maxlen)
-    dci_d = deque(maxlen=maxlen)
-    dco_d = deque(maxlen=maxlen)
-    dd_d = deque(maxlen=maxlen)
-    di_d = deque(maxlen=maxlen)
-    do_d = deque(maxlen=maxlen)
-    t1d_d = deque(maxlen=maxlen)
-    t4d_d = deque(maxlen=maxlen)
-    
-    dcc_t = deque(maxlen=maxlen)
-    dci_t = deque(maxlen=maxlen)
-    dco_t = deque(maxlen=maxlen)
-    dd_t = deque(maxlen=maxlen)
-    di_t = deque(maxlen=maxlen)
-    do_t = deque(maxlen=maxlen)
-    t1d_t = deque(maxlen=maxlen)
-    t4d_t = deque(maxlen=maxlen)
-    
-    diode_dict = {'dcc_d':dcc_d, 'dci_d':dci_d, 
-                  'dco_d':dco_d, 'dd_d':dd_d, 
-                  'di_d':di_d, 'do_d':do_d, 
-                  't1d_d':t1d_d, 't4d_d':t4d_d}
-    
-    diode_t_dict = {'dcc_t':dcc_t, 'dci_t':dci_t,
-                    'dco_t':dco_t, 'dd_t':dd_t, 
-                    'di_t':di_t, 'do_t':do_t, 
-                    't1d_t':t1d_t, 't4d_t':t4d_t}
+    dcc = RingBuffer(maxlen)
+    dci = RingBuffer(maxlen)
+    dco = RingBuffer(maxlen)
+    dd = RingBuffer(maxlen)
+    di = RingBuffer(maxlen)
+    do = RingBuffer(maxlen)
+    t1d = RingBuffer(maxlen)
+    t4d = RingBuffer(maxlen)
+    
+    diode_dict = {'dcc':dcc, 'dci':dci, 
+                  'dco':dco, 'dd':dd, 
+                  'di':di, 'do':do, 
+                  't1d':t1d, 't4d':t4d}
     
     # Subscribe to diodes
     beam.fake_dcc.subscribe(
-        partial(new_data, in_value=dcc_d, in_time=dcc_t)
+        partial(new_data, in_buffer=dcc)
     )
     
     beam.fake_dci.subscribe(
-        partial(new_data, in_value=dci_d, in_time=dci_t)
+        partial(new_data, in_buffer=dci)
     )
     
     beam.fake_dco.subscribe(
-        partial(new_data, in_value=dco_d, in_time=dco_t)
+        partial(new_data, in_buffer=dco)
     )
     
     beam.fake_dd.subscribe(
-        partial(new_data, in_value=dd_d, in_time=dd_t)
+        partial(new_data, in_buffer=dd)
     )
     
     beam.fake_di.subscribe(
-        partial(new_data, in_value=di_d, in_time=di_t)
+        partial(new_data, in_buffer=di)
     )
     
     beam.fake_do.subscribe(
-        partial(new_data, in_value=do_d, in_time=do_t)
+        partial(new_data, in_buffer=do)
     )
     
     beam.fake_t1d.subscribe(
-        partial(new_data, in_value=t1d_d, in_time=t1d_t)
+        partial(new_data, in_buffer=t1d)
     )
     
     beam.fake_t4d.subscribe(
-        partial(new_data, in_value=t4d_d, in_time=t4d_t)
+        partial(new_data, in_buffer=t4d)
     )
 
     origins = ["localhost:{}".format(5006)]
@@ -246,7 +312,6 @@ def launch_server():
         {
             '/Correlation': partial(
                 produce_correlation_graphs,
-                diode_t_dict=diode_t_dict,
                 diode_dict=diode_dict
             )
         },
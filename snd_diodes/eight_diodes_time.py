@@ -13,7 +13,7 @@ from holoviews.streams import Buffer
 import tables
 from eight_diodes_beam import FakeEightBeams
 from functools import partial
-from collections import deque
+from ring_buffer import RingBuffer
 from event_builder import basic_event_builder
 import time
 
@@ -37,7 +37,7 @@ def apply_formatter(plot, element):
         months=['%D %H:%M:%S'], 
         years=['%D %H:%M:%S'])
     
-def produce_correlation_graphs(doc, diode_t_dict, diode_dict):
+def produce_correlation_graphs(doc, diode_dict):
     """
     Produce correlation graphs and push them onto the web page document.
     
@@ -47,11 +47,8 @@ def produce_correlation_graphs(doc, diode_t_dict, diode_dict):
     doc: bokeh.document (I think)
         Bokeh document to be displayed on webpage
     
-    diode_t_dict: dictionary
-        diciontary with deques containing timestamps of the diode readings
-    
     diode_dict: dictionary
-        dictionary with deques containing diode readins
+        dictionary with ring buffers containing diode readings and timestamps
     
     """
     
@@ -94,14 +91,16 @@ def produce_correlation_graphs(doc, diode_t_dict, diode_dict):
     cb_id_t4d_dco = None
     
     # Push data into buffers
-    def push_data(x_diode, y_diode, x_diode_t, y_diode_t, buffer):
+    def push_data(x_diode, y_diode, buffer):
         """
         Push data from x and y diode into buffer to be graphed.
 
         """
         
-        x_diode_data = pd.Series(x_diode, index=x_diode_t)
-        y_diode_data = pd.Series(y_diode, index=y_diode_t)
+        x_diode_d, x_diode_t = x_diode.last()
+        y_diode_d, y_diode_t = y_diode.last()
+        x_diode_data = pd.Series(x_diode_d, index=x_diode_t)
+        y_diode_data = pd.Series(y_diode_d, index=y_diode_t)
         zipped = basic_event_builder(x_diode=x_diode_data, y_diode=y_diode_data)
         buffer.send(zipped)
     
@@ -120,23 +119,23 @@ def produce_correlation_graphs(doc, diode_t_dict, diode_dict):
             startButton.label = '❚❚ Pause'
             
             cb_id_dcc_dco = doc.add_periodic_callback(
-                partial(push_data, x_diode=diode_dict['dcc_d'], y_diode=diode_dict['dco_d'], 
-                        x_diode_t=diode_t_dict['dcc_t'], y_diode_t=diode_t_dict['dco_t'], buffer=b_dcc_dco),
+                partial(push_data, x_diode=diode_dict['dcc'], y_diode=diode_dict['dco'], 
+                        buffer=b_dcc_dco),
                 cb_time)
 
             cb_id_t4d_dd = doc.add_periodic_callback(
-                partial(push_data, x_diode=diode_dict['t4d_d'], y_diode=diode_dict['dd_d'], 
-                        x_diode_t=diode_t_dict['t4d_t'], y_diode_t=diode_t_dict['dd_t'], buffer=b_t4d_dd),
+                partial(push_data, x_diode=diode_dict['t4d'], y_diode=diode_dict['dd'], 
+                        buffer=b_t4d_dd),
                 cb_time)
 
             cb_id_do_di = doc.add_periodic_callback(
-                partial(push_data, x_diode=diode_dict['do_d'], y_diode=diode_dict['di_d'], 
-                        x_diode_t=diode_t_dict['do_t'], y_diode_t=diode_t_dict['di_t'], buffer=b_do_di),
+                partial(push_data, x_diode=diode_dict['do'], y_diode=diode_dict['di'], 
+                        buffer=b_do_di),
                 cb_time)
 
             cb_id_t4d_dco = doc.add_periodic_callback(
-                partial(push_data, x_diode=diode_dict['t4d_d'], y_diode=diode_dict['dco_d'], 
-                        x_diode_t=diode_t_dict['t4d_t'], y_diode_t=diode_t_dict['dco_t'], buffer=b_t4d_dco),
+                partial(push_data, x_diode=diode_dict['t4d'], y_diode=diode_dict['dco'], 
+                        buffer=b_t4d_dco),
                 cb_time)
             
         else:
@@ -155,7 +154,7 @@ def produce_correlation_graphs(doc, diode_t_dict, diode_dict):
     doc.title = "Correlation Graphs"
     doc.add_root(plot)
 
-def produce_curve(doc, diode_t_dict, diode_dict):
+def produce_curve(doc, diode_dict):
     """
     Produce time history graphs and push them onto the web page document.
     
@@ -165,11 +164,8 @@ def produce_curve(doc, diode_t_dict, diode_dict):
     doc: bokeh.document (I think)
         Bokeh document to be displayed on webpage
     
-    diode_t_dict: dictionary
-        diciontary with deques containing timestamps of the diode readings
-    
     diode_dict: dictionary
-        dictionary with deques containing diode readings
+        dictionary with ring buffers containing diode readings and timestamps
     
     """
                       
@@ -365,18 +361,18 @@ def produce_curve(doc, diode_t_dict, diode_dict):
     cb_id_t1d_std = None
     cb_id_t4d_std = None
         
-    def push_data_median(diode_t, diode, buffer):
+    def push_data_median(diode, buffer):
         """
         Push rolling median of diode readings and push resulting list into buffer
         to be graphed.
 
         """
                 
-        timeStuff = list(diode_t)
-        # Convert time to seconds so bokeh formatter can get correct datetime
-        times = [1000*time for time in timeStuff]
+        diode_d, diode_t = diode.last()
+        # Convert ns timestamps to ms so bokeh formatter can get correct datetime
+        times = diode_t/1e6
        
-        diodeData = pd.Series(diode, index=times)
+        diodeData = pd.Series(diode_d, index=times)
      
         zipped = basic_event_builder(diode=diodeData)
         median = zipped.rolling(120, min_periods=1).median()
@@ -384,7 +380,7 @@ def produce_curve(doc, diode_t_dict, diode_dict):
         buffer.send(median[119::2])
         zipped.to_csv('testData2.csv')
         
-    def push_data_std(diode_t, diode, buffer):
+    def push_data_std(diode, buffer):
         """
         Calculate rolling standard deviation of diode readings. Generate lists
         containing values one standard deviation away from the median (lower and higher)
@@ -392,10 +388,10 @@ def produce_curve(doc, diode_t_dict, diode_dict):
 
         """
         
-        timeStuff = list(diode_t)
-        times = [1000*time for time in timeStuff] # Convert time to seconds so bokeh formatter can get correct datetime
+        diode_d, diode_t = diode.last()
+        times = diode_t/1e6 # Convert ns timestamps to ms so bokeh formatter can get correct datetime
         
-        diodeData = pd.Series(diode, index=times)
+        diodeData = pd.Series(diode_d, index=times)
         zipped = basic_event_builder(diode=diodeData)
         
         median = zipped.rolling(120, min_periods=1).median()
@@ -423,77 +419,77 @@ def produce_curve(doc, diode_t_dict, diode_dict):
             
             # Callbacks for median lines
             cb_id_dcc = doc.add_periodic_callback(
-                partial(push_data_median, diode_t=diode_t_dict['dcc_t'], 
-                        diode=diode_dict['dcc_d'], buffer=buffer_dcc), 
+                partial(push_data_median, diode=diode_dict['dcc'], 
+                        buffer=buffer_dcc), 
                 cb_time)
 
             cb_id_dci = doc.add_periodic_callback(
-                partial(push_data_median, diode_t=diode_t_dict['dci_t'], 
-                        diode=diode_dict['dci_d'], buffer=buffer_dci), 
+                partial(push_data_median, diode=diode_dict['dci'], 
+                        buffer=buffer_dci), 
                 cb_time)
 
             cb_id_dco = doc.add_periodic_callback(
-                partial(push_data_median, diode_t=diode_t_dict['dco_t'], 
-                        diode=diode_dict['dco_d'], buffer=buffer_dco), 
+                partial(push_data_median, diode=diode_dict['dco'], 
+                        buffer=buffer_dco), 
                 cb_time)
 
             cb_id_dd = doc.add_periodic_callback(
-                partial(push_data_median, diode_t=diode_t_dict['dd_t'], 
-                        diode=diode_dict['dd_d'], buffer=buffer_dd), 
+                partial(push_data_median, diode=diode_dict['dd'], 
+                        buffer=buffer_dd), 
                 cb_time)
 
             cb_id_di = doc.add_periodic_callback(
-                partial(push_data_median, diode_t=diode_t_dict['di_t'], 
-                        diode=diode_dict['di_d'], buffer=buffer_di), 
+                partial(push_data_median, diode=diode_dict['di'], 
+                        buffer=buffer_di), 
                 cb_time)
 
             cb_id_do = doc.add_periodic_callback(
-                partial(push_data_median, diode_t=diode_t_dict['do_t'], 
-                        diode=diode_dict['do_d'], buffer=buffer_do), 
+                partial(push_data_median, diode=diode_dict['do'], 
+                        buffer=buffer_do), 
                 cb_time)
 
             cb_id_t1d = doc.add_periodic_callback(
-                partial(push_data_median, diode_t=diode_t_dict['t1d_t'], 
-                        diode=diode_dict['t1d_d'], buffer=buffer_t1d), 
+                partial(push_data_median, diode=diode_dict['t1d'], 
+                        buffer=buffer_t1d), 
                 cb_time)
 
             cb_id_t4d = doc.add_periodic_callback(
-                partial(push_data_median, diode_t=diode_t_dict['t4d_t'], 
-                        diode=diode_dict['t4d_d'], buffer=buffer_t4d), 
+                partial(push_data_median, diode=diode_dict['t4d'], 
+                        buffer=buffer_t4d), 
                 cb_time)
             
             # Callbacks for std lines
             cb_id_dcc_std = doc.add_periodic_callback(
-                partial(push_data_std, diode_t=diode_t_dict['dcc_t'], 
-                        diode=diode_dict['dcc_d'], buffer=b_dcc_std), 
+                partial(push_data_std, diode=diode_dict['dcc'], 
+                        buffer=b_dcc_std), 
                 cb_time)
             cb_id_dci_std = doc.add_periodic_callback(
-                partial(push_data_std, diode_t=diode_t_dict['dci_t'], 
-                        diode=diode_dict['dci_d'], buffer=b_dci_std), 
+                partial(push_data_std, diode=diode_dict['dci'], 
+                        buffer=b_dci_std), 
                 cb_time)
             cb_id_dco_std = doc.add_periodic_callback(
-                partial(push_data_std, diode_t=diode_t_dict['dco_t'], 
-                        diode=diode_dict['dco_d'], buffer=b_dco_std), 
+                partial(push_data_std, diode=diode_dict['dco'], 
+                        buffer=b_dco_std), 
                 cb_time)
             cb_id_dd_std = doc.add_periodic_callback(
-                partial(push_data_std, diode_t=diode_t_dict['dd_t'], 
-                        diode=diode_dict['dd_d'], buffer=b_dd_std), 
+                partial(push_data_std, diode=diode_dict['dd'], 
+                        buffer=b_dd_std), 
                 cb_time)
             cb_id_di_std = doc.add_periodic_callback(
-                partial(push_data_std, diode_t=diode_t_dict['di_t'], 
-                        diode=diode_dict['di_d'], buffer=b_di_std), 
+                partial(push_data_std, diode=diode_dict['di'], 
+                        buffer=b_di_std), 
                 cb_time)
             cb_id_do_std = doc.add_periodic_callback(
-                partial(push_data_std, diode_t=diode_t_dict['do_t'], 
-                        diode=diode_dict['do_d'], buffer=b_do_std), 
+                partial(push_data_std, diode=diode_dict['do'], 
+                        buffer=b_do_std), 
                 cb_time)
             cb_id_t1d_std = doc.add_periodic_callback(
-                partial(push_data_std, diode_t=diode_t_dict['t1d_t'], 
-                        diode=diode_dict['t1d_d'], buffer=b_t1d_std), 
+                partial(push_data_std, diode=diode_dict['t1d'], 
+                        buffer=b_t1d_std), 
                 cb_time)
             cb_id_t4d_std = doc.add_periodic_callback(
-                partial(push_data_std, diode_t=diode_t_dict['t4d_t'], 
-                        diode=diode_dict['t4d_d'], buffer=b_t4d_std), 
+                partial(push_data_std, diode=diode_dict['t4d'], 
+                        buffer=b_t4d_std), 
                 cb_time)
         else:
             startButton.label = '► Play'
@@ -525,11 +521,10 @@ def produce_curve(doc, diode_t_dict, diode_dict):
 
 def new_data(*args, **kwargs):
     """
-    Append data from subscribe into data containers
+    Append data from subscribe into ring buffer
     """
     
-    kwargs['in_value'].append(kwargs['value'])
-    kwargs['in_time'].append(kwargs['timestamp'])
+    kwargs['in_buffer'].append(kwargs['value'], kwargs['timestamp'])
     
 
 def launch_server():
@@ -545,65 +540,51 @@ def launch_server():
     # Initialize data carriers
     beam = FakeEightBeams()
 
-    dcc_d = deque(maxlen=maxlen)
-    dci_d = deque(maxlen=maxlen)
-    dco_d = deque(maxlen=maxlen)
-    dd_d = deque(maxlen=maxlen)
-    di_d = deque(maxlen=maxlen)
-    do_d = deque(maxlen=maxlen)
-    t1d_d = deque(maxlen=maxlen)
-    t4d_d = deque(maxlen=maxlen)
-    
-    dcc_t = deque(maxlen=maxlen)
-    dci_t = deque(maxlen=maxlen)
-    dco_t = deque(maxlen=maxlen)
-    dd_t = deque(maxlen=maxlen)
-    di_t = deque(maxlen=maxlen)
-    do_t = deque(maxlen=maxlen)
-    t1d_t = deque(maxlen=maxlen)
-    t4d_t = deque(maxlen=maxlen)
-    
-    diode_dict = {'dcc_d':dcc_d, 'dci_d':dci_d, 
-                  'dco_d':dco_d, 'dd_d':dd_d, 
-                  'di_d':di_d, 'do_d':do_d, 
-                  't1d_d':t1d_d, 't4d_d':t4d_d}
-    
-    diode_t_dict = {'dcc_t':dcc_t, 'dci_t':dci_t,
-                    'dco_t':dco_t, 'dd_t':dd_t, 
-                    'di_t':di_t, 'do_t':do_t, 
-                    't1d_t':t1d_t, 't4d_t':t4d_t}
+    dcc = RingBuffer(maxlen)
+    dci = RingBuffer(maxlen)
+    dco = RingBuffer(maxlen)
+    dd = RingBuffer(maxlen)
+    di = RingBuffer(maxlen)
+    do = RingBuffer(maxlen)
+    t1d = RingBuffer(maxlen)
+    t4d = RingBuffer(maxlen)
+    
+    diode_dict = {'dcc':dcc, 'dci':dci, 
+                  'dco':dco, 'dd':dd, 
+                  'di':di, 'do':do, 
+                  't1d':t1d, 't4d':t4d}
     
     # Subscribe to diodes
     beam.fake_dcc.subscribe(
-        partial(new_data, in_value=dcc_d, in_time=dcc_t)
+        partial(new_data, in_buffer=dcc)
     )
     
     beam.fake_dci.subscribe(
-        partial(new_data, in_value=dci_d, in_time=dci_t)
+        partial(new_data, in_buffer=dci)
     )
     
     beam.fake_dco.subscribe(
-        partial(new_data, in_value=dco_d, in_time=dco_t)
+        partial(new_data, in_buffer=dco)
     )
     
     beam.fake_dd.subscribe(
-        partial(new_data, in_value=dd_d, in_time=dd_t)
+        partial(new_data, in_buffer=dd)
     )
     
     beam.fake_di.subscribe(
-        partial(new_data, in_value=di_d, in_time=di_t)
+        partial(new_data, in_buffer=di)
     )
     
     beam.fake_do.subscribe(
-        partial(new_data, in_value=do_d, in_time=do_t)
+        partial(new_data, in_buffer=do)
     )
     
     beam.fake_t1d.subscribe(
-        partial(new_data, in_value=t1d_d, in_time=t1d_t)
+        partial(new_data, in_buffer=t1d)
     )
     
     beam.fake_t4d.subscribe(
-        partial(new_data, in_value=t4d_d, in_time=t4d_t)
+        partial(new_data, in_buffer=t4d)
     )
 
     origins = ["localhost:{}".format(5006)]
@@ -612,12 +593,10 @@ def launch_server():
         {
             '/Time_History': partial(
                 produce_curve,
-                diode_t_dict=diode_t_dict,
                 diode_dict=diode_dict
             ),
             '/Correlation': partial(
                 produce_correlation_graphs,
-                diode_t_dict=diode_t_dict,
                 diode_dict=diode_dict
             )
         },
@@ -13,7 +13,8 @@ from holoviews.streams import Buffer
 import tables
 from eight_diodes_beam import FakeEightBeams
 from functools import partial
-from collections import deque
+from ring_buffer import RingBuffer
+from rolling import RollingWindow
 from event_builder import basic_event_builder
 import time
 
@@ -38,7 +39,7 @@ def apply_formatter(plot, element):
         years=['%D %H:%M:%S'])
 
 
-def produce_curve(doc, diode_t_dict, diode_dict):
+def produce_curve(doc, diode_dict, rolling_dict):
     """
     Produce time history graphs and push them onto the web page document.
     
@@ -48,11 +49,11 @@ def produce_curve(doc, diode_t_dict, diode_dict):
     doc: bokeh.document (I think)
         Bokeh document to be displayed on webpage
     
-    diode_t_dict: dictionary
-        diciontary with deques containing timestamps of the diode readings
-    
     diode_dict: dictionary
-        dictionary with deques containing diode readings
+        dictionary with ring buffers containing diode readings and timestamps
+    
+    rolling_dict: dictionary
+        dictionary with shared RollingWindow for every diode
     
     """
                       
@@ -247,27 +248,48 @@ def produce_curve(doc, diode_t_dict, diode_dict):
     cb_id_do_std = None
     cb_id_t1d_std = None
     cb_id_t4d_std = None
+    
+    # Sequence number of the next median or std each buffer hasn't shown
+    seqs = {}
+    
+    def new_results(diode, buffer):
+        """
+        Return the medians and stds the buffer hasn't shown, with their
+        timestamps, keeping only every other one from the 120th on
         
-    def push_data_median(diode_t, diode, buffer):
+        """
+        
+        # Shared engine only computes results for samples it hasn't seen yet
+        diode.update()
+        median_d, median_t, _ = diode.median.since(seqs.get(buffer, 0))
+        std_d, _, end = diode.std.since(seqs.get(buffer, 0))
+        seqs[buffer] = end
+        
+        # Exclude first 119 points because of binning issues and sparsing the
+        # data, counting from the first result ever so ticks line up
+        first = end - len(std_d)
+        skip = max(119 - first, 0)
+        skip += (first + skip) % 2 == 0
+        return median_d[skip::2], std_d[skip::2], median_t[skip::2]
+        
+    def push_data_median(diode, buffer):
         """
         Push rolling median of diode readings and push resulting list into buffer
         to be graphed.
 
         """
                 
-        timeStuff = list(diode_t)
-        # Convert time to seconds so bokeh formatter can get correct datetime
-        times = [1000*time for time in timeStuff]
+        median_d, _, median_t = new_results(diode, buffer)
+        if len(median_d) == 0:
+            return
+        
+        # Convert ns timestamps to ms so bokeh formatter can get correct datetime
+        times = median_t/1e6
        
-        diodeData = pd.Series(diode, index=times)
-     
-        zipped = basic_event_builder(diode=diodeData)
-        median = zipped.rolling(120, min_periods=1).median()
-        # Exclude first 119 points because of binning issues and sparsing the data (Doesn't seem to really work though)
-        buffer.send(median[119::2])
-        zipped.to_csv('testData2.csv')
+        median = pd.DataFrame({'diode':median_d}, index=times)
+        buffer.send(median)
         
-    def push_data_std(diode_t, diode, buffer):
+    def push_data_std(diode, buffer):
         """
         Calculate rolling standard deviation of diode readings. Generate lists
         containing values one standard deviation away from the median (lower and higher)
@@ -275,18 +297,13 @@ def produce_curve(doc, diode_t_dict, diode_dict):
 
         """
         
-        timeStuff = list(diode_t)
-        times = [1000*time for time in timeStuff] # Convert time to seconds so bokeh formatter can get correct datetime
-        
-        diodeData = pd.Series(diode, index=times)
-        zipped = basic_event_builder(diode=diodeData)
+        median_d, std_d, median_t = new_results(diode, buffer)
+        if len(std_d) == 0:
+            return
+        times = median_t/1e6 # Convert ns timestamps to ms so bokeh formatter can get correct datetime
         
-        median = zipped.rolling(120, min_periods=1).median()
-        std = zipped.rolling(120, min_periods=1).std()
-        lowerbound = median - std
-        higherbound = median + std
-        df = pd.DataFrame({'lowerbound':lowerbound['diode'], 'higherbound':higherbound['diode']})
-        buffer.send(df[119::2])
+        df = pd.DataFrame({'lowerbound':median_d - std_d, 'higherbound':median_d + std_d}, index=times)
+        buffer.send(df)
     
     
     def play_graph():
@@ -306,77 +323,77 @@ def produce_curve(doc, diode_t_dict, diode_dict):
             
             # Callbacks for median lines
             cb_id_dcc = doc.add_periodic_callback(
-                partial(push_data_median, diode_t=diode_t_dict['dcc_t'], 
-                        diode=diode_dict['dcc_d'], buffer=buffer_dcc), 
+                partial(push_data_median, diode=rolling_dict['dcc'], 
+                        buffer=buffer_dcc), 
                 cb_time)
 
             cb_id_dci = doc.add_periodic_callback(
-                partial(push_data_median, diode_t=diode_t_dict['dci_t'], 
-                        diode=diode_dict['dci_d'], buffer=buffer_dci), 
+                partial(push_data_median, diode=rolling_dict['dci'], 
+                        buffer=buffer_dci), 
                 cb_time)
 
             cb_id_dco = doc.add_periodic_callback(
-                partial(push_data_median, diode_t=diode_t_dict['dco_t'], 
-                        diode=diode_dict['dco_d'], buffer=buffer_dco), 
+                partial(push_data_median, diode=rolling_dict['dco'], 
+                        buffer=buffer_dco), 
                 cb_time)
 
             cb_id_dd = doc.add_periodic_callback(
-                partial(push_data_median, diode_t=diode_t_dict['dd_t'], 
-                        diode=diode_dict['dd_d'], buffer=buffer_dd), 
+                partial(push_data_median, diode=rolling_dict['dd'], 
+                        buffer=buffer_dd), 
                 cb_time)
 
             cb_id_di = doc.add_periodic_callback(
-                partial(push_data_median, diode_t=diode_t_dict['di_t'], 
-                        diode=diode_dict['di_d'], buffer=buffer_di), 
+                partial(push_data_median, diode=rolling_dict['di'], 
+                        buffer=buffer_di), 
                 cb_time)
 
             cb_id_do = doc.add_periodic_callback(
-                partial(push_data_median, diode_t=diode_t_dict['do_t'], 
-                        diode=diode_dict['do_d'], buffer=buffer_do), 
+                partial(push_data_median, diode=rolling_dict['do'], 
+                        buffer=buffer_do), 
                 cb_time)
 
             cb_id_t1d = doc.add_periodic_callback(
-                partial(push_data_median, diode_t=diode_t_dict['t1d_t'], 
-                        diode=diode_dict['t1d_d'], buffer=buffer_t1d), 
+                partial(push_data_median, diode=rolling_dict['t1d'], 
+                        buffer=buffer_t1d), 
                 cb_time)
 
             cb_id_t4d = doc.add_periodic_callback(
-                partial(push_data_median, diode_t=diode_t_dict['t4d_t'], 
-                        diode=diode_dict['t4d_d'], buffer=buffer_t4d), 
+                partial(push_data_median, diode=rolling_dict['t4d'], 
+                        buffer=buffer_t4d), 
                 cb_time)
             
             # Callbacks for std lines
             cb_id_dcc_std = doc.add_periodic_callback(
-                partial(push_data_std, diode_t=diode_t_dict['dcc_t'], 
-                        diode=diode_dict['dcc_d'], buffer=b_dcc_std), 
+                partial(push_data_std, diode=rolling_dict['dcc'], 
+                        buffer=b_dcc_std), 
                 cb_time)
             cb_id_dci_std = doc.add_periodic_callback(
-                partial(push_data_std, diode_t=diode_t_dict['dci_t'], 
-                        diode=diode_dict['dci_d'], buffer=b_dci_std), 
+                partial(push_data_std, diode=rolling_dict['dci'], 
+                        buffer=b_dci_std), 
                 cb_time)
             cb_id_dco_std = doc.add_periodic_callback(
-                partial(push_data_std, diode_t=diode_t_dict['dco_t'], 
-                        diode=diode_dict['dco_d'], buffer=b_dco_std), 
+                partial(push_data_std, diode=rolling_dict['dco'], 
+                        buffer=b_dco_std), 
                 cb_time)
             cb_id_dd_std = doc.add_periodic_callback(
-                partial(push_data_std, diode_t=diode_t_dict['dd_t'], 
-                        diode=diode_dict['dd_d'], buffer=b_dd_std), 
+                partial(push_data_std, diode=rolling_dict['dd'], 
+                        buffer=b_dd_std), 
                 cb_time)
             cb_id_di_std = doc.add_periodic_callback(
-                partial(push_data_std, diode_t=diode_t_dict['di_t'], 
-                        diode=diode_dict['di_d'], buffer=b_di_std), 
+                partial(push_data_std, diode=rolling_dict['di'], 
+                        buffer=b_di_std), 
                 cb_time)
             cb_id_do_std = doc.add_periodic_callback(
-                partial(push_data_std, diode_t=diode_t_dict['do_t'], 
-                        diode=diode_dict['do_d'], buffer=b_do_std), 
+                partial(push_data_std, diode=rolling_dict['do'], 
+                        buffer=b_do_std), 
                 cb_time)
             cb_id_t1d_std = doc.add_periodic_callback(
-                partial(push_data_std, diode_t=diode_t_dict['t1d_t'], 
-                        diode=diode_dict['t1d_d'], buffer=b_t1d_std), 
+                partial(push_data_std, diode=rolling_dict['t1d'], 
+                        buffer=b_t1d_std), 
                 cb_time)
             cb_id_t4d_std = doc.add_periodic_callback(
-                partial(push_data_std, diode_t=diode_t_dict['t4d_t'], 
-                        diode=diode_dict['t4d_d'], buffer=b_t4d_std), 
+                partial(push_data_std, diode=rolling_dict['t4d'], 
+                        buffer=b_t4d_std), 
                 cb_time)
         else:
             startButton.label = '► Play'
@@ -408,12 +425,11 @@ def produce_curve(doc, diode_t_dict, diode_dict):
 
 def new_data(*args, **kwargs):
     """
-    Append data from subscribe into data containers
+    Append data from subscribe into ring buffer
     
     """
     
-    kwargs['in_value'].append(kwargs['value'])
-    kwargs['in_time'].append(kwargs['timestamp'])
+    kwargs['in_buffer'].append(kwargs['value'], kwargs['timestamp'])
     #print("I'm working!")
 
 def launch_server():
@@ -429,65 +445,54 @@ def launch_server():
     # Initialize data carriers
     beam = FakeEightBeams()
 
-    dcc_d = deque(maxlen=maxlen)
-    dci_d = deque(maxlen=maxlen)
-    dco_d = deque(maxlen=maxlen)
-    dd_d = deque(maxlen=maxlen)
-    di_d = deque(maxlen=maxlen)
-    do_d = deque(maxlen=maxlen)
-    t1d_d = deque(maxlen=maxlen)
-    t4d_d = deque(maxlen=maxlen)
-    
-    dcc_t = deque(maxlen=maxlen)
-    dci_t = deque(maxlen=maxlen)
-    dco_t = deque(maxlen=maxlen)
-    dd_t = deque(maxlen=maxlen)
-    di_t = deque(maxlen=maxlen)
-    do_t = deque(maxlen=maxlen)
-    t1d_t = deque(maxlen=maxlen)
-    t4d_t = deque(maxlen=maxlen)
-    
-    diode_dict = {'dcc_d':dcc_d, 'dci_d':dci_d, 
-                  'dco_d':dco_d, 'dd_d':dd_d, 
-                  'di_d':di_d, 'do_d':do_d, 
-                  't1d_d':t1d_d, 't4d_d':t4d_d}
-    
-    diode_t_dict = {'dcc_t':dcc_t, 'dci_t':dci_t,
-                    'dco_t':dco_t, 'dd_t':dd_t, 
-                    'di_t':di_t, 'do_t':do_t, 
-                    't1d_t':t1d_t, 't4d_t':t4d_t}
+    dcc = RingBuffer(maxlen)
+    dci = RingBuffer(maxlen)
+    dco = RingBuffer(maxlen)
+    dd = RingBuffer(maxlen)
+    di = RingBuffer(maxlen)
+    do = RingBuffer(maxlen)
+    t1d = RingBuffer(maxlen)
+    t4d = RingBuffer(maxlen)
+    
+    diode_dict = {'dcc':dcc, 'dci':dci, 
+                  'dco':dco, 'dd':dd, 
+                  'di':di, 'do':do, 
+                  't1d':t1d, 't4d':t4d}
+    
+    # Rolling median/std shared by every session
+    rolling_dict = {name: RollingWindow(120, source=diode) for name, diode in diode_dict.items()}
     
     # Subscribe to diodes
     beam.fake_dcc.subscribe(
-        partial(new_data, in_value=dcc_d, in_time=dcc_t)
+        partial(new_data, in_buffer=dcc)
     )
     
     beam.fake_dci.subscribe(
-        partial(new_data, in_value=dci_d, in_time=dci_t)
+        partial(new_data, in_buffer=dci)
     )
     
     beam.fake_dco.subscribe(
-        partial(new_data, in_value=dco_d, in_time=dco_t)
+        partial(new_data, in_buffer=dco)
     )
     
     beam.fake_dd.subscribe(
-        partial(new_data, in_value=dd_d, in_time=dd_t)
+        partial(new_data, in_buffer=dd)
     )
     
     beam.fake_di.subscribe(
-        partial(new_data, in_value=di_d, in_time=di_t)
+        partial(new_data, in_buffer=di)
     )
     
     beam.fake_do.subscribe(
-        partial(new_data, in_value=do_d, in_time=do_t)
+        partial(new_data, in_buffer=do)
     )
     
     beam.fake_t1d.subscribe(
-        partial(new_data, in_value=t1d_d, in_time=t1d_t)
+        partial(new_data, in_buffer=t1d)
     )
     
     beam.fake_t4d.subscribe(
-        partial(new_data, in_value=t4d_d, in_time=t4d_t)
+        partial(new_data, in_buffer=t4d)
     )
 
     origins = ["localhost:{}".format(5006)]
@@ -496,8 +501,8 @@ def launch_server():
         {
             '/Time_History': partial(
                 produce_curve,
-                diode_t_dict=diode_t_dict,
-                diode_dict=diode_dict
+                diode_dict=diode_dict,
+                rolling_dict=rolling_dict
             )
         },
         allow_websocket_origin=origins,
@@ -15,8 +15,9 @@ import tables
 from fake_timetool_beam import FakeTimetool
 from fake_beam import FakeBeam
 from functools import partial
-from collections import deque
+from ring_buffer import RingBuffer
 from event_builder import basic_event_builder
+from rolling import RollingCorrelation
 
 renderer = hv.renderer('bokeh').instance(mode='server')
 
@@ -39,7 +40,7 @@ def apply_formatter(plot, element):
         years=['%D %H:%M:%S'])
 
 
-def produce_graphs(doc, timetool_d, timetool_t, ipm2_d, ipm2_t, ipm3_d, ipm3_t):
+def produce_graphs(doc, timetool, ipm2, ipm3):
     
     switch_key = 'ipm2'
     
@@ -69,32 +70,28 @@ def produce_graphs(doc, timetool_d, timetool_t, ipm2_d, ipm2_t, ipm3_d, ipm3_t):
     cb_id_amp_ipm = None
     cb_id_timehistory = None
     
-    def push_data_scatter(timetool_d, timetool_t, buffer):
+    # Correlation state carried between ticks, pairs timetool and ipm samples
+    # by sequence number starting from corr_seq
+    correlation = RollingCorrelation(windows=(120,))
+    corr_seq = 0
+    
+    def push_data_scatter(timetool, buffer):
         
-        timeStuff = list(timetool_t)
-        # Convert time to seconds so bokeh formatter can get correct datetime
-        times = [1000*time for time in timeStuff]
+        tt_d, tt_t = timetool.last()
+        # Convert ns timestamps to ms so bokeh formatter can get correct datetime
+        times = tt_t/1e6
         
-        edgePos = []
-        for array in timetool_d:
-            edgePos.append(array[1])
+        edgePos = tt_d[:, 1]
             
         edgePos_data = pd.Series(edgePos, index=times)
         zipped = basic_event_builder(timetool_data=edgePos_data)
         buffer.send(zipped)
         
-    def push_data_amp_ipm (timetool_d, timetool_t, ipm2_d, ipm2_t, ipm3_d, ipm3_t, buffer):
-        
-        timeStuff = list(timetool_t)
-        # Convert time to seconds so bokeh formatter can get correct datetime
-        times = [1000*time for time in timeStuff]
+    def push_data_amp_ipm (timetool, ipm2, ipm3, buffer):
         
-        tt_d = list(timetool_d)
-        tt_t = list(timetool_t)
-        i2_d = list(ipm2_d)
-        i2_t = list(ipm2_t)
-        i3_d = list(ipm3_d)
-        i3_t = list(ipm3_t)
+        tt_d, tt_t = timetool.last()
+        i2_d, i2_t = ipm2.last()
+        i3_d, i3_t = ipm3.last()
         
         ipmValue = i2_d
         ipmTime = i2_t
@@ -113,58 +110,44 @@ def produce_graphs(doc, timetool_d, timetool_t, ipm2_d, ipm2_t, ipm3_d, ipm3_t):
             ipmValue = ipmValue[:len(tt_d)]
             ipmTime = ipmTime[:len(tt_d)]
         
-        edgeAmp = []
-        
-        for array in tt_d:
-            edgeAmp.append(array[2])
+        edgeAmp = tt_d[:, 2]
             
         data = pd.DataFrame({'timetool': edgeAmp, 'ipm': ipmValue})
         
         buffer.send(data)
                
         
-    def push_data_correlation_time_history(timetool_d, timetool_t, ipm2_d, ipm2_t, ipm3_d, ipm3_t, buffer):
+    def push_data_correlation_time_history(timetool, ipm2, ipm3, buffer):
         
-        timeStuff = list(timetool_t)
-        # Convert time to seconds so bokeh formatter can get correct datetime
-        times = [1000*time for time in timeStuff]
+        nonlocal corr_seq
         
-        tt_d = list(timetool_d)
-        tt_t = list(timetool_t)
-        i2_d = list(ipm2_d)
-        i2_t = list(ipm2_t)
-        i3_d = list(ipm3_d)
-        i3_t = list(ipm3_t)
-        
-        ipmValue = i2_d
-        ipmTime = i2_t
+        ipm = ipm2
         
         if switch_key == 'ipm2':
-            ipmValue = i2_d
-            ipmTime = i2_t
+            ipm = ipm2
         elif switch_key == 'ipm3':
-            ipmValue = i3_d
-            ipmTime = i3_t
+            ipm = ipm3
         
-        if len(tt_d) > len(ipmValue):
-            tt_d = tt_d[:len(ipmValue)]
-            tt_t = tt_t[:len(ipmValue)]
-        elif len(tt_d) < len(ipmValue):
-            ipmValue = ipmValue[:len(tt_d)]
-            ipmTime = ipmTime[:len(tt_d)]
-        
-        edgeAmp = []
+        # Only pairs that arrived since the last tick, as far back as both
+        # ring buffers still hold
+        end = min(timetool.seq, ipm.seq)
+        start = max(corr_seq, end - min(timetool.maxlen, ipm.maxlen))
+        corr_seq = end
+        tt_d, tt_t, _ = timetool.since(start)
+        ipmValue, ipmTime, _ = ipm.since(start)
+        tt_d = tt_d[:end - start]
+        tt_t = tt_t[:end - start]
+        ipmValue = ipmValue[:end - start]
         
-        for array in tt_d:
-            edgeAmp.append(array[2])
-        
-        data = pd.DataFrame({'timetool': edgeAmp, 'ipm': ipmValue})
+        # Convert ns timestamps to ms so bokeh formatter can get correct datetime
+        times = tt_t/1e6
+        edgeAmp = tt_d[:, 2]
         
-        data_list = data['timetool'].rolling(window=120).corr(other=data['ipm'])
+        data_list = correlation.add(edgeAmp, ipmValue)[120]
         
         final_df = pd.DataFrame({
-            'time': times[119:], 
-            'correlation': data_list[119:]
+            'time': times, 
+            'correlation': data_list
         })
         
         #print(final_df)
@@ -177,8 +160,10 @@ def produce_graphs(doc, timetool_d, timetool_t, ipm2_d, ipm2_t, ipm3_d, ipm3_t):
         
         """
         
-        nonlocal switch_key, b_timehistory, b_IpmAmp
+        nonlocal switch_key, b_timehistory, b_IpmAmp, correlation, corr_seq
         switch_key = select.value
+        correlation = RollingCorrelation(windows=(120,))
+        corr_seq = 0
         b_timehistory.clear()
         b_IpmAmp.clear()
         print(switch_key)
@@ -188,30 +173,23 @@ def produce_graphs(doc, timetool_d, timetool_t, ipm2_d, ipm2_t, ipm3_d, ipm3_t):
     
     cb_id_scatter = doc.add_periodic_callback(
         partial(push_data_scatter, 
-                timetool_d=timetool_d, 
-                timetool_t=timetool_t, 
+                timetool=timetool, 
                 buffer=b_scatter), 
         1000)
     
     cb_id_amp_ipm = doc.add_periodic_callback(
         partial(push_data_amp_ipm,
-                timetool_d=timetool_d, 
-                timetool_t=timetool_t,
-                ipm2_d=ipm2_d,
-                ipm2_t=ipm2_t,
-                ipm3_d=ipm3_d,
-                ipm3_t=ipm3_t,
+                timetool=timetool, 
+                ipm2=ipm2,
+                ipm3=ipm3,
                 buffer=b_IpmAmp), 
         1000)
     
     cb_id_timehistory = doc.add_periodic_callback(
         partial(push_data_correlation_time_history, 
-                timetool_d=timetool_d, 
-                timetool_t=timetool_t,
-                ipm2_d=ipm2_d,
-                ipm2_t=ipm2_t,
-                ipm3_d=ipm3_d,
-                ipm3_t=ipm3_t,
+                timetool=timetool, 
+                ipm2=ipm2,
+                ipm3=ipm3,
                 buffer=b_timehistory), 
         1000)
     
@@ -220,39 +198,37 @@ def produce_graphs(doc, timetool_d, timetool_t, ipm2_d, ipm2_t, ipm3_d, ipm3_t):
 
 def new_data(*args, **kwargs):
     """
-    Append data from subscribe into data containers
+    Append data from subscribe into ring buffer
     
     """
     
-    kwargs['in_value'].append(kwargs['value'])
-    kwargs['in_time'].append(kwargs['timestamp'])
+    kwargs['in_buffer'].append(kwargs['value'], kwargs['timestamp'])
     
 
 def launch_server():
    
     maxlen = 1000000
+    # Number of values in each TTALL waveform
+    timetool_width = 8
     
     # Initialize data carriers
-    timetool = FakeTimetool()
+    timetool_beam = FakeTimetool()
     ipm = FakeBeam()
 
-    timetool_d = deque(maxlen=maxlen)
-    timetool_t = deque(maxlen=maxlen)
-    ipm2_d = deque(maxlen=maxlen)
-    ipm2_t = deque(maxlen=maxlen)
-    ipm3_d = deque(maxlen=maxlen)
-    ipm3_t = deque(maxlen=maxlen)
+    timetool = RingBuffer(maxlen, shape=(timetool_width,))
+    ipm2 = RingBuffer(maxlen)
+    ipm3 = RingBuffer(maxlen)
     
-    timetool.fake_timetool.subscribe(
-        partial(new_data, in_value=timetool_d, in_time=timetool_t)
+    timetool_beam.fake_timetool.subscribe(
+        partial(new_data, in_buffer=timetool)
     )
     
     ipm.fake_ipm2.subscribe(
-        partial(new_data, in_value=ipm2_d, in_time=ipm2_t)
+        partial(new_data, in_buffer=ipm2)
     )
     
     ipm.fake_ipm3.subscribe(
-        partial(new_data, in_value=ipm3_d, in_time=ipm3_t)
+        partial(new_data, in_buffer=ipm3)
     )
     origins = ["localhost:{}".format(5006)]
     
@@ -260,12 +236,9 @@ def launch_server():
         {
             '/Testing': partial(
                 produce_graphs,
-                timetool_d=timetool_d,
-                timetool_t=timetool_t,
-                ipm2_d=ipm2_d,
-                ipm2_t=ipm2_t,
-                ipm3_d=ipm3_d,
-                ipm3_t=ipm3_t
+                timetool=timetool,
+                ipm2=ipm2,
+                ipm3=ipm3
             )
         },
         allow_websocket_origin=origins,
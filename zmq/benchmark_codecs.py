@@ -0,0 +1,78 @@
+"""
+Compare the codecs of framing.py on the kinds of arrays the masters publish:
+bytes on the wire against the CPU time it costs to encode and decode them.
+Only the codecs whose libraries are installed are run.
+
+    python benchmark_codecs.py [number of events]
+
+"""
+import sys
+import time
+
+import numpy as np
+
+from framing import CODECS, available_codecs, encode, decode
+
+
+def signals(n):
+    """
+    Return a dictionary of signal name to a typical array of n events at
+    120 Hz
+
+    """
+
+    rng = np.random.RandomState(0)
+    seconds = 1.5e9 + np.arange(n)/120.
+
+    # Slow drift plus shot to shot noise, like the ipm sums and diodes
+    drift = np.cumsum(rng.normal(0, 1e-3, n))
+    return {
+        'ipm sum (float64)': 2.0 + drift + rng.normal(0, 1e-2, n),
+        'ipm sum (float32)': (2.0 + drift + rng.normal(0, 1e-2, n)).astype(np.float32),
+        'timetool position': rng.normal(0.5, 0.05, n),
+        'timestamps (s)': seconds,
+        'event_time (sec, nsec)': np.column_stack([
+            seconds.astype(np.int64),
+            ((seconds % 1)*1e9).astype(np.int64)])}
+
+
+def timed(func, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        result = func()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+
+def benchmark(n=1000000, repeat=5):
+    """
+    Print the compression ratio and encode/decode throughput of every
+    available codec on every signal
+
+    """
+
+    missing = set(CODECS) - set(available_codecs())
+    if missing:
+        print('Not installed, skipped: ' + ', '.join(sorted(missing)))
+    print('%-24s %-14s %10s %8s %12s %12s' % (
+        'signal', 'codec', 'bytes', 'ratio', 'encode MB/s', 'decode MB/s'))
+
+    for name, array in sorted(signals(n).items()):
+        for codec in available_codecs():
+            frame, encode_time = timed(lambda: encode(array, codec), repeat)
+            buffer = memoryview(frame if codec != 'none' else array.tobytes())
+            decoded, decode_time = timed(
+                lambda: decode(buffer, array.dtype.str, array.shape, codec), repeat)
+            assert np.array_equal(decoded, array)
+
+            size = len(buffer) if codec != 'none' else array.nbytes
+            megabytes = array.nbytes / 1e6
+            print('%-24s %-14s %10d %8.2f %12.0f %12.0f' % (
+                name, codec, size, array.nbytes / float(size),
+                megabytes / max(encode_time, 1e-9), megabytes / max(decode_time, 1e-9)))
+
+
+if __name__ == '__main__':
+    benchmark(*[int(arg) for arg in sys.argv[1:2]])
@@ -0,0 +1,188 @@
+"""
+Forwarding broker between the master and the dashboards. The master
+publishes every message once to the broker, which fans it out to any
+number of Bokeh servers, so extra dashboard hosts don't load the MPI
+master rank. Run it on a core or node of its own, e.g.
+
+    taskset -c 3 python broker.py --master tcp://psanagpu114:5006 --port 5556
+
+and point the dashboards at tcp://<broker host>:5556 instead of the
+master, and at tcp://<broker host>:5557 for the cached messages.
+
+"""
+import argparse
+import time
+
+import zmq
+
+
+class Broker:
+    """
+    XSUB/XPUB proxy forwarding the subscriptions of the dashboards up to
+    the master and the messages of the channels they subscribed to down to
+    them.
+
+    With the cache on, the latest message of every channel is kept and
+    handed out on a REP socket on the next port (see
+    framing.fetch_cached()), so a new page gets data right away instead of
+    waiting for the next message of the master. Only the page asking gets
+    it, the ones already subscribed don't see it again.
+
+    Parameters
+    ----------
+
+    context: zmq.Context
+        Context to create sockets with
+
+    master: str
+        Address the master publishes on, e.g. "tcp://psanagpu114:5006"
+
+    port: int
+        Port to publish to the dashboards on
+
+    cache: bool
+        Whether to keep the latest message of every channel for new pages
+
+    """
+
+    def __init__(self, context, master, port, cache=True):
+        self.frontend = context.socket(zmq.XSUB)
+        self.frontend.connect(master)
+        self.backend = context.socket(zmq.XPUB)
+
+        # Hear every subscription, not only the first one to each channel
+        self.backend.setsockopt(zmq.XPUB_VERBOSE, 1)
+        self.backend.bind("tcp://*:%d" % port)
+
+        self.cache = None
+        self.snapshots = None
+        if cache:
+            self.cache = {}
+            self.snapshots = context.socket(zmq.REP)
+            self.snapshots.bind("tcp://*:%d" % (port + 1))
+        self.topics = set()
+        self._reset_metrics()
+
+    def _reset_metrics(self):
+        self.messages = 0
+        self.bytes = 0
+        self.subscriptions = 0
+        self.snapshots_sent = 0
+        self.send_time = 0.
+        self.max_send_time = 0.
+        self.started = time.time()
+
+    def forward(self):
+        """
+        Send a message from the master to the dashboards
+
+        """
+
+        frames = self.frontend.recv_multipart(copy=False)
+
+        # Time it takes to hand the message to the XPUB
+        start = time.time()
+        self.backend.send_multipart(frames, copy=False)
+        send_time = time.time() - start
+        if self.cache is not None:
+            self.cache[frames[0].bytes] = frames
+
+        self.messages += 1
+        self.bytes += sum(len(frame.buffer) for frame in frames)
+        self.send_time += send_time
+        self.max_send_time = max(self.max_send_time, send_time)
+
+    def subscription(self):
+        """
+        Pass a (un)subscription of a dashboard on to the master
+
+        """
+
+        message = self.backend.recv()
+        subscribe, topic = message[:1] == b'\x01', message[1:]
+
+        # The master only needs to hear once that a channel is wanted, and
+        # unsubscriptions only come once no page wants it anymore
+        if subscribe and topic not in self.topics:
+            self.topics.add(topic)
+            self.frontend.send(message)
+        elif not subscribe:
+            self.topics.discard(topic)
+            self.frontend.send(message)
+
+        if subscribe:
+            self.subscriptions += 1
+
+    def snapshot(self):
+        """
+        Answer a page asking for the cached message of a channel, with an
+        empty frame if there is none yet
+
+        """
+
+        name = self.snapshots.recv()
+        frames = self.cache.get(name + b'\x00')
+        self.snapshots.send_multipart(frames or [b''], copy=False)
+        self.snapshots_sent += 1
+
+    def metrics(self):
+        """
+        Return the throughput and the time it took to hand messages to the
+        XPUB since the last call, and start counting again
+
+        """
+
+        elapsed = max(time.time() - self.started, 1e-9)
+        metrics = {
+            'messages/s': self.messages / elapsed,
+            'MB/s': self.bytes / elapsed / 1e6,
+            'mean send time (ms)': 1e3 * self.send_time / max(self.messages, 1),
+            'max send time (ms)': 1e3 * self.max_send_time,
+            'subscriptions': self.subscriptions,
+            'snapshots': self.snapshots_sent,
+            'channels': len(self.topics)}
+        self._reset_metrics()
+        return metrics
+
+    def run(self, interval=10.):
+        """
+        Forward messages and subscriptions until interrupted, printing the
+        metrics every interval seconds
+
+        """
+
+        poller = zmq.Poller()
+        poller.register(self.frontend, zmq.POLLIN)
+        poller.register(self.backend, zmq.POLLIN)
+        if self.snapshots is not None:
+            poller.register(self.snapshots, zmq.POLLIN)
+
+        last = time.time()
+        while True:
+            events = dict(poller.poll(1000))
+            if self.backend in events:
+                self.subscription()
+            if self.frontend in events:
+                self.forward()
+            if self.snapshots in events:
+                self.snapshot()
+
+            if time.time() - last >= interval:
+                last = time.time()
+                print(', '.join('%s: %.3g' % item for item in sorted(self.metrics().items())))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--master", help="address the master publishes on", default="tcp://psanagpu114:5006")
+    parser.add_argument("--port", help="port to publish to the dashboards on", default=5556, type=int)
+    parser.add_argument("--no-cache", help="don't keep the latest message of every channel for new pages",
+                        action='store_true')
+    parser.add_argument("--interval", help="seconds between metrics printouts", default=10., type=float)
+    args = parser.parse_args()
+
+    broker = Broker(zmq.Context(), args.master, args.port, cache=not args.no_cache)
+    try:
+        broker.run(args.interval)
+    except KeyboardInterrupt:
+        print("terminating")
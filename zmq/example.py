@@ -3,6 +3,7 @@ from bokeh.application import Application
 from bokeh.application.handlers.function import FunctionHandler
 import zmq
 from functools import partial
+from framing import recv_channels
 
 def make_document(context, doc):
     print("Make doc")
@@ -14,8 +15,8 @@ def make_document(context, doc):
     
     def update():
         print("Update")
-        if socket.poll(timeout=0):
-            stuff = socket.recv_pyobj()
+        stuff = recv_channels(socket)
+        if stuff:
             print(stuff.keys())
 
     doc.add_periodic_callback(update, 1000)
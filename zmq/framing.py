@@ -0,0 +1,428 @@
+import json
+import time
+import weakref
+import zlib
+from collections import deque
+
+import numpy as np
+import zmq
+
+# Optional codecs, messages using them can only be read where they're installed
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# Ways array frames can be compressed, see encode()
+CODECS = ('none', 'shuffle-lz4', 'shuffle-zlib', 'delta-zstd')
+
+
+def topic(name):
+    """
+    Return the topic a channel is published under. Topics end with a null
+    byte so subscribing to 'peak_1' doesn't also match 'peak_10'.
+
+    """
+
+    return name.encode('utf-8') + b'\x00'
+
+
+def subscribe(socket, names):
+    """
+    Subscribe a SUB socket to the topics of some channels
+
+    """
+
+    for name in names:
+        socket.setsockopt(zmq.SUBSCRIBE, topic(name))
+
+
+def unsubscribe(socket, names):
+    """
+    Unsubscribe a SUB socket from the topics of some channels
+
+    """
+
+    for name in names:
+        socket.setsockopt(zmq.UNSUBSCRIBE, topic(name))
+
+
+def available_codecs():
+    """
+    Return the codecs the libraries installed here can encode and decode
+
+    """
+
+    return tuple(codec for codec in CODECS
+                 if not (codec.endswith('lz4') and lz4 is None)
+                 and not (codec.endswith('zstd') and zstandard is None))
+
+
+def encode(array, codec):
+    """
+    Return an array compressed with a codec as bytes, or the array itself
+    for 'none'
+
+    - 'shuffle-lz4': bytes regrouped by significance (all first bytes, then
+      all second bytes, ...) then lz4, fast and good on slowly varying
+      floats whose high bytes barely change
+    - 'shuffle-zlib': the same with zlib, slower but always installed
+    - 'delta-zstd': differences between consecutive rows of the bit
+      patterns, shuffled, then zstd, for monotonic timestamps
+
+    Parameters
+    ----------
+
+    array: numpy.array
+        Contiguous array to compress
+
+    codec: str
+        One of available_codecs()
+
+    """
+
+    if codec == 'none':
+        return array
+    if codec not in available_codecs():
+        raise ValueError("Codec %s isn't available, pick one of %s" % (codec, ', '.join(available_codecs())))
+
+    if codec == 'delta-zstd':
+        array = _delta(array)
+    shuffled = _shuffle(array)
+    if codec == 'shuffle-lz4':
+        return lz4.frame.compress(shuffled)
+    if codec == 'shuffle-zlib':
+        return zlib.compress(shuffled, 1)
+    return zstandard.ZstdCompressor(level=3).compress(shuffled)
+
+
+def decode(buffer, dtype, shape, codec):
+    """
+    Rebuild an array from a frame encoded with encode()
+
+    """
+
+    dtype = np.dtype(dtype)
+    if codec == 'none':
+        return np.frombuffer(buffer, dtype=dtype).reshape(shape)
+    compressed = np.frombuffer(buffer, dtype=np.uint8).tobytes()
+    if codec == 'shuffle-lz4':
+        shuffled = lz4.frame.decompress(compressed)
+    elif codec == 'shuffle-zlib':
+        shuffled = zlib.decompress(compressed)
+    else:
+        shuffled = zstandard.ZstdDecompressor().decompress(compressed)
+    array = _unshuffle(shuffled, dtype).reshape(shape)
+    if codec == 'delta-zstd':
+        array = _undelta(array)
+    return array
+
+
+def _shuffle(array):
+    grouped = array.reshape(-1).view(np.uint8).reshape(-1, array.dtype.itemsize)
+    return grouped.T.tobytes()
+
+
+def _unshuffle(shuffled, dtype):
+    grouped = np.frombuffer(shuffled, dtype=np.uint8).reshape(dtype.itemsize, -1)
+    return np.ascontiguousarray(grouped.T).view(dtype).reshape(-1)
+
+
+def _bits(array):
+    # Same size unsigned integers, wrapping around makes the deltas exact
+    return array.view(np.dtype('u%d' % array.dtype.itemsize))
+
+
+def _delta(array):
+    if array.ndim == 0 or len(array) == 0:
+        return array
+    bits = _bits(array)
+    delta = np.empty_like(bits)
+    delta[:1] = bits[:1]
+    np.subtract(bits[1:], bits[:-1], out=delta[1:])
+    return delta.view(array.dtype)
+
+
+def _undelta(array):
+    if array.ndim == 0 or len(array) == 0:
+        return array
+    bits = _bits(array)
+    return np.cumsum(bits, axis=0, dtype=bits.dtype).view(array.dtype)
+
+
+def send_message(socket, message, flags=0, channel=None, codec='none', codecs=None):
+    """
+    Send a message as a multipart ZMQ message: a JSON header followed by
+    the raw buffer of every numpy array in it, one frame each, sent without
+    copying. Replaces send_pyobj, which boxes and copies every element.
+
+    The header is the message with each array replaced by a reference to
+    its frame, dtype and shape, so messages can be dictionaries, lists,
+    strings and numbers nested any way with arrays anywhere. Arrays of
+    Python objects can't be framed.
+
+    Note: frames are sent from ZMQ's own thread, so arrays must not be
+    written to until the send is done.
+
+    Parameters
+    ----------
+
+    socket: zmq.Socket
+        Socket to send on
+
+    message: object
+        Message to send
+
+    flags: int
+        ZMQ send flags, e.g. zmq.NOBLOCK
+
+    channel: str
+        Channel the message is about, sent first as its topic so SUB
+        sockets only get the channels they subscribed to
+
+    codec: str
+        Codec to compress array frames with, see encode(). The codec of
+        every frame is written in the header for the receiver to decode it.
+
+    codecs: dict
+        Codec to use instead for the arrays under some dictionary keys,
+        e.g. {'peak_8_TS': 'delta-zstd'}
+
+    """
+
+    frames = []
+    header = _pack(message, frames, codec, codecs or {})
+    frames.insert(0, json.dumps(header).encode('utf-8'))
+    if channel is not None:
+        frames.insert(0, topic(channel))
+
+    # A future to await with zmq.asyncio sockets
+    return socket.send_multipart(frames, flags=flags, copy=False)
+
+
+def recv_message(socket, flags=0, channel=False):
+    """
+    Receive a message sent with send_message(), with channel=True if it was
+    sent with a channel. Arrays are rebuilt with np.frombuffer on the
+    received frames without copying (uncompressed ones) or on the
+    decompressed bytes, so they are read-only.
+
+    """
+
+    return unpack_message(socket.recv_multipart(flags=flags, copy=False), channel)
+
+
+def unpack_message(frames, channel=False):
+    """
+    Rebuild a message from the frames sent with send_message(), e.g. the
+    result of awaiting recv_multipart(copy=False) on a zmq.asyncio socket
+
+    """
+
+    if channel:
+        frames = frames[1:]
+    header = json.loads(frames[0].bytes.decode('utf-8'))
+    return _unpack(header, frames)
+
+
+def recv_channels(socket):
+    """
+    Receive every message waiting on a SUB socket, each a dictionary of
+    channel name to data sent with its channel, and return them merged into
+    one dictionary holding the latest data of each channel. Only the latest
+    message of each channel is decoded. The Conflater of a socket is made
+    on the first call and kept for the next ones.
+
+    """
+
+    if socket not in _conflaters:
+        _conflaters[socket] = Conflater(socket)
+    return _conflaters[socket].receive()
+
+
+# Conflater of every socket recv_channels() was called with
+_conflaters = weakref.WeakKeyDictionary()
+
+
+def fetch_cached(context, address, names, timeout=1000):
+    """
+    Ask a broker.py for the latest message of some channels, and return the
+    frames of every one it has cached as they would arrive on a SUB socket.
+    Gives up on a broker that doesn't answer within timeout ms.
+
+    """
+
+    socket = context.socket(zmq.REQ)
+    socket.connect(address)
+    cached = []
+    try:
+        for name in names:
+            socket.send(name.encode('utf-8'))
+            if not socket.poll(timeout):
+                break
+            frames = socket.recv_multipart(copy=False)
+            if len(frames) > 1:
+                cached.append(frames)
+    finally:
+        socket.close(linger=0)
+    return cached
+
+
+class Conflater:
+    """
+    Latest-value delivery of the channels published on a SUB socket, for
+    masters sending the whole history of a channel in every message like
+    zmq/master.py does.
+
+    drain() takes every waiting message off the socket without decoding it
+    and only keeps the latest one of each channel, so a paused or slow
+    client holds one message per channel instead of a growing backlog.
+    receive() decodes those once and hands them out as one merged update.
+    ZMQ_CONFLATE can't do this, it only keeps one message of the whole
+    socket and breaks multipart messages.
+
+    Channels whose messages only hold what is new can be queued instead:
+    every message is kept, up to queue_length, and receive() hands out the
+    list of their data in the order they arrived. Beyond queue_length the
+    oldest message is dropped.
+
+    ``dropped`` counts the messages replaced by a newer one of the same
+    channel, or pushed out of a full queue, before being received. ``lag``
+    is how many seconds the oldest message behind the last receive()
+    waited. ``publishes`` holds the 'publish' number the latest message of
+    each channel was sent with, for masters numbering their publishes.
+
+    Parameters
+    ----------
+
+    socket: zmq.Socket
+        SUB socket subscribed to the channels to receive
+
+    hwm: int
+        Most messages ZMQ queues for the socket before dropping new ones
+        (RCVHWM). Only applies to connections made afterwards.
+
+    policies: dict
+        'latest' or 'queue' by channel name, 'latest' for the others
+
+    queue_length: int
+        Most messages kept for a queued channel
+
+    """
+
+    def __init__(self, socket, hwm=None, policies=None, queue_length=1000):
+        self.socket = socket
+        if hwm is not None:
+            socket.setsockopt(zmq.RCVHWM, hwm)
+        self.policies = policies or {}
+        self.queue_length = queue_length
+        self.pending = {}
+        self.arrived = {}
+        self.dropped = 0
+        self.lag = 0.
+        self.publishes = {}
+
+    def _queued(self, channel):
+        return self.policies.get(channel, 'latest') == 'queue'
+
+    def drain(self):
+        """
+        Take every message waiting on the socket, keeping the latest of
+        each channel or queueing it
+
+        """
+
+        while self.socket.poll(timeout=0):
+            self.put(self.socket.recv_multipart(copy=False))
+
+    def put(self, frames):
+        """
+        Add the frames of a message received some other way, e.g. from
+        fetch_cached()
+
+        """
+
+        channel = frames[0].bytes[:-1].decode('utf-8')
+        if channel not in self.pending:
+            self.arrived[channel] = time.time()
+
+        if self._queued(channel):
+            queue = self.pending.setdefault(channel, deque(maxlen=self.queue_length))
+            if len(queue) == queue.maxlen:
+                self.dropped += 1
+            queue.append(frames)
+        else:
+            if channel in self.pending:
+                self.dropped += 1
+            self.pending[channel] = frames
+
+    def _unpack(self, frames):
+        message = unpack_message(frames, channel=True)
+        publish = message.pop('publish', None)
+        for name in message:
+            self.publishes[name] = publish
+        return message
+
+    def receive(self):
+        """
+        Drain the socket and return the data of every channel that arrived
+        since the last call merged into one dictionary, the latest data or
+        the list of queued data of each channel
+
+        """
+
+        self.drain()
+        now = time.time()
+        self.lag = max([now - arrived for arrived in self.arrived.values()] or [0.])
+
+        latest = {}
+        for channel, pending in self.pending.items():
+            if self._queued(channel):
+                messages = [self._unpack(frames) for frames in pending]
+                for name in messages[0]:
+                    latest[name] = [message[name] for message in messages]
+            else:
+                latest.update(self._unpack(pending))
+        self.pending.clear()
+        self.arrived.clear()
+        return latest
+
+
+def _pack(value, frames, codec, codecs):
+    if isinstance(value, np.ndarray):
+        if value.dtype.hasobject:
+            raise TypeError("Arrays of objects can't be sent as frames")
+        value = np.ascontiguousarray(value)
+        frame = encode(value, codec)
+
+        # Not worth it for small or noisy arrays
+        if codec != 'none' and len(frame) >= value.nbytes:
+            frame, codec = value, 'none'
+        frames.append(frame)
+        return {'__array__': len(frames), 'dtype': value.dtype.str, 'shape': value.shape,
+                'codec': codec}
+    if isinstance(value, dict):
+        return dict((key, _pack(item, frames, codecs.get(key, codec), codecs))
+                    for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return [_pack(item, frames, codec, codecs) for item in value]
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def _unpack(value, frames):
+    if isinstance(value, dict):
+        if '__array__' in value:
+            return decode(frames[value['__array__']].buffer, value['dtype'], value['shape'],
+                          value.get('codec', 'none'))
+        return dict((key, _unpack(item, frames)) for key, item in value.items())
+    if isinstance(value, list):
+        return [_unpack(item, frames) for item in value]
+    return value
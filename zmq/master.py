@@ -5,6 +5,7 @@ size = comm.Get_size()
 
 import numpy as np
 from mpidata import mpidata 
+from framing import send_message
 import zmq
 import random
 import sys
@@ -12,14 +13,16 @@ import time
 
 # Only make socket and connection once
 
-def runmaster(nClients):
+def runmaster(nClients, codec='none', time_codec='none'):
     global socket
     port = "5006"
     context = zmq.Context()
     socket = context.socket(zmq.PUB)
+    # Run broker.py in front of this to fan out to many dashboards
     socket.bind("tcp://*:%s" % port)
 
     myDict={}
+    publish = 0
     while nClients > 0:
         # Remove client if the run ended
         md = mpidata()
@@ -47,17 +50,22 @@ def runmaster(nClients):
             #md.addarray('evt_ts',np.array(evt_ts))
             evt_ts_str = '%.4f'%(md.send_timeStamp[0] + md.send_timeStamp[1]/1e9)
             #here we will send the dict (or whatever we make this here) to the plots.
-            dataToZMQ(myDict, evt_ts_str)
+            dataToZMQ(myDict, evt_ts_str, publish, codec, {'event_time': time_codec})
+            publish += 1
             print("Send")
 
 
-def dataToZMQ(sumDict, event_ts_str):
+def dataToZMQ(sumDict, event_ts_str, publish, codec='none', codecs=None):
     #here we will issue the ZMQ send command. I am not sure what format the data should have here.
     
     #placeholder code
     #print 'DEBUG keys: ',sumDict['event_time'].shape, sumDict.keys()
 
-    socket.send_pyobj(sumDict)
+    # One message per channel so clients only get the channels they subscribe to,
+    # compressed with the codec of the channel if it has one. Every message of a
+    # publish carries its number, so clients can tell which channels go together.
+    for name, values in sumDict.items():
+        send_message(socket, {name: values, 'publish': publish}, channel=name, codec=codec, codecs=codecs)
 
 #
 # the app to go with this is like the code written for EPICS, except that the data going into the stream/buffer is not event built from EPICS, but instead received from ZMQ.
@@ -18,11 +18,13 @@ import argparse
 parser = argparse.ArgumentParser()
 parser.add_argument("exprun", help="psana experiment/run string (e.g. exp=xppd7114:run=43)")
 parser.add_argument("-n","--noe",help="number of events, all events=0",default=-1, type=int)
+parser.add_argument("--codec",help="codec to compress published arrays with (none, shuffle-lz4, shuffle-zlib, delta-zstd)",default='none')
+parser.add_argument("--time-codec",help="codec to compress event_time with",default='none')
 
 args = parser.parse_args()
 
 if rank==0:
-    runmaster(numClients)
+    runmaster(numClients, args.codec, args.time_codec)
 else:
     runclient(args)
 
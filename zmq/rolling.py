@@ -0,0 +1,298 @@
+import math
+from bisect import bisect_left, insort
+from collections import deque
+
+import numpy as np
+
+from ring_buffer import RingBuffer
+
+
+class RollingWindow:
+    """
+    Stateful rolling median and standard deviation of one channel.
+
+    Gives the same numbers as pandas' rolling(window, min_periods=1)
+    median() and std(), but keeps the window between calls (a sorted list
+    for the median, running sums for the std) and only computes outputs for
+    newly added samples. Results go into the ``median`` and ``std`` ring
+    buffers, so one instance can be shared by every session of a server,
+    each reading with its own cursor or just calling last().
+
+    Parameters
+    ----------
+
+    window: int
+        Number of samples in the window
+
+    maxlen: int
+        Number of results to keep, defaults to the source's maxlen
+
+    source: RingBuffer
+        Optional ring buffer to follow with update(). Samples can also be
+        passed in by hand with add().
+
+    """
+
+    def __init__(self, window=120, maxlen=None, source=None):
+        if maxlen is None:
+            maxlen = source.maxlen
+        self.window = window
+        self.source = source
+        self.median = RingBuffer(maxlen)
+        self.std = RingBuffer(maxlen)
+        self._cursor = 0
+        self._last_ts = None
+        self._values = deque()
+        self._sorted = []
+        self._sum = 0.0
+        self._sumsq = 0.0
+        self._count = 0
+
+    def update(self):
+        """
+        Compute results for every sample added to the source since the
+        last call
+
+        """
+
+        values, timestamps, self._cursor = self.source.since(self._cursor)
+        self.add(values, timestamps/1e9)
+
+    def add(self, values, timestamps):
+        """
+        Add samples with timestamps in seconds. Anything at or before the
+        last timestamp already added is ignored, so the full history can be
+        passed in again without repeating results.
+
+        """
+
+        values = np.asarray(values, dtype=np.float64)
+        timestamps = np.asarray(timestamps, dtype=np.float64)
+        if self._last_ts is not None:
+            start = np.searchsorted(timestamps, self._last_ts, side='right')
+            values = values[start:]
+            timestamps = timestamps[start:]
+        if len(timestamps) == 0:
+            return
+        self._last_ts = timestamps[-1]
+
+        medians = np.empty(len(values))
+        stds = np.empty(len(values))
+        window = self._values
+        ordered = self._sorted
+        for i, value in enumerate(values.tolist()):
+            if len(window) == self.window:
+                old = window.popleft()
+                del ordered[bisect_left(ordered, old)]
+                self._sum -= old
+                self._sumsq -= old*old
+            window.append(value)
+            insort(ordered, value)
+            self._sum += value
+            self._sumsq += value*value
+
+            # Resum now and then so rounding errors can't build up
+            self._count += 1
+            if self._count % self.window == 0:
+                self._sum = math.fsum(window)
+                self._sumsq = math.fsum(v*v for v in window)
+
+            n = len(ordered)
+            mid = n // 2
+            medians[i] = ordered[mid] if n % 2 else (ordered[mid - 1] + ordered[mid]) / 2
+            if n > 1:
+                stds[i] = math.sqrt(max((self._sumsq - self._sum*self._sum/n) / (n - 1), 0))
+            else:
+                stds[i] = np.nan
+
+        self.median.extend(medians, timestamps)
+        self.std.extend(stds, timestamps)
+
+
+class RollingCorrelation:
+    """
+    Streaming rolling correlation between two paired channels.
+
+    Keeps the last samples of the longest window between calls, so each
+    call to add() only works on the new pairs (plus one window of history)
+    using running sums, and returns one correlation per new pair for every
+    window. There is no warm-up gap between calls: a pair near the start of
+    a batch still sees the samples from the previous batch.
+
+    Parameters
+    ----------
+
+    windows: tuple
+        Window lengths in samples
+
+    min_periods: int
+        Fewest samples needed for a correlation, NaN before that
+
+    """
+
+    def __init__(self, windows=(120,), min_periods=2):
+        self.windows = tuple(windows)
+        self.min_periods = min_periods
+        self._x = np.empty(0)
+        self._y = np.empty(0)
+
+    def add(self, x, y):
+        """
+        Add new pairs and return a dictionary of window length to a numpy
+        array with the correlation at every new pair
+
+        """
+
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        if len(x) == 0:
+            return dict((window, np.empty(0)) for window in self.windows)
+
+        history = len(self._x)
+        x = np.concatenate([self._x, x])
+        y = np.concatenate([self._y, y])
+
+        # Running sums, shifted by the first value to keep them small
+        sums = []
+        dx = x - x[0]
+        dy = y - y[0]
+        for column in (dx, dy, dx*dx, dy*dy, dx*dy):
+            sums.append(np.concatenate([[0.], np.cumsum(column)]))
+        cx, cy, cxx, cyy, cxy = sums
+
+        result = dict()
+        end = np.arange(history + 1, len(x) + 1)
+        for window in self.windows:
+            start = np.maximum(end - window, 0)
+            n = end - start
+            sx = cx[end] - cx[start]
+            sy = cy[end] - cy[start]
+            with np.errstate(invalid='ignore', divide='ignore'):
+                cov = (cxy[end] - cxy[start]) - sx*sy/n
+                var_x = (cxx[end] - cxx[start]) - sx*sx/n
+                var_y = (cyy[end] - cyy[start]) - sy*sy/n
+                corr = cov / np.sqrt(var_x*var_y)
+            corr[n < self.min_periods] = np.nan
+            result[window] = corr
+
+        keep = max(self.windows) - 1
+        self._x = x[max(len(x) - keep, 0):] if keep > 0 else x[:0]
+        self._y = y[max(len(y) - keep, 0):] if keep > 0 else y[:0]
+        return result
+
+
+class CorrelationMatrix:
+    """
+    Incremental correlation matrix of several event built channels, both
+    over a rolling window of events and over everything since the last
+    clear().
+
+    Each call to add() costs one pass over the new events: the rolling
+    window keeps running sums and cross products (events falling out of the
+    window are subtracted again), and the since-clear moments are merged in
+    batch by batch.
+
+    Parameters
+    ----------
+
+    names: list
+        Channel names, one column of the events passed to add() each
+
+    window: int
+        Number of events in the rolling window
+
+    """
+
+    def __init__(self, names, window=1200):
+        self.names = list(names)
+        self.window = window
+        size = len(self.names)
+        self._events = RingBuffer(window, shape=(size,))
+        self._shift = None
+        self._sum = np.zeros(size)
+        self._products = np.zeros((size, size))
+        self._added = 0
+        self.clear()
+
+    def clear(self):
+        """
+        Restart the since-clear moments, the rolling window is kept
+
+        """
+
+        size = len(self.names)
+        self.count = 0
+        self._mean = np.zeros(size)
+        self._comoment = np.zeros((size, size))
+
+    def add(self, events, timestamps):
+        """
+        Add new events
+
+        Parameters
+        ----------
+
+        events: numpy.array
+            One row per event, one column per channel
+
+        timestamps: numpy.array
+            Event timestamps in seconds
+
+        """
+
+        events = np.asarray(events, dtype=np.float64).reshape(-1, len(self.names))
+        count = len(events)
+        if count == 0:
+            return
+
+        # Since clear, merge the moments of the batch into the running ones
+        batch_mean = events.mean(axis=0)
+        centred = events - batch_mean
+        total = self.count + count
+        delta = batch_mean - self._mean
+        self._comoment += centred.T.dot(centred) + np.outer(delta, delta)*self.count*count/total
+        self._mean += delta*count/total
+        self.count = total
+
+        # Rolling window, only the newest window events can stay
+        if self._shift is None:
+            self._shift = events[0].copy()
+        events = events[-self.window:]
+        timestamps = np.asarray(timestamps)[-self.window:]
+        old, _ = self._events.last()
+        dropped = old[:max(len(old) + len(events) - self.window, 0)] - self._shift
+        new = events - self._shift
+        self._sum += new.sum(axis=0) - dropped.sum(axis=0)
+        self._products += new.T.dot(new) - dropped.T.dot(dropped)
+        self._events.extend(events, timestamps)
+
+        # Resum now and then so rounding errors can't build up
+        self._added += len(events)
+        if self._added >= self.window:
+            current = self._events.last()[0] - self._shift
+            self._sum = current.sum(axis=0)
+            self._products = current.T.dot(current)
+            self._added = 0
+
+    def _correlation(self, covariance):
+        scale = np.sqrt(np.diag(covariance))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return covariance / np.outer(scale, scale)
+
+    def correlation(self, since_clear=False):
+        """
+        Return the correlation matrix as a numpy array, over the rolling
+        window or since the last clear()
+
+        """
+
+        if since_clear:
+            if self.count < 2:
+                return np.full((len(self.names),)*2, np.nan)
+            return self._correlation(self._comoment / (self.count - 1))
+
+        count = len(self._events)
+        if count < 2:
+            return np.full((len(self.names),)*2, np.nan)
+        covariance = (self._products - np.outer(self._sum, self._sum)/count) / (count - 1)
+        return self._correlation(covariance)
@@ -16,6 +16,7 @@ from holoviews.streams import Buffer
 import tables
 from functools import partial
 from collections import deque
+from framing import recv_channels, subscribe
 import datetime
 
 renderer = hv.renderer('bokeh').instance(mode='server')
@@ -45,7 +46,7 @@ def produce_graphs(context, doc):
     socket = context.socket(zmq.SUB)
     # MUST BE FROM SAME MACHINE, CHANGE IF NECESSARY!!!
     socket.connect("tcp://psanagpu114:%d" % port)
-    socket.setsockopt(zmq.SUBSCRIBE, b"")
+    subscribe(socket, ['tt__FLTPOS_PS', 'tt__AMPL', 'ipm2__sum', 'event_time'])
         
     b_scatter = Buffer(pd.DataFrame({'timetool': []}), length=40000)
     b_IpmAmp = Buffer(pd.DataFrame({'ipm':[]}), length=1000)
@@ -71,6 +72,26 @@ def produce_graphs(context, doc):
     cb_id_scatter = None
     cb_id_amp_ipm = None
     cb_id_timehistory = None
+    
+    # Latest data of every channel, and the channels each plot hasn't seen yet
+    latest = {}
+    unseen = {'scatter': set(), 'amp_ipm': set(), 'correlation': set()}
+    
+    def receive(plot, names):
+        """
+        Return the latest data of the channels a plot needs if any of them
+        arrived since the plot last got them, None otherwise
+        
+        """
+        
+        received = recv_channels(socket)
+        latest.update(received)
+        for channels in unseen.values():
+            channels.update(received)
+        if not unseen[plot] & set(names) or not all(name in latest for name in names):
+            return None
+        unseen[plot] -= set(names)
+        return dict((name, latest[name]) for name in names)
  
     def push_data_scatter(buffer):
         
@@ -78,8 +99,8 @@ def produce_graphs(context, doc):
         timetool_t = deque(maxlen=1000000)
         
         # Current bug, may need to have continuous stream of data?
-        if socket.poll(timeout=0):
-            stuff = socket.recv_pyobj()
+        stuff = receive('scatter', ['tt__FLTPOS_PS', 'event_time'])
+        if stuff:
             timetool_d = stuff['tt__FLTPOS_PS']
             
             timeData = deque(maxlen=1000000)
@@ -106,8 +127,8 @@ def produce_graphs(context, doc):
         timetool_d = deque(maxlen=1000000)
         ipm2_d = deque(maxlen=1000000)
         
-        if socket.poll(timeout=0):
-            stuff = socket.recv_pyobj()
+        stuff = receive('amp_ipm', ['tt__AMPL', 'ipm2__sum'])
+        if stuff:
             timetool_d = stuff['tt__AMPL']
             ipm2_d = stuff['ipm2__sum']
 
@@ -124,8 +145,8 @@ def produce_graphs(context, doc):
         timetool_t = deque(maxlen=1000000)
         ipm2_d = deque(maxlen=1000000)
         
-        if socket.poll(timeout=0):
-            stuff = socket.recv_pyobj()
+        stuff = receive('correlation', ['tt__FLTPOS_PS', 'ipm2__sum', 'event_time'])
+        if stuff:
             timetool_d = stuff['tt__FLTPOS_PS']
             ipm2_d = stuff['ipm2__sum']
             
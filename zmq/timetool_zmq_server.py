@@ -7,7 +7,7 @@ import holoviews as hv
 import pandas as pd
 
 from bokeh.layouts import layout, widgetbox, row, column
-from bokeh.models import Button, Slider, Select, HoverTool, DatetimeTickFormatter
+from bokeh.models import Button, Slider, Select, HoverTool, DatetimeTickFormatter, Div
 from bokeh.plotting import curdoc
 from bokeh.io import output_file, save
 from bokeh.server.server import Server
@@ -18,6 +18,8 @@ from holoviews.core import util
 import tables
 from functools import partial
 from collections import deque
+from rolling import RollingCorrelation
+from framing import Conflater, fetch_cached, subscribe, unsubscribe
 import datetime
 
 renderer = hv.renderer('bokeh').instance(mode='server')
@@ -56,8 +58,11 @@ def my_partial(func, *args, **kwargs):
     
 class BokehApp:
     
-    def __init__(self):
+    def __init__(self, hwm, address, cache_address):
         self.switchButton = 'ipm2__sum'
+        self.hwm = hwm
+        self.address = address
+        self.cache_address = cache_address
         self.maxlen = 1000000
         
         # Initialize buffers
@@ -65,10 +70,20 @@ class BokehApp:
         self.b_IpmAmp = Buffer(pd.DataFrame({'timetool': [], 'ipm': []}), length=1000)
         self.b_corr_timehistory = Buffer(pd.DataFrame({'timestamp':[],'correlation':[]}), length=40000)
         
-        # Initialize callbacks
-        self.cb_id_timetool = None
-        self.cb_id_amp_ipm = None
-        self.cb_id_corr_timehistory = None
+        # Correlation state carried from one message to the next, and the
+        # number of events already correlated
+        self.correlation = RollingCorrelation(windows=(120,))
+        self.correlated = 0
+        
+        # Latest data of every channel, the publish each plot last showed
+        # and the number of events already on the timetool plot
+        self.latest = {}
+        self.pushed = {}
+        self.plotted = 0
+        
+        # Initialize callback
+        self.cb_id_dispatch = None
+        self.paused = False
                 
     def clear_buffer(self):
         """
@@ -105,12 +120,29 @@ class BokehApp:
         
         """
 
-        port = 5006
         socket = context.socket(zmq.SUB)
         
-        # MUST BE FROM SAME MACHINE, CHANGE IF NECESSARY!!!
-        socket.connect("tcp://psanagpu114:%d" % port)
-        socket.setsockopt(zmq.SUBSCRIBE, b"")
+        # Only the latest message of each channel is kept, a paused or slow
+        # page gets one merged update instead of the backlog
+        conflater = Conflater(socket, self.hwm)
+        
+        # The master, or a broker.py forwarding its messages
+        socket.connect(self.address)
+        
+        def follow(names):
+            """
+            Subscribe to channels, starting from the messages a broker has
+            cached of them if there is one
+            
+            """
+            
+            subscribe(socket, names)
+            if self.cache_address is not None:
+                for frames in fetch_cached(context, self.cache_address, names):
+                    conflater.put(frames)
+        
+        # Only the channels the plots show, the ipm one follows the drop down menu
+        follow(['tt__FLTPOS_PS', 'tt__AMPL', 'event_time', self.switchButton])
         
         # Note: Cannot name 'timetool' variables in hvTimeTool and hvIpmAmp the same thing
         # Otherwise, holoviews will try to sync the axis and throw off the ranges for the plots
@@ -133,92 +165,111 @@ class BokehApp:
 
         layout = (hvIpmAmp+hvCorrTimeHistory+hvTimeTool).cols(2)
         hvplot = renderer.get_plot(layout)
+        
+        def event_times(event_time):
+            """
+            Convert event_time (seconds, nanoseconds) to milliseconds so the
+            bokeh formatter can get the correct datetime
+            
+            """
+            
+            return [1000*float(str(time[0]) + "." + str(time[1])) for time in event_time]
 
-        def push_data_timetool(buffer):
+        def push_data_timetool(buffer, data_dict, times):
             """
             Push data to timetool time history graph
             
             """
 
-            timetool_d = deque(maxlen=self.maxlen)
-            timetool_t = deque(maxlen=self.maxlen)
-
-            if socket.poll(timeout=0):
-                data_dict = socket.recv_pyobj()
-                timetool_d = data_dict['tt__FLTPOS_PS']
-
-                # Get time from data_dict
-                timeData = deque(maxlen=self.maxlen)
-                for time in data_dict['event_time']:
-                    num1 = str(time[0])
-                    num2 = str(time[1])
-                    fullnum = num1 + "." + num2
-                    timeData.append(float(fullnum))
-                timetool_t = timeData
-
-            # Convert time to seconds so bokeh formatter can get correct datetime
-            times = [1000*time for time in list(timetool_t)]
-
-            data = pd.DataFrame({'timestamp': times, 'timetool': timetool_d})
+            # Messages hold the whole history, only the events past the plotted ones are new
+            timetool_d = data_dict['tt__FLTPOS_PS']
+            start = self.plotted if len(timetool_d) >= self.plotted else 0
+            self.plotted = len(timetool_d)
+            data = pd.DataFrame({'timestamp': times[start:], 'timetool': timetool_d[start:]})
                         
             buffer.send(data)
             
-        def push_data_amp_ipm (buffer):
+        def push_data_amp_ipm(buffer, data_dict):
             """
             Push data into timetool amp vs ipm graph
             
             """
         
-            timetool_d = deque(maxlen=self.maxlen)
-            ipm_d = deque(maxlen=self.maxlen)
-
-            if socket.poll(timeout=0):
-                data_dict = socket.recv_pyobj()
-                timetool_d = data_dict['tt__AMPL']
-                ipm_d = data_dict[self.switchButton]
-
-            data = pd.DataFrame({'timetool': timetool_d, 'ipm': ipm_d})
+            # The plot only keeps the last 1000 events
+            data = pd.DataFrame({'timetool': data_dict['tt__AMPL'][-1000:], 'ipm': data_dict[self.switchButton][-1000:]})
 
             buffer.send(data)
             
-        def push_data_corr_time_history(buffer):
+        def push_data_corr_time_history(buffer, data_dict, times):
             """
             Calculate correlation between timetool amp and ipm and
             push to correlation time history graph
             
             """
         
-            timetool_d = deque(maxlen=self.maxlen)
-            timetool_t = deque(maxlen=self.maxlen)
-            ipm_d = deque(maxlen=self.maxlen)
-
-            if socket.poll(timeout=0):
-                data_dict = socket.recv_pyobj()
-                timetool_d = data_dict['tt__FLTPOS_PS']
-                ipm_d = data_dict[self.switchButton]
-
-                # Get time from data_dict
-                timeData = deque(maxlen=self.maxlen)
-                for time in data_dict['event_time']:
-                    num1 = str(time[0])
-                    num2 = str(time[1])
-                    fullnum = num1 + "." + num2
-                    timeData.append(float(fullnum))
-                timetool_t = timeData
-
-            # Convert time to seconds so bokeh formatter can get correct datetime
-            times = [1000*time for time in list(timetool_t)]
-
-            data = pd.DataFrame({'timetool': timetool_d, 'ipm': ipm_d})
-            data_corr = data['timetool'].rolling(window=120).corr(other=data['ipm'])
+            timetool_d = data_dict['tt__FLTPOS_PS']
+            ipm_d = data_dict[self.switchButton]
+            
+            # Every message holds the whole history so far, a shorter one
+            # means the master started over
+            if len(timetool_d) < self.correlated:
+                self.correlation = RollingCorrelation(windows=(120,))
+                self.correlated = 0
+            
+            # Only the new events are correlated, earlier ones are kept in the window
+            start = self.correlated
+            data_corr = self.correlation.add(timetool_d[start:], ipm_d[start:])[120]
+            self.correlated = len(timetool_d)
 
-            # Start at index 119 so we don't get null data
             final_df = pd.DataFrame({
-                'timestamp': times[119:], 
-                'correlation': data_corr[119:]
+                'timestamp': times[start:], 
+                'correlation': data_corr
             })
 
             buffer.send(final_df)
+        
+        def dispatch():
+            """
+            Receive and decode what arrived on the socket once, and push it to
+            every plot with new data under a single hold, so the three plots
+            always show the same events. While paused messages are still
+            taken off the socket, keeping only the latest of each channel.
+            
+            """
+            
+            if self.paused:
+                conflater.drain()
+                return
+            received = conflater.receive()
+            status.text = "Dropped: %d messages, lag: %.1f s" % (conflater.dropped, conflater.lag)
+            if not received:
+                return
+            self.latest.update(received)
+            
+            def ready(plot, names):
+                # Every channel arrived from the same publish, one the plot hasn't shown
+                if not all(name in self.latest for name in names):
+                    return False
+                publishes = set(conflater.publishes.get(name) for name in names)
+                if len(publishes) != 1 or self.pushed.get(plot) in publishes:
+                    return False
+                self.pushed[plot] = publishes.pop()
+                return True
+            
+            times = None
+            if 'event_time' in self.latest:
+                times = event_times(self.latest['event_time'])
+            
+            doc.hold('combine')
+            try:
+                if ready('timetool', ['tt__FLTPOS_PS', 'event_time']):
+                    push_data_timetool(self.b_timetool, self.latest, times)
+                if ready('amp_ipm', ['tt__AMPL', self.switchButton]):
+                    push_data_amp_ipm(self.b_IpmAmp, self.latest)
+                if ready('corr_time_history', ['tt__FLTPOS_PS', self.switchButton, 'event_time']):
+                    push_data_corr_time_history(self.b_corr_timehistory, self.latest, times)
+            finally:
+                doc.unhold()
                     
         def switch(attr, old, new):
             """
@@ -226,7 +277,11 @@ class BokehApp:
 
             """
             
+            unsubscribe(socket, [self.switchButton])
             self.switchButton = select.value
+            follow([self.switchButton])
+            self.correlation = RollingCorrelation(windows=(120,))
+            self.correlated = 0
             self.clear_buffer()
         
         def stop():
@@ -237,41 +292,14 @@ class BokehApp:
             
             if stopButton.label == 'Play':
                 stopButton.label = 'Pause'
-                self.cb_id_timetool = doc.add_periodic_callback(
-                    partial(push_data_timetool, 
-                            buffer=self.b_timetool), 
-                    1000)
-
-                self.cb_id_amp_ipm = doc.add_periodic_callback(
-                    partial(push_data_amp_ipm,
-                            buffer=self.b_IpmAmp), 
-                    1000)
-
-                self.cb_id_corr_timehistory = doc.add_periodic_callback(
-                    partial(push_data_corr_time_history, 
-                            buffer=self.b_corr_timehistory), 
-                    1000)
+                self.paused = False
+                dispatch()
             else:
                 stopButton.label = 'Play'
-                doc.remove_periodic_callback(self.cb_id_timetool)
-                doc.remove_periodic_callback(self.cb_id_amp_ipm)
-                doc.remove_periodic_callback(self.cb_id_corr_timehistory)
+                self.paused = True
         
         # Start the callback
-        self.cb_id_timetool = doc.add_periodic_callback(
-            partial(push_data_timetool, 
-                    buffer=self.b_timetool), 
-            1000)
-
-        self.cb_id_amp_ipm = doc.add_periodic_callback(
-            partial(push_data_amp_ipm,
-                    buffer=self.b_IpmAmp), 
-            1000)
-
-        self.cb_id_corr_timehistory = doc.add_periodic_callback(
-            partial(push_data_corr_time_history, 
-                    buffer=self.b_corr_timehistory), 
-            1000)
+        self.cb_id_dispatch = doc.add_periodic_callback(dispatch, 1000)
         
         # Use this to test since ipm2 and ipm3 are too similar to see any differences
         # select = Select(title='ipm value:', value='ipm2__sum', options=['ipm2__sum', 'tt__FLTPOS_PS'])
@@ -281,31 +309,47 @@ class BokehApp:
         stopButton = Button(label='Pause')
         stopButton.on_click(stop)
         
-        plot = column(select, stopButton, hvplot.state)
+        status = Div(text="Dropped: 0 messages, lag: 0.0 s")
+        
+        plot = column(select, stopButton, status, hvplot.state)
         doc.add_root(plot)
         
-def make_document(context, doc):
+def make_document(context, hwm, address, cache_address, doc):
     """
     Create an instance of BokehApp() for each instance of the server
     
     """
     
-    bokehApp = BokehApp()
+    bokehApp = BokehApp(hwm, address, cache_address)
     
     bokehApp.produce_graphs(context, doc)
     
-def launch_server():
+def launch_server(hwm=10, address="tcp://psanagpu114:5006", cache_address=None):
     """
     Launch a bokeh_server to plot the a timetool time history, timetool amp
     vs ipm, and correlation graph by using zmq to get the data.
     
+    Parameters
+    ----------
+    
+    hwm: int
+        Most messages queued for each page before new ones are dropped
+        
+    address: str
+        Address to receive data from, the master or a broker.py in front
+        of it to take the fan-out to many dashboards off the master
+        
+    cache_address: str
+        Address of the cache of a broker.py, for new pages to start from the
+        latest messages instead of waiting for the next ones
+    
     """
    
     context = zmq.Context()
 
     origins = ["localhost:{}".format(5000)]
     
-    apps = {'/': Application(FunctionHandler(partial(make_document, context)))}
+    apps = {'/': Application(FunctionHandler(partial(make_document, context, hwm, address, cache_address)))}
     server = Server(apps, port=5000)
     
     server.start()
@@ -322,4 +366,4 @@ def launch_server():
         
         
 if __name__ == '__main__':
-    launch_server()
+    launch_server(*[int(arg) for arg in sys.argv[1:2]] + sys.argv[2:4])